@@ -0,0 +1,208 @@
+import heapq
+import itertools
+import math
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app, g, request
+from metrics import add_phase
+from pool import READ_METHODS
+
+
+# Rejected refuses a request before it is served: 503 when the worker is
+# overloaded, 429 when the caller is over its rate limit. retry_after is in
+# seconds.
+class Rejected(Exception):
+    def __init__(self, status_code, retry_after):
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+class Waiter:
+    __slots__ = ('event', 'admitted', 'shed')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.admitted = False
+        self.shed = False
+
+
+# AdmissionController bounds the requests a worker serves at once. Up to
+# max_concurrent run, up to max_queue more wait for a slot in priority
+# order, and the others are refused at once instead of piling up in front
+# of the database until they all time out. A request of higher priority
+# arriving at a full queue takes the place of the lowest queued one, which
+# is refused. A request still queued after queue_timeout seconds gives up.
+class AdmissionController:
+    def __init__(self, max_concurrent, max_queue=None, queue_timeout=5):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_concurrent if max_queue is None else max_queue
+        self.queue_timeout = queue_timeout
+        self._active = 0
+        # Heap of [priority, arrival, waiter].
+        self._waiting = []
+        self._arrivals = itertools.count()
+        self._lock = threading.Lock()
+        self._stats = {
+            'admitted': 0,
+            'shed': 0,
+            'queue_timeouts': 0,
+        }
+
+    # acquire() returns True once the request may run, False if it is
+    # refused. Lower priorities go first. Every admitted request must
+    # release() its slot.
+    def acquire(self, priority=0):
+        with self._lock:
+            if self._active < self.max_concurrent and not self._waiting:
+                self._active += 1
+                self._stats['admitted'] += 1
+                return True
+
+            if len(self._waiting) >= self.max_queue:
+                lowest = max(self._waiting) if self._waiting else None
+                self._stats['shed'] += 1
+                if lowest is None or lowest[0] <= priority:
+                    return False
+                self._waiting.remove(lowest)
+                heapq.heapify(self._waiting)
+                lowest[2].shed = True
+                lowest[2].event.set()
+
+            waiter = Waiter()
+            entry = [priority, next(self._arrivals), waiter]
+            heapq.heappush(self._waiting, entry)
+
+        waiter.event.wait(self.queue_timeout)
+        with self._lock:
+            if waiter.admitted:
+                return True
+            if not waiter.shed:
+                self._waiting.remove(entry)
+                heapq.heapify(self._waiting)
+                self._stats['queue_timeouts'] += 1
+            return False
+
+    # release() hands the slot of a finished request to the first queued
+    # one.
+    def release(self):
+        with self._lock:
+            if self._waiting:
+                waiter = heapq.heappop(self._waiting)[2]
+                waiter.admitted = True
+                waiter.event.set()
+                self._stats['admitted'] += 1
+            else:
+                self._active -= 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['active'] = self._active
+            stats['waiting'] = len(self._waiting)
+        return stats
+
+
+# RateLimiter keeps a token bucket per subject: burst tokens at most,
+# refilled at rate per second. Buckets of the least recently seen subjects
+# are dropped beyond max_subjects.
+class RateLimiter:
+    def __init__(self, rate, burst, max_subjects=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_subjects = max_subjects
+        # subject -> [tokens, monotonic time of the last refill]
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {
+            'rate_limited': 0,
+        }
+
+    # take() takes a token from the bucket of a subject. Returns 0 if there
+    # was one, otherwise the seconds until there is.
+    def take(self, subject):
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(subject)
+            if bucket is None:
+                bucket = self._buckets[subject] = [self.burst, now]
+                if len(self._buckets) > self.max_subjects:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(subject)
+                bucket[0] = min(self.burst,
+                                bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0
+            self._stats['rate_limited'] += 1
+            return (1 - bucket[0]) / self.rate
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['subjects'] = len(self._buckets)
+        return stats
+
+
+# setup_admission(app) bounds the requests each worker serves at once (see
+# AdmissionController) and, with RATE_LIMIT_PER_SECOND, the requests of
+# each token subject. Admission runs before any route, so a refused request
+# never costs a token verification or a database connection.
+def setup_admission(app):
+    if app.config['ADMISSION_MAX_CONCURRENT']:
+        app.extensions['admission'] = AdmissionController(
+            app.config['ADMISSION_MAX_CONCURRENT'],
+            max_queue=app.config['ADMISSION_MAX_QUEUE'],
+            queue_timeout=app.config['ADMISSION_QUEUE_TIMEOUT'])
+    if app.config['RATE_LIMIT_PER_SECOND']:
+        app.extensions['rate_limiter'] = RateLimiter(
+            app.config['RATE_LIMIT_PER_SECOND'],
+            app.config['RATE_LIMIT_BURST'],
+            max_subjects=app.config['RATE_LIMIT_SUBJECTS'])
+    app.before_request(admit)
+    app.teardown_request(release)
+
+
+# priority() ranks a request for admission, lower first: authenticated
+# reads, then anonymous reads (refused by auth anyway), then writes.
+def priority():
+    if request.method in READ_METHODS:
+        return 0 if 'Authorization' in request.headers else 1
+    return 2
+
+
+def admit():
+    controller = current_app.extensions.get('admission')
+    if controller is None or request.method == 'OPTIONS' or \
+            request.endpoint == 'metrics':
+        return
+
+    start = time.perf_counter()
+    admitted = controller.acquire(priority())
+    add_phase('admission', start)
+    if not admitted:
+        raise Rejected(503, current_app.config['ADMISSION_RETRY_AFTER'])
+    # The slot is released with the request context, after the last chunk
+    # of a streamed response.
+    g.admission = controller
+
+
+def release(error=None):
+    controller = g.pop('admission', None)
+    if controller is not None:
+        controller.release()
+
+
+# check_rate_limit() raises Rejected(429) if the subject of a verified token
+# is over its rate limit. Called by requires_auth.
+def check_rate_limit(payload):
+    limiter = current_app.extensions.get('rate_limiter')
+    subject = payload.get('sub')
+    if limiter is None or subject is None:
+        return
+    wait = limiter.take(subject)
+    if wait:
+        raise Rejected(429, math.ceil(wait))
@@ -1,63 +1,567 @@
-from flask import Flask, request, abort, jsonify
-from flask_sqlalchemy import SQLAlchemy
+from flask import Flask, Blueprint, request, abort, jsonify, Response
+from flask import current_app, g, has_app_context, make_response
+from flask import stream_with_context
 from flask_cors import CORS
-from models import Movie, Actor, setup_db
-from auth import requires_auth, AuthError
-import os
-
-
-# create_app() sets up the app and db
+from functools import wraps
+from config import from_env
+from models import Movie, Actor, setup_db, get_versions, on_commit
+from models import db, bulk_insert
+from auth import requires_auth, setup_auth, AuthError
+from admission import Rejected, setup_admission
+from response_cache import ResponseCache
+from group_commit import GroupCommitter
+from replicas import setup_replicas
+from sqlalchemy import inspect
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.orm import selectinload
+from metrics import add_phase, count_auth_failure, setup_metrics
+from search import search, MIN_QUERY_LENGTH
+from catalog_stats import read_stats, summary
+from cast_graph import BuildTimeout, CastGraphIndex
+from compression import setup_compression
+from serialize import columns, formatter, format_rows, json_response
+from serialize import dumps
+from sqlstats import setup_sqlstats
+import base64
+import datetime
+import hashlib
+import json
+import time
+
+api = Blueprint('api', __name__)
+
+# Relationships that can be embedded with ?include= and the tables they are
+# read from.
+INCLUDES = {
+    'actors': ('movies_actors', 'actor'),
+    'movies': ('movies_actors', 'movie'),
+}
+
+
+# create_app() sets up the app and db. Settings are resolved once from the
+# environment (see config.py), nothing connects to the database or Auth0
+# until the first request.
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
-    setup_db(app, os.environ['DATABASE_URL'])
+    app.config.update(from_env())
+    if test_config is not None:
+        app.config.update(test_config)
+
+    setup_db(app, app.config['SQLALCHEMY_DATABASE_URI'])
+    setup_auth(app)
+
+    # GET requests read from the replicas, if any, see replicas.py.
+    if app.config['DATABASE_REPLICA_URLS']:
+        setup_replicas(app)
+
+    # List responses are shared by the workers through a local SQLite
+    # file, see response_cache.py.
+    if app.config['RESPONSE_CACHE']:
+        app.extensions['response_cache'] = ResponseCache(
+            path=app.config['RESPONSE_CACHE_PATH'],
+            max_bytes=app.config['RESPONSE_CACHE_MAX_BYTES'],
+            ttl=app.config['RESPONSE_CACHE_TTL']
+        )
+
+    # Single-row inserts share transactions, see group_commit.py.
+    if app.config['GROUP_COMMIT']:
+        app.extensions['group_commit'] = GroupCommitter(
+            app,
+            max_rows=app.config['GROUP_COMMIT_MAX_ROWS'],
+            max_wait_ms=app.config['GROUP_COMMIT_MAX_WAIT_MS']
+        )
+
+    # Co-stars and paths between actors are answered from an in-memory
+    # index of movies_actors, built on first use, see cast_graph.py.
+    app.extensions['cast_graph'] = CastGraphIndex(
+        build_seconds=app.config['CAST_GRAPH_BUILD_SECONDS'],
+        chunk_size=app.config['STREAM_CHUNK_SIZE']
+    )
+
+    # gzip, deflate, br and zstd responses for the clients accepting them,
+    # see compression.py.
+    if app.config['COMPRESSION']:
+        setup_compression(app)
+
+    # Statement counts, DB time and the slow query log, see sqlstats.py.
+    setup_sqlstats(app)
+
+    # Phase histograms and component statistics at /metrics, see
+    # metrics.py.
+    if app.config['METRICS']:
+        setup_metrics(app)
+
+    # Concurrency limits, load shedding and rate limits, see admission.py.
+    # Set up after the metrics so the time spent queued is measured.
+    setup_admission(app)
+
+    app.register_blueprint(api)
     CORS(app)
     return app
 
 
-APP = create_app()
+# Writes drop the cached responses of the tables they changed in every
+# worker.
+@on_commit
+def invalidate_cached(tables):
+    if has_app_context():
+        response_cache = current_app.extensions.get('response_cache')
+        if response_cache is not None:
+            response_cache.invalidate(tables)
 
 
 # format() formats db.model instances using the format method for each class.
-def format(list):
-    return [item.format() for item in list]
+# Related instances named in includes are embedded ordered by id.
+def format(list, includes=()):
+    data = [item.format() for item in list]
 
+    for name in includes:
+        for item, formatted in zip(list, data):
+            related = sorted(getattr(item, name), key=lambda r: r.id)
+            formatted[name] = format(related)
 
-# get() queries a db.model class and checks for 404 error.
-def get(table):
-    data = table.query.all()
+    return data
 
-    if len(data) == 0:
-        abort(404)
 
-    return data
+# include_args() returns the relationships named in ?include= after
+# checking the db.model class has them, 400 otherwise.
+def include_args(table):
+    names = [name for name in request.args.get('include', '').split(',')
+             if name]
+
+    for name in names:
+        if name not in INCLUDES or not hasattr(table, name):
+            abort(400)
+
+    return names
+
+
+# request_tables() adds the tables read by ?include= to the given tables.
+def request_tables(tables):
+    tables = list(tables)
+    for name in request.args.get('include', '').split(','):
+        for table in INCLUDES.get(name, ()):
+            if table not in tables:
+                tables.append(table)
+    return tuple(tables)
+
+
+# encode_cursor() turns the last id of a page (or another integer position
+# named by key) into an opaque cursor.
+def encode_cursor(value, key='id'):
+    cursor = json.dumps({key: value}).encode()
+    return base64.urlsafe_b64encode(cursor).decode().rstrip('=')
+
+
+# decode_cursor() returns the position encoded in a cursor, 400 if malformed.
+def decode_cursor(cursor, key='id'):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        value = json.loads(base64.urlsafe_b64decode(padded))[key]
+    except (ValueError, TypeError, KeyError):
+        abort(400)
+
+    if not isinstance(value, int) or isinstance(value, bool):
+        abort(400)
 
+    return value
 
-@APP.route('/movies')
+
+# page_args() reads the limit and cursor query parameters.
+def page_args(key='id'):
+    limit = parse_limit(request.args.get('limit'), current_app.config)
+
+    cursor = request.args.get('cursor')
+    after = decode_cursor(cursor, key) if cursor else None
+
+    return limit, after
+
+
+# parse_limit() returns the page size of a ?limit= value, capped at
+# MAX_PAGE_SIZE, 400 if it isn't a positive integer. Shared with asgi.py.
+def parse_limit(limit, config):
+    if limit is None:
+        limit = str(config['DEFAULT_PAGE_SIZE'])
+    # isdigit() alone accepts digits int() cannot parse, such as '²'.
+    if not (limit.isascii() and limit.isdigit()) or int(limit) < 1:
+        abort(400)
+    return min(int(limit), config['MAX_PAGE_SIZE'])
+
+
+# get() queries one page of a db.model class ordered by id and checks for
+# 404 error on the first page. Returns the rows and the next cursor.
+# Relationships in includes are loaded with one extra IN query each for
+# the whole page.
+def get(table, includes=()):
+    limit, after = page_args()
+
+    if includes:
+        query = table.query
+        for name in includes:
+            query = query.options(selectinload(getattr(table, name)))
+    else:
+        # Plain pages are read as column tuples, no objects are built.
+        query = db.session.query(*columns(table))
+    query = query.order_by(table.id)
+    if after is not None:
+        query = query.filter(table.id > after)
+    # One extra row tells whether there is a next page.
+    data = query.limit(limit + 1).all()
+
+    if len(data) == 0 and after is None:
+        abort(404)
+
+    next_cursor = None
+    if len(data) > limit:
+        data = data[:limit]
+        next_cursor = encode_cursor(data[-1].id)
+
+    start = time.perf_counter()
+    if includes:
+        data = format(data, includes)
+    else:
+        data = format_rows(table, data)
+    add_phase('serialize', start)
+
+    return data, next_cursor
+
+
+# stream_mode() returns 'json' or 'ndjson' if the client asked for a
+# streamed export with ?stream=1, ?stream=ndjson or the NDJSON media type.
+def stream_mode():
+    stream = request.args.get('stream', '').lower()
+    if stream == 'ndjson':
+        return 'ndjson'
+    if stream in ('1', 'true', 'json'):
+        return 'json'
+    if request.accept_mimetypes.best == 'application/x-ndjson':
+        return 'ndjson'
+    return None
+
+
+# stream() exports a whole db.model class ordered by id. Rows are read in
+# chunks through a server-side cursor and written out as they arrive, so
+# memory stays flat however big the table is. Checks for 404 error.
+def stream(table, key, mode):
+    chunk_size = current_app.config['STREAM_CHUNK_SIZE']
+    query = db.session.query(*columns(table)).order_by(table.id) \
+        .execution_options(stream_results=True) \
+        .yield_per(chunk_size)
+    rows = iter(query)
+
+    # The first row is read up front so an empty table is still a 404.
+    first = next(rows, None)
+    if first is None:
+        abort(404)
+
+    format_row = formatter(table)
+
+    def generate():
+        if mode == 'json':
+            yield '{"%s":[' % key + dumps(format_row(first))
+            separator = ','
+        else:
+            yield dumps(format_row(first)) + '\n'
+            separator = ''
+
+        chunk = []
+        for row in rows:
+            chunk.append(separator + dumps(format_row(row)))
+            if mode == 'ndjson':
+                chunk.append('\n')
+            if len(chunk) >= chunk_size:
+                yield ''.join(chunk)
+                chunk = []
+        yield ''.join(chunk)
+
+        if mode == 'json':
+            yield '],"success":true}\n'
+
+    mimetype = 'application/json'
+    if mode == 'ndjson':
+        mimetype = 'application/x-ndjson'
+
+    return Response(stream_with_context(generate()), mimetype=mimetype)
+
+
+# table_etag() builds a strong ETag from the version counters of the tables
+# a response is read from and the representation the client asked for.
+def table_etag(tables):
+    versions = get_versions(*tables)
+    key = repr((tables, versions, request.full_path, stream_mode()))
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+# decorator used to answer conditional GETs with 304 Not Modified without
+# reading the tables when none of them changed. The comparison is weak,
+# compressed responses carry the ETag as a weak one.
+def conditional(*tables):
+    def conditional_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            etag = g.etag = table_etag(request_tables(tables))
+            if request.if_none_match.contains_weak(etag):
+                response = Response(status=304)
+                response.set_etag(etag)
+                return response
+
+            response = make_response(f(*args, **kwargs))
+            if response.status_code == 200 and not g.get('stale'):
+                response.set_etag(etag)
+            return response
+
+        return wrapper
+    return conditional_decorator
+
+
+# decorator used to serve responses from the shared response cache. The key
+# covers the ETag (table versions, URL and format) and the permissions of
+# the caller. Streamed exports and stale responses (g.stale) are never
+# cached. Compressed bodies are stored under the key and their encoding by
+# compression.py, a client accepting the same encoding is served them as
+# they are.
+def cached(*tables):
+    def cached_decorator(f):
+        @wraps(f)
+        def wrapper(token, *args, **kwargs):
+            response_cache = current_app.extensions.get('response_cache')
+            if response_cache is None or stream_mode() is not None:
+                return f(token, *args, **kwargs)
+
+            read_tables = request_tables(tables)
+            etag = g.get('etag') or table_etag(read_tables)
+            scope = ' '.join(sorted(token.get('permissions', [])))
+            key = hashlib.sha1(f'{etag}|{scope}'.encode()).hexdigest()
+
+            compression = current_app.extensions.get('compression')
+            encoding = None
+            if compression is not None:
+                encoding = compression.negotiate(request.accept_encodings)
+            if encoding is not None:
+                hit = response_cache.get(f'{key}|{encoding}')
+                if hit is not None:
+                    g.compressed = encoding
+                    mimetype, body = hit
+                    return Response(body, mimetype=mimetype)
+            g.cache_key = (key, read_tables)
+
+            hit = response_cache.get(key)
+            if hit is not None:
+                mimetype, body = hit
+                return Response(body, mimetype=mimetype)
+
+            response = make_response(f(token, *args, **kwargs))
+            if response.status_code == 200 and not response.is_streamed \
+                    and not g.get('stale'):
+                response_cache.set(key, read_tables, response.mimetype,
+                                   response.get_data())
+            return response
+
+        return wrapper
+    return cached_decorator
+
+
+@api.route('/movies')
 @requires_auth('view:content')
+@conditional('movie')
+@cached('movie')
 def getMovies(token):
 
-    movies = get(Movie)
+    includes = include_args(Movie)
+    mode = stream_mode()
+    if mode is not None:
+        # Exports are flat, relationships are only embedded in pages.
+        if includes:
+            abort(400)
+        return stream(Movie, 'movies', mode)
 
-    return jsonify({
+    movies, next_cursor = get(Movie, includes)
+
+    return json_response({
         'success': True,
-        'movies': format(movies)
+        'movies': movies,
+        'next_cursor': next_cursor
     })
 
 
-@APP.route('/actors')
+@api.route('/actors')
 @requires_auth('view:content')
+@conditional('actor')
+@cached('actor')
 def getActors(token):
 
-    actors = get(Actor)
+    includes = include_args(Actor)
+    mode = stream_mode()
+    if mode is not None:
+        # Exports are flat, relationships are only embedded in pages.
+        if includes:
+            abort(400)
+        return stream(Actor, 'actors', mode)
+
+    actors, next_cursor = get(Actor, includes)
+
+    return json_response({
+        'success': True,
+        'actors': actors,
+        'next_cursor': next_cursor
+    })
+
+
+# search_page() answers a search request over one column of a db.model
+# class. Results are ranked, so pages are addressed by offset.
+def search_page(table, column, key):
+    q = request.args.get('q', '').strip()
+    if len(q) < MIN_QUERY_LENGTH:
+        abort(400)
+
+    limit, offset = page_args('offset')
+    offset = offset or 0
+    # One extra row tells whether there is a next page.
+    data = search(table, column, q, limit + 1, offset)
+
+    next_cursor = None
+    if len(data) > limit:
+        data = data[:limit]
+        next_cursor = encode_cursor(offset + limit, 'offset')
+
+    return jsonify({
+        'success': True,
+        key: format(data),
+        'next_cursor': next_cursor
+    })
+
+
+@api.route('/movies/search')
+@requires_auth('view:content')
+@conditional('movie')
+@cached('movie')
+def searchMovies(token):
+    return search_page(Movie, Movie.title, 'movies')
+
+
+@api.route('/actors/search')
+@requires_auth('view:content')
+@conditional('actor')
+@cached('actor')
+def searchActors(token):
+    return search_page(Actor, Actor.name, 'actors')
+
+
+# GET /stats serves the catalog counts kept in catalog_stats, without
+# reading the movie and actor tables.
+@api.route('/stats')
+@requires_auth('view:content')
+@conditional('movie', 'actor', 'movies_actors')
+@cached('movie', 'actor', 'movies_actors')
+def getStats(token):
 
     return jsonify({
         'success': True,
-        'actors': format(actors)
+        'stats': summary(read_stats())
     })
 
 
-@APP.route('/movies', methods=['POST'])
+# cast_graph() returns the latest graph of the links, 503 if the first one
+# isn't built within CAST_GRAPH_BUILD_SECONDS. A response answered from
+# the previous graph while a new one is built is marked stale, it must not
+# be cached or validated under the current table versions.
+def cast_graph():
+    version = get_versions('movies_actors')[0]
+    try:
+        graph = current_app.extensions['cast_graph'].graph(version)
+    except BuildTimeout:
+        abort(503)
+    if graph.version < version:
+        g.stale = True
+    return graph
+
+
+# rows_by_id() returns the rows of columns(table) with the given ids, by
+# id.
+def rows_by_id(table, ids):
+    if not ids:
+        return {}
+    return {row.id: row for row in
+            db.session.query(*columns(table)).filter(table.id.in_(ids))}
+
+
+# GET /actors/<id>/costars lists the actors who played in a movie with the
+# actor, most shared movies first. Pages are addressed by offset.
+@api.route('/actors/<int:actor_id>/costars')
+@requires_auth('view:content')
+@conditional('actor', 'movies_actors')
+@cached('actor', 'movies_actors')
+def getCostars(token, actor_id):
+
+    limit, offset = page_args('offset')
+    offset = offset or 0
+    if db.session.query(Actor.id).filter_by(id=actor_id).first() is None:
+        abort(404)
+
+    costars = cast_graph().costars(actor_id)
+    page = costars[offset:offset + limit]
+    rows = rows_by_id(Actor, [costar_id for costar_id, shared in page])
+    format_row = formatter(Actor)
+
+    data = []
+    for costar_id, shared in page:
+        if costar_id in rows:
+            data.append(dict(format_row(rows[costar_id]),
+                             shared_movies=shared))
+
+    next_cursor = None
+    if len(costars) > offset + limit:
+        next_cursor = encode_cursor(offset + limit, 'offset')
+
+    return jsonify({
+        'success': True,
+        'actor_id': actor_id,
+        'costars': data,
+        'next_cursor': next_cursor
+    })
+
+
+# GET /actors/<id>/path/<id> returns a shortest chain of actors and the
+# movies linking them, degrees is the number of movies. Actors not
+# connected within CAST_GRAPH_MAX_DEGREES movies get a null degrees.
+@api.route('/actors/<int:actor_id>/path/<int:other_id>')
+@requires_auth('view:content')
+@conditional('actor', 'movie', 'movies_actors')
+@cached('actor', 'movie', 'movies_actors')
+def getActorPath(token, actor_id, other_id):
+
+    found = db.session.query(Actor.id) \
+        .filter(Actor.id.in_({actor_id, other_id})).count()
+    if found < len({actor_id, other_id}):
+        abort(404)
+
+    chain = cast_graph().path(actor_id, other_id,
+                              current_app.config['CAST_GRAPH_MAX_DEGREES'])
+    if chain is None:
+        return jsonify({
+            'success': True,
+            'degrees': None,
+            'actors': [],
+            'movies': []
+        })
+
+    actor_ids, movie_ids = chain
+    actors = rows_by_id(Actor, actor_ids)
+    movies = rows_by_id(Movie, movie_ids)
+    format_actor, format_movie = formatter(Actor), formatter(Movie)
+
+    return jsonify({
+        'success': True,
+        'degrees': len(movie_ids),
+        'actors': [format_actor(actors[id]) for id in actor_ids
+                   if id in actors],
+        'movies': [format_movie(movies[id]) for id in movie_ids
+                   if id in movies]
+    })
+
+
+@api.route('/movies', methods=['POST'])
 @requires_auth('add:movie')
 def postMovie(token):
 
@@ -68,15 +572,144 @@ def postMovie(token):
     title = body.get('title')
     releaseDate = body.get('releaseDate')
 
-    movie = Movie(title, releaseDate)
-    movie.add()
+    group_commit = current_app.extensions.get('group_commit')
+    if group_commit is not None:
+        movie_id = group_commit.insert(
+            Movie, {'title': title, 'releaseDate': releaseDate})
+    else:
+        movie = Movie(title, releaseDate)
+        movie.add()
+        # The identity survives the commit, reading movie.id would load
+        # the row again.
+        movie_id = inspect(movie).identity[0]
+
+    return jsonify({
+        'success': True,
+        'id': movie_id
+    })
+
+
+# batch_items() reads the records of a batch request from a JSON array,
+# an {"items": [...]} object or an NDJSON body.
+def batch_items():
+    if request.mimetype == 'application/x-ndjson':
+        lines = request.get_data(as_text=True).splitlines()
+        try:
+            items = [json.loads(line) for line in lines if line.strip()]
+        except ValueError:
+            abort(400)
+    else:
+        items = request.get_json()
+        if isinstance(items, dict):
+            items = items.get('items')
+
+    if not isinstance(items, list) or len(items) == 0:
+        abort(400)
+    if len(items) > current_app.config['BATCH_MAX_SIZE']:
+        abort(413)
+
+    return items
+
+
+# validate_movie() returns the column values of a movie record, raises a
+# ValueError explaining why the record is invalid otherwise.
+def validate_movie(item):
+    if not isinstance(item, dict):
+        raise ValueError('Record must be an object.')
+
+    title = item.get('title')
+    if not isinstance(title, str) or not title.strip() or len(title) > 150:
+        raise ValueError('title must be a string of 1 to 150 characters.')
+
+    releaseDate = item.get('releaseDate')
+    if releaseDate is not None:
+        try:
+            releaseDate = datetime.datetime.fromisoformat(releaseDate)
+        except (TypeError, ValueError):
+            raise ValueError('releaseDate must be YYYY-MM-DD HH:MM:SS.')
+
+    return {'title': title, 'releaseDate': releaseDate}
+
+
+# validate_actor() returns the column values of an actor record, raises a
+# ValueError explaining why the record is invalid otherwise.
+def validate_actor(item):
+    if not isinstance(item, dict):
+        raise ValueError('Record must be an object.')
+
+    name = item.get('name')
+    if not isinstance(name, str) or not name.strip() or len(name) > 50:
+        raise ValueError('name must be a string of 1 to 50 characters.')
+
+    age = item.get('age')
+    if isinstance(age, str) and age.isdigit():
+        age = int(age)
+    if age is not None and (not isinstance(age, int) or
+                            isinstance(age, bool) or age < 0):
+        raise ValueError('age must be a non-negative integer.')
+
+    gender = item.get('gender')
+    if gender is not None and (not isinstance(gender, str) or
+                               len(gender) > 10):
+        raise ValueError('gender must be a string of at most 10 characters.')
+
+    return {'name': name, 'age': age, 'gender': gender}
+
+
+# post_batch() validates every record up front and inserts the valid ones
+# in a single transaction. Unless ?partial=true is given, one invalid
+# record rejects the whole batch with 422.
+def post_batch(model, validate):
+    items = batch_items()
+    partial = request.args.get('partial', '').lower() in ('1', 'true')
+
+    rows = []
+    indexes = []
+    errors = []
+    for index, item in enumerate(items):
+        try:
+            rows.append(validate(item))
+            indexes.append(index)
+        except ValueError as error:
+            errors.append({'index': index, 'message': str(error)})
+
+    if errors and not partial:
+        return jsonify({
+            'success': False,
+            'error': 422,
+            'message': 'Unprocessable entity.',
+            'errors': errors
+        }), 422
+
+    # ids follow the order of the request, null for rejected records.
+    ids = [None] * len(items)
+    if rows:
+        inserted = bulk_insert(model, rows,
+                               current_app.config['BATCH_CHUNK_SIZE'])
+        db.session.commit()
+        for index, new_id in zip(indexes, inserted):
+            ids[index] = new_id
 
     return jsonify({
-        'success': True
+        'success': True,
+        'ids': ids,
+        'errors': errors
     })
 
 
-@APP.route('/movies/<int:movie_id>', methods=['PATCH'])
+@api.route('/movies/batch', methods=['POST'])
+@requires_auth('add:movie')
+def postMovies(token):
+    return post_batch(Movie, validate_movie)
+
+
+@api.route('/actors/batch', methods=['POST'])
+@requires_auth('add:actor')
+def postActors(token):
+    return post_batch(Actor, validate_actor)
+
+
+@api.route('/movies/<int:movie_id>', methods=['PATCH'])
 @requires_auth('modify:movie')
 def patchMovie(token, movie_id):
 
@@ -84,29 +717,67 @@ def patchMovie(token, movie_id):
     if body is None:
         abort(400)
 
-    movie = Movie.query.filter_by(id=movie_id).one_or_none()
-    if movie is None:
-        abort(404)
+    values = patch_values(body)
+    versions = if_match_versions(request.if_match)
 
-    title = body.get('title')
-    movie.title = title
-    movie.update()
+    row = Movie.patch(movie_id, values, versions)
+    if row is None:
+        # Nothing was updated: the movie is missing or has a newer version.
+        exists = db.session.query(Movie.id).filter_by(id=movie_id).first()
+        abort(404 if versions is None or exists is None else 412)
+    db.session.commit()
 
-    return jsonify({
+    response = jsonify({
         'success': True,
-        'title': title
+        'title': row.title,
+        'movie': formatter(Movie)(row)
     })
-
-
-@APP.route('/actors/<int:actor_id>', methods=['DELETE'])
+    response.set_etag(str(row.version))
+    return response
+
+
+# patch_values() returns the columns a PATCH body sets, only title and
+# releaseDate can be changed. 422 if a value is invalid.
+def patch_values(body):
+    if not isinstance(body, dict):
+        abort(422)
+
+    values = {}
+    if 'title' in body:
+        title = body['title']
+        if not isinstance(title, str) or not title.strip() or \
+                len(title) > 150:
+            abort(422)
+        values['title'] = title
+    if 'releaseDate' in body:
+        releaseDate = body['releaseDate']
+        if releaseDate is not None:
+            try:
+                releaseDate = datetime.datetime.fromisoformat(releaseDate)
+            except (TypeError, ValueError):
+                abort(422)
+        values['releaseDate'] = releaseDate
+
+    if not values:
+        abort(422)
+    return values
+
+
+# if_match_versions() returns the movie versions listed in the parsed
+# If-Match header, None if the request is unconditional.
+def if_match_versions(if_match):
+    if not if_match or if_match.star_tag:
+        return None
+    return [int(tag) for tag in if_match.as_set() if tag.isdigit()]
+
+
+@api.route('/actors/<int:actor_id>', methods=['DELETE'])
 @requires_auth('delete:actor')
 def deleteActor(token, actor_id):
 
-    actor = Actor.query.filter_by(id=actor_id).one_or_none()
-    if actor is None:
+    if not Actor.delete_many([actor_id]):
         abort(404)
-
-    actor.delete()
+    db.session.commit()
 
     return jsonify({
         'success': True,
@@ -114,7 +785,81 @@ def deleteActor(token, actor_id):
     })
 
 
-@APP.errorhandler(400)
+# DELETE /actors removes the actors listed in the body, {"ids": [...]} or
+# a JSON array, in one transaction, or the actors matching a
+# {"filter": {...}} a chunk at a time.
+@api.route('/actors', methods=['DELETE'])
+@requires_auth('delete:actor')
+def deleteActors(token):
+    body = request.get_json()
+    if isinstance(body, dict) and 'filter' in body:
+        deleted = delete_actors_matching(actor_filter(body['filter']))
+    else:
+        if isinstance(body, dict):
+            body = body.get('ids')
+        deleted = Actor.delete_many(delete_ids(body),
+                                    current_app.config['DELETE_CHUNK_SIZE'])
+        db.session.commit()
+
+    return jsonify({
+        'success': True,
+        'deleted': deleted
+    })
+
+
+# delete_ids() returns the distinct ids of a bulk delete, 400 if there are
+# none, 413 if there are more than BATCH_MAX_SIZE and 422 if one is not an
+# integer.
+def delete_ids(ids):
+    if not isinstance(ids, list) or len(ids) == 0:
+        abort(400)
+    if len(ids) > current_app.config['BATCH_MAX_SIZE']:
+        abort(413)
+    if not all(isinstance(id, int) and not isinstance(id, bool)
+               for id in ids):
+        abort(422)
+    return sorted(set(ids))
+
+
+# actor_filter() returns the conditions of a delete by filter: name and
+# gender match exactly, min_age and max_age are inclusive. 422 if the
+# filter is empty or invalid.
+def actor_filter(filter):
+    if not isinstance(filter, dict) or not filter:
+        abort(422)
+
+    conditions = []
+    for key, value in filter.items():
+        if key in ('name', 'gender') and isinstance(value, str):
+            conditions.append(getattr(Actor, key) == value)
+        elif key in ('min_age', 'max_age') and isinstance(value, int) and \
+                not isinstance(value, bool):
+            conditions.append(Actor.age >= value if key == 'min_age'
+                              else Actor.age <= value)
+        else:
+            abort(422)
+    return conditions
+
+
+# delete_actors_matching() deletes the actors matching the conditions
+# DELETE_CHUNK_SIZE at a time in id order, committing after each chunk so
+# no transaction holds its locks for the whole set. Returns the ids.
+def delete_actors_matching(conditions):
+    chunk_size = current_app.config['DELETE_CHUNK_SIZE']
+    deleted = []
+    after = 0
+    while True:
+        ids = [row[0] for row in db.session.query(Actor.id)
+               .filter(Actor.id > after, *conditions)
+               .order_by(Actor.id).limit(chunk_size)]
+        if not ids:
+            return deleted
+        deleted += Actor.delete_many(ids, chunk_size)
+        db.session.commit()
+        after = ids[-1]
+
+
+@api.app_errorhandler(400)
 def bad_request_error(error):
     return jsonify({
         'success': False,
@@ -123,7 +868,7 @@ def bad_request_error(error):
     }), 400
 
 
-@APP.errorhandler(401)
+@api.app_errorhandler(401)
 def unauthorized_error(error):
     return jsonify({
         'success': False,
@@ -132,7 +877,7 @@ def unauthorized_error(error):
     }), 401
 
 
-@APP.errorhandler(404)
+@api.app_errorhandler(404)
 def not_found_error(error):
     return jsonify({
          'success': False,
@@ -141,7 +886,42 @@ def not_found_error(error):
     }), 404
 
 
-@APP.errorhandler(422)
+@api.app_errorhandler(405)
+def method_not_allowed_error(error):
+    return jsonify({
+        'success': False,
+        'error': 405,
+        'message': 'Method not allowed.'
+    }), 405, {'Allow': ', '.join(error.valid_methods or ())}
+
+
+@api.app_errorhandler(412)
+def precondition_failed_error(error):
+    return jsonify({
+         'success': False,
+         'error': 412,
+         'message': 'Precondition failed.'
+    }), 412
+
+
+# An ORM update or delete of a movie changed since it was loaded fails its
+# version check (Movie.version), answered like a stale If-Match.
+@api.app_errorhandler(StaleDataError)
+def stale_data_error(error):
+    db.session.rollback()
+    return precondition_failed_error(error)
+
+
+@api.app_errorhandler(413)
+def payload_too_large_error(error):
+    return jsonify({
+         'success': False,
+         'error': 413,
+         'message': 'Payload too large.'
+    }), 413
+
+
+@api.app_errorhandler(422)
 def unprocessable_error(error):
     return jsonify({
          'success': False,
@@ -150,8 +930,33 @@ def unprocessable_error(error):
     }), 422
 
 
-@APP.errorhandler(AuthError)
+@api.app_errorhandler(503)
+def service_unavailable_error(error):
+    return jsonify({
+         'success': False,
+         'error': 503,
+         'message': 'Service unavailable.'
+    }), 503
+
+
+@api.app_errorhandler(Rejected)
+def rejected_error(error):
+    messages = {
+        429: 'Too many requests.',
+        503: 'Service unavailable.',
+    }
+    response = jsonify({
+         'success': False,
+         'error': error.status_code,
+         'message': messages[error.status_code]
+    })
+    response.headers['Retry-After'] = str(max(error.retry_after, 1))
+    return response, error.status_code
+
+
+@api.app_errorhandler(AuthError)
 def auth_error(error):
+    count_auth_failure(error.error['code'])
     return jsonify({
          'success': False,
          'error': error.status_code,
@@ -160,4 +965,4 @@ def auth_error(error):
 
 
 if __name__ == '__main__':
-    APP.run(host='0.0.0.0', port=8080, debug=True)
+    create_app().run(host='0.0.0.0', port=8080, debug=True)
@@ -0,0 +1,442 @@
+import asyncio
+import datetime
+import json
+import logging
+import math
+import re
+import time
+from contextlib import asynccontextmanager
+from urllib.parse import parse_qs
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import dump_cookie, http_date, parse_etags
+from app import decode_cursor, encode_cursor, if_match_versions, parse_limit
+from app import patch_values
+from async_db import AsyncDatabase
+from auth import AuthError, check_permissions, decode_token
+from auth import create_key_store, create_token_cache, parse_auth_header
+from config import from_env
+from pool import READ_METHODS
+from replicas import LAST_WRITE_COOKIE
+from response_cache import ResponseCache
+
+logger = logging.getLogger(__name__)
+
+# Methods a preflight request is told are allowed, those of flask_cors'
+# defaults in the WSGI app.
+CORS_METHODS = b'DELETE, GET, HEAD, OPTIONS, PATCH, POST, PUT'
+
+# Messages of the error responses, identical to the error handlers of the
+# WSGI app in app.py.
+MESSAGES = {
+    400: 'Bad Request.',
+    401: 'Unauthorized.',
+    404: 'Resource not found.',
+    405: 'Method not allowed.',
+    412: 'Precondition failed.',
+    413: 'Payload too large.',
+    422: 'Unprocessable entity.',
+}
+
+
+# Records the last write of a token subject, like replicas.remember_subject.
+REMEMBER_WRITE = (
+    'INSERT INTO recent_writes (subject, written_at) VALUES (?, ?) '
+    'ON CONFLICT (subject) DO UPDATE SET written_at = excluded.written_at')
+
+
+class HTTPError(Exception):
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+# create_asgi_app() builds the async serving mode of the API, meant to run
+# side by side with the WSGI app: `uvicorn --factory asgi:create_asgi_app`
+# or `gunicorn -k uvicorn.workers.UvicornWorker "asgi:create_asgi_app()"`.
+# It serves the same routes with the same request/response contracts and
+# error bodies, over asyncpg (Postgres) or aiosqlite (SQLite). Exports,
+# ETags, includes, search and batch endpoints are only served by the WSGI
+# app.
+def create_asgi_app(test_config=None):
+    config = from_env()
+    if test_config is not None:
+        config.update(test_config)
+    return AsyncAPI(config)
+
+
+class AsyncAPI:
+    def __init__(self, config):
+        self.config = config
+        self.db = AsyncDatabase(
+            config['SQLALCHEMY_DATABASE_URI'],
+            min_size=1,
+            max_size=config['DB_POOL_SIZE'] + config['DB_MAX_OVERFLOW'])
+        self.jwks = create_key_store(config)
+        self.token_cache = create_token_cache(config)
+        self.response_cache = None
+        if config['RESPONSE_CACHE']:
+            self.response_cache = ResponseCache(
+                path=config['RESPONSE_CACHE_PATH'],
+                max_bytes=config['RESPONSE_CACHE_MAX_BYTES'])
+
+        self.routes = [
+            ('GET', re.compile(r'^/movies$'),
+             'view:content', self.getMovies),
+            ('GET', re.compile(r'^/actors$'),
+             'view:content', self.getActors),
+            ('POST', re.compile(r'^/movies$'),
+             'add:movie', self.postMovie),
+            ('PATCH', re.compile(r'^/movies/(\d+)$'),
+             'modify:movie', self.patchMovie),
+            ('DELETE', re.compile(r'^/actors/(\d+)$'),
+             'delete:actor', self.deleteActor),
+        ]
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            status, body, headers = await self.dispatch(scope, receive)
+            await send({
+                'type': 'http.response.start',
+                'status': status,
+                'headers': [
+                    (b'content-type', b'application/json'),
+                    (b'content-length', str(len(body)).encode()),
+                ] + cors_headers(scope) + headers,
+            })
+            # HEAD responses have the headers of the GET response only.
+            if scope['method'] == 'HEAD':
+                body = b''
+            await send({'type': 'http.response.body', 'body': body})
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await self.db.connect()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.db.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    # dispatch() routes a request and turns errors into the JSON bodies of
+    # the WSGI error handlers. Like Flask, GET routes also answer HEAD, and
+    # every route OPTIONS with the methods it allows.
+    async def dispatch(self, scope, receive):
+        method = 'GET' if scope['method'] == 'HEAD' else scope['method']
+        try:
+            allowed = set()
+            for route_method, pattern, permission, handler in self.routes:
+                match = pattern.match(scope['path'])
+                if match is None:
+                    continue
+                allowed.add(route_method)
+                if route_method != method:
+                    continue
+                token = await self.authenticate(scope, permission)
+                request = Request(scope, await read_body(receive))
+                data = await handler(token, request, *map(int, match.groups()))
+                headers = request.response_headers
+                if method not in READ_METHODS:
+                    headers += await self.remember_writes(token)
+                return 200, dumps(data), headers
+
+            if not allowed:
+                raise HTTPError(404)
+            allowed.add('OPTIONS')
+            if 'GET' in allowed:
+                allowed.add('HEAD')
+            headers = [(b'allow', ', '.join(sorted(allowed)).encode())]
+            if method == 'OPTIONS':
+                return 200, b'', headers
+            return 405, error_body(405), headers
+
+        except AuthError as error:
+            return error.status_code, dumps({
+                'success': False,
+                'error': error.status_code,
+                'message': error.error
+            }), []
+        except (HTTPError, HTTPException) as error:
+            status = getattr(error, 'status_code', None) or error.code
+            return status, error_body(status), []
+
+    # authenticate() checks the bearer token without blocking the event
+    # loop: cached tokens are checked in memory, new ones are verified
+    # (and the JWKS fetched if needed) on a worker thread.
+    async def authenticate(self, scope, permission):
+        headers = dict(scope['headers'])
+        header = headers.get(b'authorization')
+        token = parse_auth_header(header.decode('latin-1')
+                                  if header is not None else None)
+
+        verified = self.token_cache.get(token)
+        if verified is None:
+            loop = asyncio.get_event_loop()
+            payload = await loop.run_in_executor(
+                None, decode_token, token, self.jwks, self.config)
+            verified = self.token_cache.put(token, payload)
+
+        check_permissions(permission, verified.payload, verified.permissions)
+        return verified.payload
+
+    # remember_writes() records a successful write like replicas.py does in
+    # the WSGI app, when there are replicas: the recent_writes row of the
+    # token subject, and the cookie it returns the headers of.
+    async def remember_writes(self, token):
+        if not self.config['DATABASE_REPLICA_URLS']:
+            return []
+        now = time.time()
+        subject = token.get('sub')
+        if subject is not None:
+            try:
+                await self.db.fetch(REMEMBER_WRITE, subject, now)
+            except Exception:
+                logger.exception('Could not record the write of %s.',
+                                 subject)
+        window = self.config['READ_YOUR_WRITES_SECONDS']
+        cookie = dump_cookie(LAST_WRITE_COOKIE, '%.3f' % now,
+                             max_age=math.ceil(window), httponly=True,
+                             samesite='Lax')
+        return [(b'set-cookie', cookie.encode('latin-1'))]
+
+    async def getMovies(self, token, request):
+        movies, next_cursor = await self.page(
+            request, 'movie', 'id, title, "releaseDate", version')
+        return {
+            'success': True,
+            'movies': [format_movie(movie) for movie in movies],
+            'next_cursor': next_cursor
+        }
+
+    async def getActors(self, token, request):
+        actors, next_cursor = await self.page(
+            request, 'actor', 'id, name, age, gender')
+        return {
+            'success': True,
+            'actors': actors,
+            'next_cursor': next_cursor
+        }
+
+    async def postMovie(self, token, request):
+        body = request.json()
+        if body is None:
+            raise HTTPError(400)
+
+        title = body.get('title')
+        releaseDate = self.to_db_datetime(body.get('releaseDate'))
+
+        async with self.transaction() as conn:
+            inserted = await conn.fetch(
+                'INSERT INTO movie (title, "releaseDate") VALUES (?, ?) '
+                'RETURNING id', title, releaseDate)
+            await self.bump_versions(conn, 'movie')
+
+        return {
+            'success': True,
+            'id': inserted[0]['id']
+        }
+
+    async def patchMovie(self, token, request, movie_id):
+        body = request.json()
+        if body is None:
+            raise HTTPError(400)
+
+        values = patch_values(body)
+        versions = if_match_versions(
+            parse_etags(request.headers.get(b'if-match', b'').decode()))
+        if 'releaseDate' in values:
+            values['releaseDate'] = self.to_db_datetime(values['releaseDate'])
+
+        # One statement sets the columns and the version, like Movie.patch().
+        assignments = ''.join(f'"{name}" = ?, ' for name in values)
+        where = 'id = ?'
+        params = list(values.values()) + [movie_id]
+        if versions is not None:
+            where += ' AND version IN ({})'.format(
+                ', '.join('?' for version in versions) or 'NULL')
+            params += versions
+
+        async with self.transaction() as conn:
+            updated = await conn.fetch(
+                f'UPDATE movie SET {assignments}version = version + 1 '
+                f'WHERE {where} RETURNING id, title, "releaseDate", version',
+                *params)
+            if not updated:
+                exists = await conn.fetch(
+                    'SELECT id FROM movie WHERE id = ?', movie_id)
+                raise HTTPError(404 if versions is None or not exists
+                                else 412)
+            await self.bump_versions(conn, 'movie')
+
+        movie = updated[0]
+        request.response_headers.append(
+            (b'etag', f'"{movie["version"]}"'.encode()))
+        return {
+            'success': True,
+            'title': movie['title'],
+            'movie': format_movie(movie)
+        }
+
+    async def deleteActor(self, token, request, actor_id):
+        async with self.transaction() as conn:
+            unlinked = await conn.fetch(
+                'DELETE FROM movies_actors WHERE actor_id = ? '
+                'RETURNING movie_id', actor_id)
+            deleted = await conn.fetch(
+                'DELETE FROM actor WHERE id = ? RETURNING id', actor_id)
+            if not deleted:
+                raise HTTPError(404)
+            await self.bump_versions(
+                conn, 'actor', *(['movies_actors'] if unlinked else []))
+
+        return {
+            'success': True,
+            'actor_id': actor_id
+        }
+
+    # page() reads one page of a table ordered by id, with the same limit
+    # and cursor parameters as the WSGI app.
+    async def page(self, request, table, columns):
+        limit = parse_limit(request.args.get('limit'), self.config)
+
+        cursor = request.args.get('cursor')
+        after = decode_cursor(cursor) if cursor else 0
+
+        # One extra row tells whether there is a next page.
+        rows = await self.db.fetch(
+            f'SELECT {columns} FROM {table} WHERE id > ? '
+            f'ORDER BY id LIMIT ?',
+            after, limit + 1,
+            timeout=self.config['DB_READ_TIMEOUT_MS'] / 1000 or None)
+
+        if len(rows) == 0 and cursor is None:
+            raise HTTPError(404)
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1]['id'])
+
+        return rows, next_cursor
+
+    # transaction() opens a write transaction with the write timeout, the
+    # shared response cache is invalidated once it committed.
+    @asynccontextmanager
+    async def transaction(self):
+        tables = set()
+        async with self.db.transaction(
+                self.config['DB_WRITE_TIMEOUT_MS']) as conn:
+            conn.changed_tables = tables
+            yield conn
+
+        if tables and self.response_cache is not None:
+            loop = asyncio.get_event_loop()
+            await loop.run_in_executor(
+                None, self.response_cache.invalidate, tables)
+
+    # bump_versions() increments the table version counters in the same
+    # transaction, like models.bump_versions().
+    async def bump_versions(self, conn, *tables):
+        conn.changed_tables.update(tables)
+        placeholders = ', '.join('?' for table in tables)
+        await conn.fetch(
+            'UPDATE table_version SET version = version + 1 '
+            f'WHERE name IN ({placeholders})', *tables)
+
+    # to_db_datetime() converts a releaseDate from a request to a value the
+    # driver accepts, 422 if it isn't a date.
+    def to_db_datetime(self, value):
+        if value is None:
+            return None
+        if not isinstance(value, datetime.datetime):
+            try:
+                value = datetime.datetime.fromisoformat(value)
+            except (TypeError, ValueError):
+                raise HTTPError(422)
+        if self.db.dialect == 'sqlite':
+            # The format SQLAlchemy stores datetimes in on SQLite.
+            return value.strftime('%Y-%m-%d %H:%M:%S.%f')
+        return value
+
+
+class Request:
+    def __init__(self, scope, body):
+        self.args = {name: values[-1] for name, values in
+                     parse_qs(scope['query_string'].decode()).items()}
+        self.headers = dict(scope['headers'])
+        self.body = body
+        # Headers added to the response by the handler.
+        self.response_headers = []
+
+    # json() returns the decoded body, None if there is none, 400 if it is
+    # not valid JSON.
+    def json(self):
+        if not self.body:
+            return None
+        try:
+            return json.loads(self.body)
+        except ValueError:
+            raise HTTPError(400)
+
+
+async def read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+
+# format_movie() formats a movie row like Movie.format() and Flask's JSON
+# encoder, which writes datetimes as HTTP dates.
+def format_movie(row):
+    releaseDate = row['releaseDate']
+    if isinstance(releaseDate, str):
+        releaseDate = datetime.datetime.fromisoformat(releaseDate)
+    if releaseDate is not None:
+        releaseDate = http_date(releaseDate.utctimetuple())
+    return {
+        'id': row['id'],
+        'title': row['title'],
+        'releaseDate': releaseDate,
+        'version': row['version'],
+    }
+
+
+# error_body() is the body of the WSGI error handler for a status.
+def error_body(status):
+    return dumps({
+        'success': False,
+        'error': status,
+        'message': MESSAGES.get(status, 'Error.')
+    })
+
+
+# cors_headers() returns the headers flask_cors adds to the responses of the
+# WSGI app with its defaults: any origin, named back when the request has
+# one, and for preflight requests any method and the requested headers.
+def cors_headers(scope):
+    headers = dict(scope['headers'])
+    origin = headers.get(b'origin')
+    if origin is None:
+        return [(b'access-control-allow-origin', b'*')]
+
+    cors = [(b'access-control-allow-origin', origin)]
+    method = headers.get(b'access-control-request-method', b'').upper()
+    if scope['method'] == 'OPTIONS' and method in CORS_METHODS.split(b', '):
+        requested = headers.get(b'access-control-request-headers')
+        if requested:
+            cors.append((b'access-control-allow-headers', b', '.join(
+                sorted(name.strip() for name in requested.split(b',')))))
+        cors.append((b'access-control-allow-methods', CORS_METHODS))
+    return cors + [(b'vary', b'Origin')]
+
+
+# dumps() serializes like flask.jsonify: sorted keys, compact separators
+# and a trailing newline.
+def dumps(data):
+    return (json.dumps(data, sort_keys=True, separators=(',', ':')) +
+            '\n').encode()
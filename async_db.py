@@ -0,0 +1,113 @@
+import asyncio
+import re
+from contextlib import asynccontextmanager
+
+PLACEHOLDER = re.compile(r'\?')
+
+
+# AsyncDatabase runs SQL through an asyncio driver: asyncpg for postgresql://
+# urls and aiosqlite for sqlite:/// urls, meant for local runs. Statements
+# are written with '?' placeholders and rows are returned as dicts.
+class AsyncDatabase:
+    def __init__(self, url, min_size=1, max_size=10):
+        self.url = url
+        self.min_size = min_size
+        self.max_size = max_size
+        self.dialect = 'sqlite' if url.startswith('sqlite') else 'postgresql'
+        self._pool = None
+        self._sqlite = None
+        self._lock = None
+
+    # connect() opens the pool or the SQLite connection. The lifespan
+    # startup calls it, and so does the first statement for servers that
+    # don't send lifespan events.
+    async def connect(self):
+        if self._lock is None:
+            # SQLite has a single connection, statements take turns on it.
+            self._lock = asyncio.Lock()
+        if self._pool is not None or self._sqlite is not None:
+            return
+        async with self._lock:
+            if self._pool is None and self._sqlite is None:
+                await self._open()
+
+    async def _open(self):
+        if self.dialect == 'postgresql':
+            import asyncpg
+            dsn = self.url.replace('postgresql+psycopg2://', 'postgresql://')
+            self._pool = await asyncpg.create_pool(
+                dsn, min_size=self.min_size, max_size=self.max_size)
+        else:
+            import aiosqlite
+            path = self.url.split(':///', 1)[1]
+            # Autocommit, transaction() issues BEGIN and COMMIT itself.
+            self._sqlite = await aiosqlite.connect(path, isolation_level=None)
+
+    async def close(self):
+        if self._pool is not None:
+            await self._pool.close()
+            self._pool = None
+        if self._sqlite is not None:
+            await self._sqlite.close()
+            self._sqlite = None
+
+    # fetch() runs one statement outside of a transaction.
+    async def fetch(self, sql, *params, timeout=None):
+        await self.connect()
+        if self.dialect == 'postgresql':
+            async with self._pool.acquire() as conn:
+                return await PostgresConnection(conn).fetch(
+                    sql, *params, timeout=timeout)
+        async with self._lock:
+            return await SQLiteConnection(self._sqlite).fetch(sql, *params)
+
+    # transaction() yields a connection whose statements commit together,
+    # or roll back together if the block raises.
+    @asynccontextmanager
+    async def transaction(self, timeout_ms=0):
+        await self.connect()
+        if self.dialect == 'postgresql':
+            async with self._pool.acquire() as conn:
+                async with conn.transaction():
+                    if timeout_ms:
+                        await conn.execute(
+                            f'SET LOCAL statement_timeout = {timeout_ms:d}')
+                    yield PostgresConnection(conn)
+            return
+
+        async with self._lock:
+            await self._sqlite.execute('BEGIN')
+            try:
+                yield SQLiteConnection(self._sqlite)
+            except BaseException:
+                await self._sqlite.execute('ROLLBACK')
+                raise
+            await self._sqlite.execute('COMMIT')
+
+
+class PostgresConnection:
+    def __init__(self, conn):
+        self.conn = conn
+
+    async def fetch(self, sql, *params, timeout=None):
+        rows = await self.conn.fetch(self._numbered(sql), *params,
+                                     timeout=timeout)
+        return [dict(row) for row in rows]
+
+    # _numbered() rewrites '?' placeholders to asyncpg's $1, $2, ...
+    def _numbered(self, sql):
+        counter = iter(range(1, sql.count('?') + 1))
+        return PLACEHOLDER.sub(lambda match: f'${next(counter)}', sql)
+
+
+class SQLiteConnection:
+    def __init__(self, conn):
+        self.conn = conn
+
+    async def fetch(self, sql, *params, timeout=None):
+        async with self.conn.execute(sql, params) as cursor:
+            rows = await cursor.fetchall()
+            if cursor.description is None:
+                return []
+            columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row)) for row in rows]
@@ -1,14 +1,35 @@
-import json
-import os
-from flask import request, _request_ctx_stack
+from flask import current_app, g, request, _request_ctx_stack
 from functools import wraps
+import time
 from jose import jwt
-from urllib.request import urlopen
+from admission import check_rate_limit
+from jwks import JWKSStore
+from metrics import add_phase
+from token_cache import TokenCache
 
-# retrieves environment variables required for decoding tokens.
-AUTH0_DOMAIN = os.environ['AUTH0_DOMAIN']
-ALGORITHMS = os.environ['ALGORITHMS']
-API_AUDIENCE = os.environ['AUDIENCE']
+
+# setup_auth(app) creates the signing key store (see jwks.py) and the
+# verified token cache (see token_cache.py) of an application from its
+# config. Nothing is fetched until the first token is verified.
+def setup_auth(app):
+    app.extensions['jwks'] = create_key_store(app.config)
+    app.extensions['token_cache'] = create_token_cache(app.config)
+
+
+def create_key_store(config):
+    return JWKSStore(
+        url=config['JWKS_URL'],
+        pinned_file=config['JWKS_FILE'],
+        ttl=config['JWKS_TTL'],
+        min_refetch_interval=config['JWKS_MIN_REFETCH_INTERVAL']
+    )
+
+
+def create_token_cache(config):
+    return TokenCache(
+        max_size=config['TOKEN_CACHE_SIZE'],
+        ttl=config['TOKEN_CACHE_TTL']
+    )
 
 
 # A standardized way to communicate auth failure modes
@@ -19,15 +40,21 @@ class AuthError(Exception):
 
 
 def get_token_auth_header():
+    return parse_auth_header(request.headers.get('Authorization'))
+
+
+# parse_auth_header() returns the token of an Authorization header value,
+# shared by the WSGI and ASGI apps.
+def parse_auth_header(header):
     # Raises an AuthError if no header is present.
-    if 'Authorization' not in request.headers:
+    if header is None:
         raise AuthError({
             'code': 'authorization_header_missing',
             'description': 'Authorization header is expected.'
         }, 401)
 
-    # Gets authorization header from the request.
-    auth_header_parts = request.headers['Authorization'].split()
+    # Gets authorization header parts.
+    auth_header_parts = header.split()
 
     # Raises an AuthError if header is malformed.
     if auth_header_parts[0].lower() != 'bearer':
@@ -50,15 +77,19 @@ def get_token_auth_header():
     return auth_header_parts[1]
 
 
-def check_permissions(permission, payload):
+# check_permissions() accepts the precomputed permission set of a cached
+# token, otherwise the permissions are read from the payload.
+def check_permissions(permission, payload, permissions=None):
+    if permissions is None and 'permissions' in payload:
+        permissions = payload['permissions']
     # Raises an AuthError if permissions are not included in the payload.
-    if 'permissions' not in payload:
+    if permissions is None:
         raise AuthError({
             'code': 'invalid_claims',
             'description': 'Permissions not included in JWT.'
         }, 401)
     # Raises an AuthError if requested permission not in payload permissions.
-    if permission not in payload['permissions']:
+    if permission not in permissions:
         raise AuthError({
             'code': 'unauthorized',
             'description': 'Permission not found.'
@@ -67,37 +98,39 @@ def check_permissions(permission, payload):
 
 
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
-    unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
-
-    # Raises an AuthError if 'kid' is not in the header.
+    return decode_token(token,
+                        current_app.extensions['jwks'],
+                        current_app.config)
+
+
+# decode_token() verifies a token against the keys of a JWKSStore and the
+# AUTH0_DOMAIN, ALGORITHMS and API_AUDIENCE settings of config, shared by
+# the WSGI and ASGI apps.
+def decode_token(token, jwks, config):
+    # Raises an AuthError if the token can't be decoded or 'kid' is not in
+    # the header.
+    try:
+        unverified_header = jwt.get_unverified_header(token)
+    except jwt.JWTError:
+        unverified_header = {}
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
 
-    # Verifies the token using Auth0.
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    # Looks up the Auth0 signing key used for the token.
+    rsa_key = jwks.get_key(unverified_header['kid'])
+
     # Decodes the payload from the token.
-    if rsa_key:
+    if rsa_key is not None:
         try:
             payload = jwt.decode(
                 token,
                 rsa_key,
-                algorithms=ALGORITHMS,
-                audience=API_AUDIENCE,
-                issuer='https://' + AUTH0_DOMAIN + '/'
+                algorithms=config['ALGORITHMS'],
+                audience=config['API_AUDIENCE'],
+                issuer='https://' + config['AUTH0_DOMAIN'] + '/'
             )
 
             return payload
@@ -130,10 +163,22 @@ def requires_auth(permission=''):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
+            start = time.perf_counter()
             token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
-            return f(payload, *args, **kwargs)
+            add_phase('auth_header', start)
+
+            start = time.perf_counter()
+            token_cache = current_app.extensions['token_cache']
+            verified = token_cache.get(token)
+            if verified is None:
+                verified = token_cache.put(token, verify_decode_jwt(token))
+            add_phase('auth_verify', start)
+            # Subject of the request, see replicas.py.
+            g.subject = verified.payload.get('sub')
+            check_rate_limit(verified.payload)
+            check_permissions(permission, verified.payload,
+                              verified.permissions)
+            return f(verified.payload, *args, **kwargs)
 
         return wrapper
     return requires_auth_decorator
@@ -0,0 +1,89 @@
+import os
+import random
+import sqlite3
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from cast_graph import build_graph  # noqa: E402
+
+# Builds the cast graph of a synthetic catalog and measures co-star and
+# shortest path queries, then runs the same path queries as recursive SQL
+# over an in-memory SQLite copy of the links (up to 3 degrees, deeper ones
+# take too long to wait for).
+#
+#   python benchmarks/cast_graph.py [links] [queries]
+#
+# Movies have 4 actors each, picked with a skew so a few actors play in
+# many movies, as in a real catalog.
+LINKS = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+QUERIES = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+SQL_QUERIES = 5
+
+PATH_SQL = '''
+WITH RECURSIVE reach(actor_id, depth) AS (
+    SELECT ?, 0
+    UNION
+    SELECT l2.actor_id, reach.depth + 1 FROM reach
+    JOIN movies_actors l1 ON l1.actor_id = reach.actor_id
+    JOIN movies_actors l2 ON l2.movie_id = l1.movie_id
+    WHERE reach.depth < 3
+)
+SELECT min(depth) FROM reach WHERE actor_id = ?
+'''
+
+
+def catalog(rng):
+    movies = LINKS // 4
+    actors = LINKS // 4
+    links = set()
+    for movie_id in range(1, movies + 1):
+        while len(links) < movie_id * 4:
+            links.add((movie_id, 1 + int(actors * rng.random() ** 3)))
+    return sorted(links), actors
+
+
+def percentiles(seconds):
+    seconds = sorted(seconds)
+    return (seconds[len(seconds) // 2] * 1000,
+            seconds[int(len(seconds) * 0.99)] * 1000)
+
+
+def measure(query, pairs):
+    seconds = []
+    for pair in pairs:
+        start = time.perf_counter()
+        query(*pair)
+        seconds.append(time.perf_counter() - start)
+    return percentiles(seconds)
+
+
+if __name__ == '__main__':
+    rng = random.Random(1)
+    links, actors = catalog(rng)
+
+    start = time.perf_counter()
+    graph = build_graph(0, links)
+    build = time.perf_counter() - start
+    stats = graph.stats()
+    print(f"{stats['links']:,} links, {stats['movies']:,} movies, "
+          f"{stats['actors']:,} actors, built in {build:.2f} s")
+
+    ids = list(graph.actor_ids)
+    pairs = [(rng.choice(ids), rng.choice(ids)) for i in range(QUERIES)]
+    p50, p99 = measure(lambda a, b: graph.costars(a), pairs)
+    print(f'costars:            p50 {p50:8.3f} ms  p99 {p99:8.3f} ms')
+    p50, p99 = measure(graph.path, pairs)
+    print(f'path:               p50 {p50:8.3f} ms  p99 {p99:8.3f} ms')
+
+    conn = sqlite3.connect(':memory:')
+    conn.execute('CREATE TABLE movies_actors (movie_id INTEGER, '
+                 'actor_id INTEGER)')
+    conn.executemany('INSERT INTO movies_actors VALUES (?, ?)', links)
+    conn.execute('CREATE INDEX movie ON movies_actors (movie_id)')
+    conn.execute('CREATE INDEX actor ON movies_actors (actor_id)')
+    p50, p99 = measure(lambda a, b: conn.execute(PATH_SQL, (a, b)).fetchall(),
+                       pairs[:SQL_QUERIES])
+    print(f'recursive SQL (<=3): p50 {p50:8.3f} ms  max {p99:8.3f} ms '
+          f'({SQL_QUERIES} queries)')
@@ -0,0 +1,29 @@
+import json
+import sys
+
+# Compares two results files of load.py route by route:
+#
+#   python benchmarks/compare.py before.json after.json
+
+
+def change(old, new):
+    if not old:
+        return '     n/a'
+    return f'{(new - old) / old * 100:>+7.1f}%'
+
+
+if __name__ == '__main__':
+    with open(sys.argv[1]) as before, open(sys.argv[2]) as after:
+        old, new = json.load(before), json.load(after)
+
+    for results in (old, new):
+        print('{commit:.10} {database} size={size} profile={profile} '
+              'concurrency={concurrency} cpus={cpus}'.format(**results))
+
+    print(f'{"route":<30} {"rps":>17} {"p50 ms":>17} {"p99 ms":>17}')
+    routes = dict(old['routes'], total=old['total'])
+    for name, route in dict(new['routes'], total=new['total']).items():
+        base = routes.get(name, {})
+        print(f'{name:<30}' + ''.join(
+            f' {route[key]:>9.1f}{change(base.get(key), route[key])}'
+            for key in ('rps', 'p50_ms', 'p99_ms')))
@@ -0,0 +1,96 @@
+import datetime
+import os
+import random
+import sys
+import time
+from flask import Flask
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from compression import Compression  # noqa: E402
+from serialize import dumps, http_date  # noqa: E402
+
+# Measures the CPU time and bytes saved by each encoding and level on the
+# bodies the API serves: pages of movies and actors and an NDJSON export,
+# compressed chunk by chunk as streams are.
+#
+#   python benchmarks/compression.py [repeat]
+#
+# brotli and zstd are measured when their packages are installed.
+REPEAT = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+WORDS = ['Spirited', 'Away', 'Ponyo', 'Only', 'Yesterday', 'Princess',
+         'Mononoke', 'Castle', 'Sky', 'Wind', 'Rises', 'Kiki', 'Delivery',
+         'Service', 'Howl', 'Moving', 'Totoro', 'Porco', 'Rosso', 'Nausicaa']
+LEVELS = {'gzip': [1, 6, 9], 'deflate': [6], 'br': [1, 4, 6], 'zstd': [1, 3]}
+
+
+def movie(rng, i):
+    return {'id': i, 'title': ' '.join(rng.sample(WORDS, 2)),
+            'releaseDate': http_date(datetime.datetime(1950, 1, 1) +
+                                     datetime.timedelta(days=rng.randrange(
+                                         25000))),
+            'version': 1}
+
+
+def actor(rng, i):
+    return {'id': i, 'name': rng.choice(WORDS), 'age': rng.randrange(8, 90),
+            'gender': rng.choice(['Female', 'Male'])}
+
+
+def page(key, rows):
+    return (dumps({'success': True, key: rows, 'next_cursor': 'eyJpZCI6IDF9'})
+            + '\n').encode()
+
+
+def bodies(rng):
+    movies = [movie(rng, i) for i in range(1, 1001)]
+    actors = [actor(rng, i) for i in range(1, 101)]
+    return [
+        ('/movies?limit=20', [page('movies', movies[:20])]),
+        ('/movies (100)', [page('movies', movies[:100])]),
+        ('/actors (100)', [page('actors', actors)]),
+        ('/movies?limit=1000', [page('movies', movies)]),
+        # Exports write STREAM_CHUNK_SIZE rows per chunk.
+        ('ndjson export, 10 chunks', [
+            ''.join(dumps(row) + '\n' for row in movies[i:i + 100]).encode()
+            for i in range(0, 1000, 100)]),
+    ]
+
+
+def settings(encoding, level):
+    if encoding == 'br':
+        return Compression(brotli_quality=level)
+    if encoding == 'zstd':
+        return Compression(zstd_level=level)
+    return Compression(level=level)
+
+
+def measure(compression, encoding, chunks):
+    best = None
+    for i in range(REPEAT):
+        start = time.perf_counter()
+        if len(chunks) == 1:
+            size = len(compression.compress(encoding, chunks[0]))
+        else:
+            size = sum(len(data) for data in
+                       compression.compress_chunks(encoding, iter(chunks)))
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return size, best
+
+
+if __name__ == '__main__':
+    encodings = Compression().encodings
+    print(f'best of {REPEAT}, encodings: {", ".join(encodings)}')
+    with Flask(__name__).app_context():
+        payloads = bodies(random.Random(0))
+    for name, chunks in payloads:
+        size = sum(len(chunk) for chunk in chunks)
+        print(f'\n{name}: {size:,} bytes')
+        for encoding in encodings:
+            for level in LEVELS[encoding]:
+                compressed, seconds = measure(settings(encoding, level),
+                                              encoding, chunks)
+                print(f'  {encoding:>7} {level:>2}: {compressed:>8,} bytes '
+                      f'({compressed / size:6.1%})  {seconds * 1e6:>8.1f} us'
+                      f'  {size / seconds / 1e6:>6.1f} MB/s')
@@ -0,0 +1,26 @@
+import os
+import sys
+from load import parse_args, run
+
+# Compares single-row POST /movies with and without group commit (see
+# group_commit.py) at several GROUP_COMMIT_MAX_WAIT_MS: each setting gets a
+# fresh copy of the seeded database. Other options are passed on to
+# load.py, point --database at Postgres to include its commit latency.
+#
+#   python benchmarks/group_commit.py --concurrency 64 --duration 30
+SETTINGS = [
+    ('off', {'GROUP_COMMIT': '0'}),
+    ('wait 0 ms', {'GROUP_COMMIT': '1', 'GROUP_COMMIT_MAX_WAIT_MS': '0'}),
+    ('wait 2 ms', {'GROUP_COMMIT': '1', 'GROUP_COMMIT_MAX_WAIT_MS': '2'}),
+    ('wait 10 ms', {'GROUP_COMMIT': '1', 'GROUP_COMMIT_MAX_WAIT_MS': '10'}),
+]
+
+if __name__ == '__main__':
+    print('group commit  requests  errors      rps   p50 ms   p99 ms')
+    for name, environ in SETTINGS:
+        os.environ.update(environ)
+        options = parse_args(sys.argv[1:] + ['--routes', 'POST /movies'])
+        total = run(options)['total']
+        print(f'{name:<12} {total["requests"]:>9} {total["errors"]:>7} '
+              f'{total["rps"]:>8.1f} {total["p50_ms"]:>8.1f} '
+              f'{total["p99_ms"]:>8.1f}')
@@ -0,0 +1,117 @@
+import base64
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jose import jwt
+
+# Permissions of the roles, see README.md.
+ROLES = {
+    'EXECUTIVE_PRODUCER': ['view:content', 'add:movie', 'modify:movie',
+                           'delete:actor', 'add:actor'],
+    'CASTING_DIRECTOR': ['view:content', 'modify:movie', 'delete:actor'],
+    'CASTING_ASSISTANT': ['view:content'],
+}
+
+
+def b64(number):
+    data = number.to_bytes((number.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+# Issuer is an offline stand-in for Auth0: an RSA key pair kept in a
+# directory, its JWKS served on localhost and RS256 tokens with the claims
+# Auth0 issues.
+class Issuer:
+    def __init__(self, directory, domain='bench.local', audience='capstone',
+                 kid='bench'):
+        self.domain = domain
+        self.audience = audience
+        self.kid = kid
+        self.jwks_file = os.path.join(directory, 'jwks.json')
+        self.url = None
+
+        os.makedirs(directory, exist_ok=True)
+        key_file = os.path.join(directory, 'key.pem')
+        if not os.path.exists(key_file):
+            key = rsa.generate_private_key(public_exponent=65537,
+                                           key_size=2048)
+            with open(key_file, 'wb') as pem:
+                pem.write(key.private_bytes(
+                    serialization.Encoding.PEM,
+                    serialization.PrivateFormat.PKCS8,
+                    serialization.NoEncryption()))
+
+        with open(key_file, 'rb') as pem:
+            self.pem = pem.read()
+        public = serialization.load_pem_private_key(self.pem, None) \
+            .public_key().public_numbers()
+        self.jwks = {'keys': [{
+            'kty': 'RSA', 'kid': kid, 'use': 'sig', 'alg': 'RS256',
+            'n': b64(public.n), 'e': b64(public.e),
+        }]}
+        with open(self.jwks_file, 'w') as jwks:
+            json.dump(self.jwks, jwks)
+
+    # serve() serves the JWKS over HTTP from a daemon thread, so the app
+    # fetches its keys like it does from Auth0.
+    def serve(self):
+        body = json.dumps(self.jwks).encode()
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Cache-Control', 'max-age=600')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.url = 'http://127.0.0.1:%d/.well-known/jwks.json' % \
+            server.server_address[1]
+        return self.url
+
+    # environ() returns the settings pointing the app at this issuer, the
+    # served JWKS if serve() was called and the JWKS file otherwise.
+    def environ(self):
+        return {
+            'AUTH0_DOMAIN': self.domain,
+            'ALGORITHMS': 'RS256',
+            'AUDIENCE': self.audience,
+            'JWKS_URL': self.url or '',
+            'JWKS_FILE': self.jwks_file,
+        }
+
+    def token(self, permissions, sub='bench|user', lifetime=24 * 3600):
+        now = int(time.time())
+        claims = {
+            'iss': f'https://{self.domain}/',
+            'sub': sub,
+            'aud': self.audience,
+            'iat': now,
+            'exp': now + lifetime,
+            'scope': '',
+            'permissions': list(permissions),
+        }
+        return jwt.encode(claims, self.pem, algorithm='RS256',
+                          headers={'kid': self.kid})
+
+
+# Prints the settings and role tokens for running test_app.py and
+# test_rbac.py without Auth0:
+#
+#   eval "$(python benchmarks/issuer.py)"
+if __name__ == '__main__':
+    issuer = Issuer(os.path.join(os.path.dirname(__file__), 'data'))
+    for name, value in issuer.environ().items():
+        print(f"export {name}='{value}'")
+    for role, permissions in ROLES.items():
+        print(f"export {role}_TOKEN='{issuer.token(permissions)}'")
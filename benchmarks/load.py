@@ -0,0 +1,342 @@
+import argparse
+import http.client
+import itertools
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+from issuer import Issuer, ROLES
+from seed import ROOT, WORDS, parse_size, seed
+from app import create_app, encode_cursor
+
+# End-to-end load test: seeds a database, starts the app under gunicorn
+# with tokens from a local issuer and drives every endpoint from
+# concurrent keep-alive clients, then writes throughput and latency
+# percentiles per route to a JSON file.
+#
+#   python benchmarks/load.py --size 100k --duration 60
+#   python benchmarks/load.py --database postgresql://localhost/bench
+#   python benchmarks/compare.py old.json new.json
+DATA = os.path.join(ROOT, 'benchmarks', 'data')
+RESULTS = os.path.join(ROOT, 'benchmarks', 'results')
+# Whole-table exports are left out of the mix above this many rows.
+EXPORT_MAX_ROWS = 100000
+
+
+# routes() returns the weighted request mix: (name, weight, build) where
+# build(rng) returns the method, path and JSON body of one request.
+def routes(size, reads_only=False):
+    def cursor(rng):
+        return encode_cursor(rng.randrange(size))
+
+    def page(path):
+        return lambda rng: ('GET', f'{path}&cursor={cursor(rng)}', None)
+
+    # The DELETEs below remove actors from id 1 up, the graph reads pick
+    # from the upper half.
+    def actor(rng):
+        return rng.randrange(size // 2 + 1, size + 1)
+
+    def search(path):
+        return lambda rng: ('GET', f'{path}?q={rng.choice(WORDS).lower()}',
+                            None)
+
+    mix = [
+        ('GET /movies', 20, page('/movies?limit=20')),
+        ('GET /actors', 15, page('/actors?limit=20')),
+        ('GET /movies?include=actors', 5,
+         page('/movies?limit=20&include=actors')),
+        ('GET /actors?include=movies', 5,
+         page('/actors?limit=20&include=movies')),
+        ('GET /movies/search', 5, search('/movies/search')),
+        ('GET /actors/search', 5, search('/actors/search')),
+        ('GET /actors/<id>/costars', 3, lambda rng: (
+            'GET', f'/actors/{actor(rng)}/costars?limit=20', None)),
+        ('GET /actors/<id>/path/<id>', 2, lambda rng: (
+            'GET', f'/actors/{actor(rng)}/path/{actor(rng)}', None)),
+    ]
+    if size <= EXPORT_MAX_ROWS:
+        mix.append(('GET /movies?stream=ndjson', 1,
+                    lambda rng: ('GET', '/movies?stream=ndjson', None)))
+    if reads_only:
+        return mix
+
+    # Every DELETE removes a different seeded actor.
+    actor_ids = itertools.count(1)
+
+    def movie(rng):
+        # String release dates are only accepted on Postgres, the single
+        # movie endpoint is driven without one.
+        return {'title': ' '.join(rng.sample(WORDS, 2))}
+
+    def batch_movie(rng):
+        return dict(movie(rng), releaseDate='2001-07-20 00:00:00')
+
+    def batch_actor(rng):
+        return {'name': rng.choice(WORDS), 'age': rng.randrange(8, 90),
+                'gender': 'Female'}
+
+    return mix + [
+        ('POST /movies', 3, lambda rng: ('POST', '/movies', movie(rng))),
+        ('POST /movies/batch', 1, lambda rng: (
+            'POST', '/movies/batch', [batch_movie(rng) for i in range(20)])),
+        ('POST /actors/batch', 1, lambda rng: (
+            'POST', '/actors/batch', [batch_actor(rng) for i in range(20)])),
+        ('PATCH /movies/<id>', 3, lambda rng: (
+            'PATCH', f'/movies/{rng.randrange(1, size + 1)}', movie(rng))),
+        ('DELETE /actors/<id>', 2, lambda rng: (
+            'DELETE', f'/actors/{next(actor_ids)}', None)),
+        ('DELETE /actors', 1, lambda rng: (
+            'DELETE', '/actors',
+            {'ids': [next(actor_ids) for i in range(20)]})),
+    ]
+
+
+# prepare_database() returns the url of a seeded database. SQLite runs get
+# a fresh copy of a seeded template, so every run starts from the same
+# rows; Postgres databases are seeded once and then used as they are.
+def prepare_database(options, size):
+    if options.database:
+        seed(create_app({'SQLALCHEMY_DATABASE_URI': options.database}), size)
+        return options.database
+
+    # The template is migrated again, seeding is skipped once it has rows.
+    template = os.path.join(DATA, f'bench-{size}.sqlite')
+    if not os.path.exists(template):
+        print(f'Seeding {size} movies and actors...', file=sys.stderr)
+    seed(create_app({'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + template}),
+         size)
+    run = os.path.join(DATA, 'run.sqlite')
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(run + suffix):
+            os.remove(run + suffix)
+    shutil.copyfile(template, run)
+    return 'sqlite:///' + run
+
+
+# free_port() returns a port nothing listens on, a server already bound to
+# the port would otherwise answer the benchmark.
+def free_port(port=0):
+    with socket.socket() as sock:
+        try:
+            sock.bind(('127.0.0.1', port))
+        except OSError:
+            raise RuntimeError(f'Port {port} is already in use.')
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, deadline):
+    while time.time() < deadline:
+        try:
+            http.client.HTTPConnection('127.0.0.1', port, timeout=1) \
+                .request('GET', '/')
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('The server did not start.')
+
+
+# start_server() starts gunicorn with gunicorn.conf.py, its output goes to
+# benchmarks/data/server.log.
+def start_server(env, port):
+    with open(os.path.join(DATA, 'server.log'), 'w') as log:
+        server = subprocess.Popen(['gunicorn', 'app:create_app()'],
+                                  cwd=ROOT, env=env,
+                                  stdout=log, stderr=subprocess.STDOUT)
+    try:
+        wait_for_port(port, time.time() + 60)
+    except RuntimeError:
+        server.kill()
+        raise
+    return server
+
+
+# client() sends requests until the deadline, recording (route, seconds,
+# ok) for every response received after `record_from`. Like a well behaved
+# client it waits for the Retry-After of a refused request (503, 429)
+# before sending the next one.
+def client(port, token, mix, rng, record_from, deadline, samples):
+    headers = {'Authorization': f'Bearer {token}',
+               'Content-Type': 'application/json'}
+    names = [name for name, weight, build in mix]
+    weights = [weight for name, weight, build in mix]
+    builds = dict((name, build) for name, weight, build in mix)
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+
+    while True:
+        start = time.perf_counter()
+        if start >= deadline:
+            break
+        name = rng.choices(names, weights)[0]
+        method, path, body = builds[name](rng)
+        if body is not None:
+            body = json.dumps(body)
+        ok = False
+        retry_after = None
+        # Workers recycled after max_requests close their idle keep-alive
+        # connections, the request is sent again on a new one.
+        for attempt in range(2):
+            try:
+                conn.request(method, path, headers=headers, body=body)
+                response = conn.getresponse()
+                response.read()
+                ok = response.status < 400
+                retry_after = response.getheader('Retry-After')
+                break
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                conn = http.client.HTTPConnection('127.0.0.1', port,
+                                                  timeout=60)
+        end = time.perf_counter()
+        if start >= record_from:
+            samples.append((name, end - start, ok))
+        if retry_after is not None and retry_after.isdigit():
+            time.sleep(max(min(int(retry_after), deadline - end), 0))
+    conn.close()
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def summarize(latencies, errors, duration):
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'rps': round(len(latencies) / duration, 2),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 3),
+        'max_ms': round(latencies[-1] * 1000, 3),
+    }
+
+
+def git(*args):
+    try:
+        return subprocess.run(['git'] + list(args), cwd=ROOT,
+                              capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ''
+
+
+# run() runs one load test and returns its results.
+def run(options):
+    size = parse_size(options.size)
+    port = free_port(options.port)
+    issuer = Issuer(DATA)
+    issuer.serve()
+    os.environ.update(issuer.environ())
+    os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+    database = prepare_database(options, size)
+    cache = os.path.join(DATA, 'run-cache.sqlite')
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(cache + suffix):
+            os.remove(cache + suffix)
+
+    env = dict(os.environ, DATABASE_URL=database, PORT=str(port),
+               GUNICORN_PROFILE=options.profile, RESPONSE_CACHE_PATH=cache)
+    if options.workers:
+        env['WEB_CONCURRENCY'] = str(options.workers)
+
+    mix = routes(size, options.reads_only)
+    if options.routes:
+        names = options.routes.split(',')
+        mix = [route for route in mix if route[0] in names]
+    server = start_server(env, port)
+    try:
+        started = time.perf_counter()
+        record_from = started + options.warmup
+        deadline = record_from + options.duration
+        samples = [[] for i in range(options.concurrency)]
+        clients = [threading.Thread(target=client, args=(
+            port,
+            issuer.token(ROLES['EXECUTIVE_PRODUCER'], sub=f'bench|{i}'),
+            mix, random.Random(i), record_from, deadline, samples[i]))
+            for i in range(options.concurrency)]
+        for thread in clients:
+            thread.start()
+        for thread in clients:
+            thread.join()
+    finally:
+        server.terminate()
+        server.wait()
+
+    by_route = {}
+    for name, seconds, ok in itertools.chain.from_iterable(samples):
+        latencies, errors = by_route.setdefault(name, ([], [0]))
+        latencies.append(seconds)
+        errors[0] += not ok
+
+    return {
+        'commit': git('rev-parse', 'HEAD'),
+        'dirty': bool(git('status', '--porcelain', '--untracked-files=no')),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'database': database.split(':', 1)[0],
+        'size': size,
+        'profile': options.profile,
+        'workers': options.workers,
+        'concurrency': options.concurrency,
+        'duration': options.duration,
+        'cpus': os.cpu_count(),
+        'python': platform.python_version(),
+        'total': summarize(
+            [seconds for route in samples for name, seconds, ok in route],
+            sum(errors[0] for latencies, errors in by_route.values()),
+            options.duration),
+        'routes': dict(
+            (name, summarize(latencies, errors[0], options.duration))
+            for name, (latencies, errors) in sorted(by_route.items())),
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', default='1k',
+                        help='movies and actors: 1k, 100k, 1m or a number')
+    parser.add_argument('--database',
+                        help='database url, a seeded SQLite copy otherwise')
+    parser.add_argument('--profile', default='gthread',
+                        help='GUNICORN_PROFILE of the server')
+    parser.add_argument('--workers', type=int,
+                        help='worker processes, see gunicorn.conf.py')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--warmup', type=float, default=5)
+    parser.add_argument('--port', type=int, default=0,
+                        help='server port, a free one otherwise')
+    parser.add_argument('--reads-only', action='store_true')
+    parser.add_argument('--routes',
+                        help='comma separated routes of the mix to run, '
+                             'e.g. "POST /movies"')
+    parser.add_argument('--output',
+                        help='results file, benchmarks/results/ otherwise')
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    options = parse_args()
+    results = run(options)
+
+    output = options.output or os.path.join(RESULTS, '{}-{}-{}.json'.format(
+        results['commit'][:10] or 'nocommit', options.size, options.profile))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as out:
+        json.dump(results, out, indent=2, sort_keys=True)
+
+    print(f'{"route":<30} {"requests":>8} {"errors":>6} {"rps":>9} '
+          f'{"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8}')
+    for name, route in list(results['routes'].items()) + \
+            [('total', results['total'])]:
+        print(f'{name:<30} {route["requests"]:>8} {route["errors"]:>6} '
+              f'{route["rps"]:>9.1f} {route["p50_ms"]:>8.1f} '
+              f'{route["p95_ms"]:>8.1f} {route["p99_ms"]:>8.1f}')
+    print(f'Results written to {output}')
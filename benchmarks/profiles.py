@@ -0,0 +1,19 @@
+import sys
+from load import parse_args, run
+
+# Compares the gunicorn profiles of gunicorn.conf.py on the read mix of
+# load.py: each profile is started in turn against the same seeded
+# database. Other options are passed on to load.py.
+#
+#   python benchmarks/profiles.py --size 100k --concurrency 32
+PROFILES = ['sync', 'gthread', 'gevent']
+
+if __name__ == '__main__':
+    print('profile   requests  errors      rps   p50 ms   p99 ms')
+    for profile in PROFILES:
+        options = parse_args(sys.argv[1:] + ['--profile', profile,
+                                             '--reads-only'])
+        total = run(options)['total']
+        print(f'{profile:<9} {total["requests"]:>8} {total["errors"]:>7} '
+              f'{total["rps"]:>8.1f} {total["p50_ms"]:>8.1f} '
+              f'{total["p99_ms"]:>8.1f}')
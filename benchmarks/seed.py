@@ -0,0 +1,90 @@
+import datetime
+import os
+import random
+import sys
+from flask_migrate import Migrate, upgrade
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from models import Actor, Movie, MoviesActors, bump_versions, db  # noqa
+
+SIZES = {'1k': 1000, '100k': 100000, '1m': 1000000}
+CHUNK_SIZE = 10000
+GENDERS = ('Female', 'Male')
+WORDS = ('Spirited', 'Away', 'Castle', 'Sky', 'Whisper', 'Heart', 'Wind',
+         'Rises', 'Porco', 'Rosso', 'Night', 'Sea', 'Garden', 'Moving',
+         'Princess', 'Valley', 'Kiki', 'Delivery', 'Service', 'Ponyo')
+
+
+def parse_size(size):
+    return SIZES.get(size.lower()) or int(size)
+
+
+def chunks(rows):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == CHUNK_SIZE:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+# seed() brings the database of an app up to date with the migrations and
+# fills it with `size` movies and actors, each movie with `cast` actors.
+# Tables that already hold rows are left alone, so a seeded database is
+# reused between runs. The rows are the same for the same seed.
+def seed(app, size, cast=3, seed=0):
+    Migrate(app, db)
+    with app.app_context():
+        upgrade(directory=os.path.join(ROOT, 'migrations'))
+        if Movie.query.first() is not None:
+            return False
+
+        rng = random.Random(seed)
+        start = datetime.datetime(1950, 1, 1)
+
+        def movies():
+            for i in range(1, size + 1):
+                yield {
+                    'id': i,
+                    'title': ' '.join(rng.sample(WORDS, 3)) + f' {i}',
+                    'releaseDate': start + datetime.timedelta(
+                        days=rng.randrange(26000)),
+                }
+
+        def actors():
+            for i in range(1, size + 1):
+                yield {
+                    'id': i,
+                    'name': f'{rng.choice(WORDS)} Actor {i}',
+                    'age': rng.randrange(8, 90),
+                    'gender': rng.choice(GENDERS),
+                }
+
+        def links():
+            link_id = 0
+            for movie_id in range(1, size + 1):
+                for actor_id in rng.sample(range(1, size + 1),
+                                           min(cast, size)):
+                    link_id += 1
+                    yield {'id': link_id, 'movie_id': movie_id,
+                           'actor_id': actor_id}
+
+        for model, rows in ((Movie, movies()), (Actor, actors()),
+                            (MoviesActors, links())):
+            for chunk in chunks(rows):
+                db.session.execute(model.__table__.insert(), chunk)
+
+        # Explicit ids leave Postgres sequences behind.
+        if db.engine.dialect.name == 'postgresql':
+            for table in ('movie', 'actor', 'movies_actors'):
+                db.session.execute(
+                    f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                    f"(SELECT max(id) FROM {table}))")
+
+        bump_versions('movie', 'actor', 'movies_actors')
+        db.session.commit()
+        return True
@@ -0,0 +1,67 @@
+import datetime
+import os
+import sys
+import time
+from flask import Flask, jsonify
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import format  # noqa: E402
+from models import Movie, db, setup_db  # noqa: E402
+from serialize import columns, format_rows, json_response  # noqa: E402
+
+# Measures the rows per second of a page of movies read as ORM objects and
+# serialized with jsonify() against the column tuple path of serialize.py,
+# on an in-memory SQLite database.
+#
+#   python benchmarks/serialization.py [rows] [repeat]
+ROWS = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+REPEAT = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+
+def orm_page():
+    movies = Movie.query.order_by(Movie.id).limit(ROWS).all()
+    return jsonify({'success': True, 'movies': format(movies),
+                    'next_cursor': None}).get_data()
+
+
+def tuple_page():
+    rows = db.session.query(*columns(Movie)) \
+        .order_by(Movie.id).limit(ROWS).all()
+    return json_response({'success': True,
+                          'movies': format_rows(Movie, rows),
+                          'next_cursor': None}).get_data()
+
+
+def measure(page):
+    best = None
+    for i in range(REPEAT):
+        start = time.perf_counter()
+        page()
+        elapsed = time.perf_counter() - start
+        # Objects must not outlive a page, as in a request.
+        db.session.remove()
+        best = elapsed if best is None else min(best, elapsed)
+    return ROWS / best
+
+
+if __name__ == '__main__':
+    app = Flask(__name__)
+    setup_db(app, 'sqlite://')
+    with app.test_request_context():
+        db.create_all()
+        db.session.bulk_insert_mappings(Movie, [
+            {'title': f'Movie {i}',
+             'releaseDate': datetime.datetime(2000, 1, 1) +
+             datetime.timedelta(days=i)}
+            for i in range(ROWS)])
+        db.session.commit()
+
+        assert orm_page() == tuple_page()
+
+        orm = measure(orm_page)
+        tuples = measure(tuple_page)
+        print(f'{ROWS} rows per page, best of {REPEAT}')
+        print(f'ORM objects + jsonify: {orm:>12,.0f} rows/s')
+        print(f'column tuples:         {tuples:>12,.0f} rows/s '
+              f'({tuples / orm:.1f}x)')
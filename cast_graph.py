@@ -0,0 +1,318 @@
+import logging
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from itertools import accumulate
+from flask import current_app
+from sqlalchemy import select
+from models import MoviesActors, db, get_versions
+
+logger = logging.getLogger(__name__)
+
+
+class BuildTimeout(Exception):
+    pass
+
+
+# CastGraph is the bipartite graph of movies and actors held in flat int
+# arrays, compressed sparse rows in both directions:
+# - the cast of the movie at index m is
+#   movie_actors[movie_offsets[m]:movie_offsets[m + 1]], actor indexes;
+# - the movies of the actor at index a are
+#   actor_movies[actor_offsets[a]:actor_offsets[a + 1]], movie indexes.
+# movie_ids and actor_ids map the indexes back to ids, actor_ids is sorted
+# and searched with bisect. A link costs 8 bytes and there is no object per
+# node or edge, so a million links take a few megabytes that gunicorn
+# workers share with the master copy-on-write.
+#
+# Only actors and movies with at least one link are in the graph. version
+# is the movies_actors table version the links were read at.
+class CastGraph:
+    def __init__(self, version, movie_ids, movie_offsets, movie_actors,
+                 actor_ids, actor_offsets, actor_movies):
+        self.version = version
+        self.movie_ids = movie_ids
+        self.movie_offsets = movie_offsets
+        self.movie_actors = movie_actors
+        self.actor_ids = actor_ids
+        self.actor_offsets = actor_offsets
+        self.actor_movies = actor_movies
+
+    def actor_index(self, actor_id):
+        i = bisect_left(self.actor_ids, actor_id)
+        if i < len(self.actor_ids) and self.actor_ids[i] == actor_id:
+            return i
+        return None
+
+    # costars() returns the (actor id, shared movies) of everyone who played
+    # in a movie with the actor, most shared movies first, then by id.
+    def costars(self, actor_id):
+        a = self.actor_index(actor_id)
+        if a is None:
+            return []
+
+        movie_offsets, movie_actors = self.movie_offsets, self.movie_actors
+        shared = {}
+        for m in self.actor_movies[self.actor_offsets[a]:
+                                   self.actor_offsets[a + 1]]:
+            for b in movie_actors[movie_offsets[m]:movie_offsets[m + 1]]:
+                shared[b] = shared.get(b, 0) + 1
+        shared.pop(a, None)
+
+        actor_ids = self.actor_ids
+        return sorted(((actor_ids[b], count) for b, count in shared.items()),
+                      key=lambda costar: (-costar[1], costar[0]))
+
+    # path() returns a shortest chain from one actor to another as
+    # ([actor ids], [movie ids]), the movie at i links actors i and i + 1.
+    # Returns None if the actors are not connected within max_degrees
+    # movies. The search runs from both ends at once and always grows the
+    # smaller frontier, a movie's cast is scanned at most once per side.
+    def path(self, source_id, target_id, max_degrees=6):
+        source = self.actor_index(source_id)
+        target = self.actor_index(target_id)
+        if source_id == target_id:
+            return [source_id], []
+        if source is None or target is None:
+            return None
+
+        # Per side: actor index -> (previous actor index, movie index).
+        parents = ({source: None}, {target: None})
+        frontiers = ([source], [target])
+        scanned = (set(), set())
+        degrees = 0
+
+        while frontiers[0] and frontiers[1] and degrees < max_degrees:
+            side = 0 if len(frontiers[0]) <= len(frontiers[1]) else 1
+            seen, other = parents[side], parents[1 - side]
+            next_frontier = []
+            meeting = None
+
+            for a in frontiers[side]:
+                for m in self.actor_movies[self.actor_offsets[a]:
+                                           self.actor_offsets[a + 1]]:
+                    if m in scanned[side]:
+                        continue
+                    scanned[side].add(m)
+                    for b in self.movie_actors[self.movie_offsets[m]:
+                                               self.movie_offsets[m + 1]]:
+                        if b in seen:
+                            continue
+                        seen[b] = (a, m)
+                        if b in other:
+                            meeting = b
+                            break
+                        next_frontier.append(b)
+                    if meeting is not None:
+                        break
+                if meeting is not None:
+                    break
+
+            if meeting is not None:
+                return self._chain(parents, meeting)
+            frontiers = ((next_frontier, frontiers[1]) if side == 0
+                         else (frontiers[0], next_frontier))
+            degrees += 1
+
+        return None
+
+    def _chain(self, parents, meeting):
+        actors, movies = [meeting], []
+        step = parents[0][meeting]
+        while step is not None:
+            actors.insert(0, step[0])
+            movies.insert(0, step[1])
+            step = parents[0][step[0]]
+        step = parents[1][meeting]
+        while step is not None:
+            actors.append(step[0])
+            movies.append(step[1])
+            step = parents[1][step[0]]
+        return ([self.actor_ids[a] for a in actors],
+                [self.movie_ids[m] for m in movies])
+
+    def stats(self):
+        return {
+            'version': self.version,
+            'movies': len(self.movie_ids),
+            'actors': len(self.actor_ids),
+            'links': len(self.movie_actors),
+        }
+
+
+# build_graph() builds a CastGraph from (movie_id, actor_id) links ordered
+# by movie_id, without duplicates.
+def build_graph(version, links):
+    movie_ids = array('q')
+    movie_offsets = array('i')
+    link_actor_ids = array('q')
+
+    last = None
+    for movie_id, actor_id in links:
+        if movie_id != last:
+            movie_ids.append(movie_id)
+            movie_offsets.append(len(link_actor_ids))
+            last = movie_id
+        link_actor_ids.append(actor_id)
+    movie_offsets.append(len(link_actor_ids))
+
+    actor_ids = array('q', sorted(set(link_actor_ids)))
+    index = dict(zip(actor_ids, range(len(actor_ids))))
+    movie_actors = array('i', [index[a] for a in link_actor_ids])
+    del index, link_actor_ids
+
+    # The reverse direction by counting sort: degrees, offsets, then each
+    # link is placed at its actor's next free slot.
+    degrees = array('i', bytes(4 * len(actor_ids)))
+    for a in movie_actors:
+        degrees[a] += 1
+    actor_offsets = array('i', [0])
+    actor_offsets.extend(accumulate(degrees))
+    free = array('i', actor_offsets)
+    actor_movies = array('i', bytes(4 * len(movie_actors)))
+    for m in range(len(movie_ids)):
+        for a in movie_actors[movie_offsets[m]:movie_offsets[m + 1]]:
+            actor_movies[free[a]] = m
+            free[a] += 1
+
+    return CastGraph(version, movie_ids, movie_offsets, movie_actors,
+                     actor_ids, actor_offsets, actor_movies)
+
+
+# CastGraphIndex keeps the CastGraph of a worker in step with the
+# movies_actors table. Every query reads the table version, one primary key
+# lookup; when a write bumped it, in any worker, the graph is rebuilt from
+# the table in a background thread while queries keep being answered from
+# the previous graph. Answers lag writes to the links by a rebuild, a few
+# seconds for a million links.
+#
+# Only the first query, with no graph to answer from, waits for a build:
+# up to build_seconds, then it fails and the build goes on for the next
+# queries. A failed build is retried build_seconds later at the earliest.
+class CastGraphIndex:
+    def __init__(self, build_seconds=20, chunk_size=10000):
+        self.build_seconds = build_seconds
+        self.chunk_size = chunk_size
+        self._graph = None
+        self._thread = None
+        self._retry_at = 0
+        self._lock = threading.Lock()
+        self._stats = {
+            'builds': 0,
+            'build_failures': 0,
+            'stale_queries': 0,
+            'timeouts': 0,
+            'build_seconds': 0,
+        }
+
+    # graph() returns the latest graph built, and starts a rebuild if the
+    # links changed since version, the current movies_actors version by
+    # default. Raises BuildTimeout if there is none yet.
+    def graph(self, version=None):
+        if version is None:
+            version = get_versions('movies_actors')[0]
+        graph = self._graph
+        if graph is not None and graph.version >= version:
+            return graph
+
+        thread = self.rebuild()
+        if graph is not None:
+            self._count('stale_queries')
+            return graph
+
+        if thread is not None:
+            thread.join(self.build_seconds)
+        graph = self._graph
+        if graph is None:
+            self._count('timeouts')
+            raise BuildTimeout()
+        return graph
+
+    # rebuild() starts a build in a background thread unless one is running
+    # or the last one failed less than build_seconds ago. Returns the
+    # running thread, None if there is none.
+    def rebuild(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return self._thread
+            if time.monotonic() < self._retry_at:
+                return None
+            self._thread = threading.Thread(
+                target=self._rebuild,
+                args=(current_app._get_current_object(),),
+                name='cast-graph', daemon=True)
+            self._thread.start()
+            return self._thread
+
+    def _rebuild(self, app):
+        with app.app_context():
+            try:
+                self._graph = self.build()
+            except Exception:
+                logger.exception('Could not build the cast graph.')
+                with self._lock:
+                    self._stats['build_failures'] += 1
+                    self._retry_at = time.monotonic() + self.build_seconds
+            finally:
+                db.session.remove()
+
+    # build() reads the links from the database and builds their graph. The
+    # version is read first: links written in between are then labelled
+    # with an older version and only cause one more rebuild.
+    def build(self):
+        start = time.monotonic()
+        version = get_versions('movies_actors')[0]
+        links = MoviesActors.__table__.c
+        result = db.session.execute(
+            select([links.movie_id, links.actor_id]).distinct()
+            .where(links.movie_id.isnot(None))
+            .where(links.actor_id.isnot(None))
+            .order_by(links.movie_id, links.actor_id)
+            .execution_options(stream_results=True))
+
+        def rows():
+            while True:
+                chunk = result.fetchmany(self.chunk_size)
+                if not chunk:
+                    return
+                yield from chunk
+
+        try:
+            graph = build_graph(version, rows())
+        finally:
+            result.close()
+
+        seconds = time.monotonic() - start
+        with self._lock:
+            self._stats['builds'] += 1
+            self._stats['build_seconds'] = seconds
+        logger.info('Cast graph of %d links built in %.3f seconds.',
+                    len(graph.movie_actors), seconds)
+        return graph
+
+    # warm() builds the graph ahead of the first query, waiting up to
+    # build_seconds. gunicorn calls it in the master, the workers inherit
+    # the graph. Errors are logged, the workers then build on their first
+    # query.
+    def warm(self):
+        try:
+            self.graph()
+        except BuildTimeout:
+            logger.warning('Cast graph not built after %.1f seconds.',
+                           self.build_seconds)
+        except Exception:
+            logger.exception('Could not build the cast graph.')
+        finally:
+            db.session.remove()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        if self._graph is not None:
+            stats.update(self._graph.stats())
+        return stats
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
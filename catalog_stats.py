@@ -0,0 +1,99 @@
+from sqlalchemy import func
+from models import CatalogStat, Movie, Actor, MoviesActors, bump_versions, db
+
+# Counts kept in catalog_stats, by bucket:
+# - movies_by_year: release year, 'unknown' without a release date.
+# - actors_by_gender: gender, 'unknown' without one.
+# - actors_by_age: age decade such as '20-29', 'unknown' without an age.
+# - cast_size: number of actors of a movie.
+KINDS = ('movies_by_year', 'actors_by_gender', 'actors_by_age', 'cast_size')
+UNKNOWN = 'unknown'
+
+
+# read_stats() returns the stored counts as {kind: {bucket: count}}, one
+# primary key range read whatever the size of the catalog.
+def read_stats():
+    stats = dict((kind, {}) for kind in KINDS)
+    rows = db.session.query(CatalogStat.kind, CatalogStat.bucket,
+                            CatalogStat.count).filter(CatalogStat.count != 0)
+    for kind, bucket, count in rows:
+        stats.setdefault(kind, {})[bucket] = count
+    return stats
+
+
+# summary() adds the totals of movies, actors and links to the counts.
+def summary(stats):
+    return dict(stats,
+                movies=sum(stats['movies_by_year'].values()),
+                actors=sum(stats['actors_by_gender'].values()),
+                links=sum(int(size) * count for size, count
+                          in stats['cast_size'].items()))
+
+
+def age_bucket(age):
+    if age is None:
+        return UNKNOWN
+    decade = int(age) // 10 * 10
+    return f'{decade}-{decade + 9}'
+
+
+# compute_stats() counts from the live tables, scanning all of them.
+def compute_stats():
+    stats = dict((kind, {}) for kind in KINDS)
+
+    year = func.extract('year', Movie.releaseDate).label('year')
+    for value, count in db.session.query(year, func.count()) \
+            .group_by(year):
+        bucket = UNKNOWN if value is None else str(int(value))
+        stats['movies_by_year'][bucket] = count
+
+    for gender, count in db.session.query(Actor.gender, func.count()) \
+            .group_by(Actor.gender):
+        stats['actors_by_gender'][gender or UNKNOWN] = count
+
+    ages = stats['actors_by_age']
+    for age, count in db.session.query(Actor.age, func.count()) \
+            .group_by(Actor.age):
+        ages[age_bucket(age)] = ages.get(age_bucket(age), 0) + count
+
+    sizes = db.session.query(
+        func.count(MoviesActors.movie_id).label('size')) \
+        .select_from(Movie) \
+        .outerjoin(MoviesActors, MoviesActors.movie_id == Movie.id) \
+        .group_by(Movie.id).subquery()
+    for size, count in db.session.query(sizes.c.size, func.count()) \
+            .group_by(sizes.c.size):
+        stats['cast_size'][str(size)] = count
+
+    return stats
+
+
+# check_stats() compares the stored counts with the live tables and returns
+# the (kind, bucket, stored, actual) that differ.
+def check_stats():
+    stored, actual = read_stats(), compute_stats()
+    differences = []
+    for kind in KINDS:
+        for bucket in sorted(set(stored[kind]) | set(actual[kind])):
+            counts = (stored[kind].get(bucket, 0),
+                      actual[kind].get(bucket, 0))
+            if counts[0] != counts[1]:
+                differences.append((kind, bucket) + counts)
+    return differences
+
+
+# rebuild_stats() recomputes catalog_stats from scratch in one transaction.
+# On Postgres the counted tables are locked against writes meanwhile, a
+# write between the scans and the rewrite would be lost.
+def rebuild_stats():
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute(
+            'LOCK TABLE movie, actor, movies_actors IN SHARE MODE')
+    stats = compute_stats()
+    CatalogStat.query.delete()
+    db.session.add_all(CatalogStat(kind=kind, bucket=bucket, count=count)
+                       for kind in KINDS
+                       for bucket, count in stats[kind].items())
+    # Cached /stats responses are keyed on these versions.
+    bump_versions('movie', 'actor', 'movies_actors')
+    db.session.commit()
@@ -0,0 +1,215 @@
+import threading
+import zlib
+from flask import current_app, g, request
+
+# brotli and zstandard are optional, their encodings are only offered when
+# the package is installed.
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Media types worth compressing, the API only writes text.
+COMPRESSIBLE = {'application/json', 'application/x-ndjson', 'text/plain'}
+
+
+# ZlibStream compresses a stream chunk by chunk. Each chunk is flushed so
+# the client can decode it on arrival, as with the uncompressed stream.
+class ZlibStream:
+    def __init__(self, level, wbits):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, wbits)
+
+    def compress(self, data):
+        return self._compressor.compress(data) + \
+            self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+class BrotliStream:
+    def __init__(self, quality):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data):
+        return self._compressor.process(data) + self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+class ZstdStream:
+    def __init__(self, level):
+        self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data):
+        return self._compressor.compress(data) + \
+            self._compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+# Compression negotiates the Content-Encoding of responses and compresses
+# their bodies. Encodings are preferred in the order below when the client
+# accepts several equally: zstd and br usually compress JSON smaller than
+# gzip for the same CPU time. deflate is the zlib format, as HTTP defines it.
+#
+# level is the zlib level of gzip and deflate (1-9), brotli_quality (0-11)
+# and zstd_level (1-22) are those of the other encodings. Bodies shorter
+# than min_bytes are sent as they are, the headers would outweigh the
+# savings.
+class Compression:
+    def __init__(self, min_bytes=1024, level=1, brotli_quality=4,
+                 zstd_level=3):
+        self.min_bytes = min_bytes
+        self.level = level
+        self.brotli_quality = brotli_quality
+        self.zstd_level = zstd_level
+        self.encodings = [encoding for encoding, available in [
+            ('zstd', zstandard is not None),
+            ('br', brotli is not None),
+            ('gzip', True),
+            ('deflate', True),
+        ] if available]
+        self._lock = threading.Lock()
+        self._stats = {
+            'responses': 0,
+            'bytes_in': 0,
+            'bytes_out': 0,
+        }
+
+    # negotiate() returns the encoding of the highest quality in the
+    # client's Accept-Encoding (a werkzeug Accept), None for identity.
+    def negotiate(self, accept_encodings):
+        best, best_quality = None, 0
+        for encoding in self.encodings:
+            quality = accept_encodings[encoding]
+            if quality > best_quality:
+                best, best_quality = encoding, quality
+        return best
+
+    def stream(self, encoding):
+        if encoding == 'zstd':
+            return ZstdStream(self.zstd_level)
+        if encoding == 'br':
+            return BrotliStream(self.brotli_quality)
+        return ZlibStream(self.level, 31 if encoding == 'gzip' else 15)
+
+    # compress() compresses a whole body.
+    def compress(self, encoding, data):
+        if encoding == 'zstd':
+            body = zstandard.ZstdCompressor(level=self.zstd_level) \
+                .compress(data)
+        elif encoding == 'br':
+            body = brotli.compress(data, quality=self.brotli_quality)
+        else:
+            compressor = zlib.compressobj(
+                self.level, zlib.DEFLATED, 31 if encoding == 'gzip' else 15)
+            body = compressor.compress(data) + compressor.flush()
+        self._count(len(data), len(body))
+        return body
+
+    # compress_chunks() compresses an iterable of chunks as they come and
+    # closes it at the end, a streamed response holds a database cursor.
+    def compress_chunks(self, encoding, chunks):
+        stream = self.stream(encoding)
+        size_in = size_out = 0
+        try:
+            for chunk in chunks:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode()
+                data = stream.compress(chunk)
+                size_in += len(chunk)
+                size_out += len(data)
+                if data:
+                    yield data
+            data = stream.finish()
+            size_out += len(data)
+            yield data
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+            self._count(size_in, size_out)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def _count(self, size_in, size_out):
+        with self._lock:
+            self._stats['responses'] += 1
+            self._stats['bytes_in'] += size_in
+            self._stats['bytes_out'] += size_out
+
+
+# setup_compression(app) compresses the responses of the app for clients
+# that accept it. Streamed responses are compressed chunk by chunk, cached
+# responses are stored compressed next to the uncompressed body (see
+# cached() in app.py) so hits are not compressed again.
+def setup_compression(app):
+    app.extensions['compression'] = Compression(
+        min_bytes=app.config['COMPRESSION_MIN_BYTES'],
+        level=app.config['COMPRESSION_LEVEL'],
+        brotli_quality=app.config['COMPRESSION_BROTLI_QUALITY'],
+        zstd_level=app.config['COMPRESSION_ZSTD_LEVEL'])
+    app.after_request(compress_response)
+
+
+# encoded() sets the headers of a response whose body is compressed. The
+# ETag turns weak: it names the data, the same for every encoding, not the
+# bytes.
+def encoded(response, encoding):
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        response.set_etag(etag, weak=True)
+
+
+def compress_response(response):
+    # The body of a cache hit may already be compressed.
+    encoding = g.pop('compressed', None)
+    if encoding is not None:
+        encoded(response, encoding)
+        return response
+
+    if response.mimetype not in COMPRESSIBLE or \
+            response.status_code < 200 or \
+            response.status_code in (204, 304) or \
+            response.direct_passthrough or \
+            'Content-Encoding' in response.headers:
+        return response
+    response.vary.add('Accept-Encoding')
+
+    compression = current_app.extensions['compression']
+    encoding = compression.negotiate(request.accept_encodings)
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = compression.compress_chunks(encoding,
+                                                        response.response)
+        response.headers.pop('Content-Length', None)
+        encoded(response, encoding)
+        return response
+
+    data = response.get_data()
+    if len(data) < compression.min_bytes:
+        return response
+    body = compression.compress(encoding, data)
+    response.set_data(body)
+    encoded(response, encoding)
+
+    cache_key = g.get('cache_key')
+    response_cache = current_app.extensions.get('response_cache')
+    if cache_key is not None and response_cache is not None and \
+            response.status_code == 200 and not g.get('stale'):
+        key, tables = cache_key
+        response_cache.set(f'{key}|{encoding}', tables, response.mimetype,
+                           body)
+    return response
@@ -0,0 +1,143 @@
+import os
+
+
+# from_env() resolves the settings of the application from the environment
+# once, when create_app() runs. Values passed to create_app(test_config)
+# take precedence over these.
+def from_env(environ=None):
+    environ = os.environ if environ is None else environ
+    domain = environ['AUTH0_DOMAIN']
+    # Database connections a worker can hold at once, see pool.py.
+    connections = int(environ.get('DB_POOL_SIZE', 5)) + \
+        int(environ.get('DB_MAX_OVERFLOW', 10))
+
+    return {
+        'SQLALCHEMY_DATABASE_URI': environ['DATABASE_URL'],
+        # Read replicas, comma separated urls, see replicas.py. A client's
+        # reads go to the primary for READ_YOUR_WRITES_SECONDS after the
+        # last write of its token subject.
+        'DATABASE_REPLICA_URLS': [
+            url.strip() for url in
+            environ.get('DATABASE_REPLICA_URLS', '').split(',')
+            if url.strip()],
+        'REPLICA_CHECK_INTERVAL':
+            float(environ.get('REPLICA_CHECK_INTERVAL', 5)),
+        'READ_YOUR_WRITES_SECONDS':
+            float(environ.get('READ_YOUR_WRITES_SECONDS', 5)),
+        # How long a worker trusts the last write of a token subject it
+        # read from the primary, a write made through another worker can go
+        # unseen this long.
+        'READ_YOUR_WRITES_CACHE_SECONDS':
+            float(environ.get('READ_YOUR_WRITES_CACHE_SECONDS', 1)),
+
+        # Auth0, see auth.py.
+        'AUTH0_DOMAIN': domain,
+        'ALGORITHMS': environ['ALGORITHMS'],
+        'API_AUDIENCE': environ['AUDIENCE'],
+        # JWKS_URL='' only uses the pinned JWKS_FILE, see jwks.py.
+        'JWKS_URL': environ.get(
+            'JWKS_URL', f'https://{domain}/.well-known/jwks.json') or None,
+        'JWKS_FILE': environ.get('JWKS_FILE'),
+        'JWKS_TTL': int(environ.get('JWKS_TTL', 600)),
+        'JWKS_MIN_REFETCH_INTERVAL':
+            int(environ.get('JWKS_MIN_REFETCH_INTERVAL', 30)),
+        # TOKEN_CACHE_SIZE=0 disables the cache, see token_cache.py.
+        'TOKEN_CACHE_SIZE': int(environ.get('TOKEN_CACHE_SIZE', 10000)),
+        'TOKEN_CACHE_TTL': int(environ.get('TOKEN_CACHE_TTL', 300)),
+
+        # List endpoints, clients can't ask for more than MAX_PAGE_SIZE
+        # rows at once. Exports read STREAM_CHUNK_SIZE rows per fetch.
+        'DEFAULT_PAGE_SIZE': int(environ.get('DEFAULT_PAGE_SIZE', 100)),
+        'MAX_PAGE_SIZE': int(environ.get('MAX_PAGE_SIZE', 1000)),
+        'STREAM_CHUNK_SIZE': int(environ.get('STREAM_CHUNK_SIZE', 1000)),
+
+        # Batch endpoints accept at most BATCH_MAX_SIZE records and insert
+        # them BATCH_CHUNK_SIZE rows per statement.
+        'BATCH_MAX_SIZE': int(environ.get('BATCH_MAX_SIZE', 1000)),
+        'BATCH_CHUNK_SIZE': int(environ.get('BATCH_CHUNK_SIZE', 500)),
+        # Bulk deletes remove DELETE_CHUNK_SIZE rows per statement, deletes
+        # by filter commit after each chunk.
+        'DELETE_CHUNK_SIZE': int(environ.get('DELETE_CHUNK_SIZE', 500)),
+
+        # Single-row inserts of a worker share transactions of up to
+        # GROUP_COMMIT_MAX_ROWS rows, waiting at most
+        # GROUP_COMMIT_MAX_WAIT_MS for more, see group_commit.py.
+        'GROUP_COMMIT': environ.get('GROUP_COMMIT', '0') != '0',
+        'GROUP_COMMIT_MAX_ROWS':
+            int(environ.get('GROUP_COMMIT_MAX_ROWS', 100)),
+        'GROUP_COMMIT_MAX_WAIT_MS':
+            float(environ.get('GROUP_COMMIT_MAX_WAIT_MS', 2)),
+
+        # Co-star and shortest path queries, see cast_graph.py. The first
+        # query waits up to CAST_GRAPH_BUILD_SECONDS for the graph, paths
+        # are searched up to CAST_GRAPH_MAX_DEGREES movies.
+        'CAST_GRAPH_BUILD_SECONDS':
+            float(environ.get('CAST_GRAPH_BUILD_SECONDS', 20)),
+        'CAST_GRAPH_MAX_DEGREES':
+            int(environ.get('CAST_GRAPH_MAX_DEGREES', 6)),
+
+        # Response compression, see compression.py. Bodies shorter than
+        # COMPRESSION_MIN_BYTES are sent as they are. COMPRESSION_LEVEL is
+        # the level of gzip and deflate, brotli and zstd have their own.
+        'COMPRESSION': environ.get('COMPRESSION', '1') != '0',
+        'COMPRESSION_MIN_BYTES':
+            int(environ.get('COMPRESSION_MIN_BYTES', 1024)),
+        'COMPRESSION_LEVEL': int(environ.get('COMPRESSION_LEVEL', 1)),
+        'COMPRESSION_BROTLI_QUALITY':
+            int(environ.get('COMPRESSION_BROTLI_QUALITY', 4)),
+        'COMPRESSION_ZSTD_LEVEL':
+            int(environ.get('COMPRESSION_ZSTD_LEVEL', 3)),
+
+        # Shared response cache, see response_cache.py. Entries expire
+        # after RESPONSE_CACHE_TTL seconds (0 keeps them until a write).
+        'RESPONSE_CACHE': environ.get('RESPONSE_CACHE', '1') != '0',
+        'RESPONSE_CACHE_PATH': environ.get('RESPONSE_CACHE_PATH'),
+        'RESPONSE_CACHE_MAX_BYTES':
+            int(environ.get('RESPONSE_CACHE_MAX_BYTES', 64 * 1024 * 1024)),
+        'RESPONSE_CACHE_TTL':
+            float(environ.get('RESPONSE_CACHE_TTL', 600)),
+
+        # Admission control, see admission.py. A worker serves at most
+        # ADMISSION_MAX_CONCURRENT requests at once (its database
+        # connections by default, 0 disables), ADMISSION_MAX_QUEUE more wait
+        # up to ADMISSION_QUEUE_TIMEOUT seconds and the others get a 503
+        # with Retry-After ADMISSION_RETRY_AFTER. RATE_LIMIT_PER_SECOND
+        # requests per token subject and worker, with bursts of
+        # RATE_LIMIT_BURST, get past auth (0 disables).
+        'ADMISSION_MAX_CONCURRENT':
+            int(environ.get('ADMISSION_MAX_CONCURRENT', connections)),
+        'ADMISSION_MAX_QUEUE':
+            int(environ.get('ADMISSION_MAX_QUEUE', connections)),
+        'ADMISSION_QUEUE_TIMEOUT':
+            float(environ.get('ADMISSION_QUEUE_TIMEOUT', 5)),
+        'ADMISSION_RETRY_AFTER':
+            int(environ.get('ADMISSION_RETRY_AFTER', 1)),
+        'RATE_LIMIT_PER_SECOND':
+            float(environ.get('RATE_LIMIT_PER_SECOND', 0)),
+        'RATE_LIMIT_BURST': float(environ.get('RATE_LIMIT_BURST', 20)),
+        'RATE_LIMIT_SUBJECTS':
+            int(environ.get('RATE_LIMIT_SUBJECTS', 10000)),
+
+        # Connection pool and statement timeouts, see pool.py.
+        'DB_POOL_SIZE': int(environ.get('DB_POOL_SIZE', 5)),
+        'DB_MAX_OVERFLOW': int(environ.get('DB_MAX_OVERFLOW', 10)),
+        'DB_POOL_TIMEOUT': int(environ.get('DB_POOL_TIMEOUT', 30)),
+        'DB_POOL_RECYCLE': int(environ.get('DB_POOL_RECYCLE', 1800)),
+        'DB_POOL_PRE_PING': environ.get('DB_POOL_PRE_PING', '1') != '0',
+        'DB_READ_TIMEOUT_MS': int(environ.get('DB_READ_TIMEOUT_MS', 5000)),
+        'DB_WRITE_TIMEOUT_MS':
+            int(environ.get('DB_WRITE_TIMEOUT_MS', 15000)),
+
+        # Statement counts and time in a Server-Timing header, statements
+        # slower than SLOW_QUERY_MS are logged (0 disables), see
+        # sqlstats.py.
+        'SERVER_TIMING': environ.get('SERVER_TIMING', '1') != '0',
+        'SLOW_QUERY_MS': float(environ.get('SLOW_QUERY_MS', 200)),
+
+        # Request metrics served at /metrics, see metrics.py.
+        'METRICS': environ.get('METRICS', '1') != '0',
+        'METRICS_DIR': environ.get('METRICS_DIR'),
+        'METRICS_FLUSH_INTERVAL':
+            float(environ.get('METRICS_FLUSH_INTERVAL', 5)),
+        'METRICS_TOKEN': environ.get('METRICS_TOKEN'),
+    }
@@ -0,0 +1,122 @@
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from models import bump_versions, db
+
+logger = logging.getLogger(__name__)
+
+
+# GroupCommitter coalesces single-row inserts from concurrent requests into
+# shared transactions, so a burst of POSTs pays for one commit (and one
+# fsync on the database) per group instead of one per row.
+#
+# Each worker process has one writer thread. It takes the first queued row,
+# waits up to max_wait_ms for more (at most max_rows per group), inserts
+# each row in its own SAVEPOINT and commits once. A row that fails only
+# rolls back its savepoint, the other rows of the group still commit.
+# insert() returns once the transaction holding its row has committed.
+#
+# Rows queued while a group commits go into the next one, so even with
+# max_wait_ms=0 groups grow with the load; a longer wait trades latency
+# for larger groups at low concurrency.
+class GroupCommitter:
+    def __init__(self, app, max_rows=100, max_wait_ms=2):
+        self.app = app
+        self.max_rows = max_rows
+        self.max_wait = max_wait_ms / 1000
+        self._queue = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._stats = {
+            'batches': 0,
+            'rows': 0,
+            'errors': 0,
+        }
+
+    # insert() inserts a row (a dict of column values) into the table of a
+    # model and returns its id once committed. Raises the database error if
+    # the row or the commit failed.
+    def insert(self, model, values):
+        future = Future()
+        self._writer_queue().put((model.__table__, values, future))
+        return future.result()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['queued'] = self._queue.qsize() if self._queue else 0
+        return stats
+
+    # The writer thread is started by the first insert of each worker, a
+    # thread started before gunicorn forks would not exist in the workers.
+    def _writer_queue(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._queue = queue.Queue()
+                    thread = threading.Thread(target=self._run,
+                                              args=(self._queue,),
+                                              daemon=True)
+                    thread.start()
+                    self._pid = os.getpid()
+        return self._queue
+
+    def _run(self, rows):
+        while True:
+            group = [rows.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(group) < self.max_rows:
+                try:
+                    group.append(rows.get(
+                        timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+
+            try:
+                with self.app.app_context():
+                    self._commit(group)
+            except Exception as error:
+                logger.exception('Group commit of %d rows failed.',
+                                 len(group))
+                for table, values, future in group:
+                    if not future.done():
+                        future.set_exception(error)
+
+    # _commit() inserts a group in one transaction and resolves the futures
+    # of its rows once it committed.
+    def _commit(self, group):
+        inserted = []
+        errors = 0
+        try:
+            # The version bump comes first: it opens the transaction on
+            # every driver, pysqlite doesn't begin one for a SAVEPOINT.
+            bump_versions(*sorted(set(table.name
+                                      for table, values, future in group)))
+            for table, values, future in group:
+                savepoint = db.session.begin_nested()
+                try:
+                    result = db.session.execute(table.insert(), values)
+                    savepoint.commit()
+                except Exception as error:
+                    savepoint.rollback()
+                    future.set_exception(error)
+                    errors += 1
+                    continue
+                inserted.append((future, result.inserted_primary_key[0]))
+
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        finally:
+            db.session.remove()
+
+        for future, new_id in inserted:
+            future.set_result(new_id)
+        with self._lock:
+            self._stats['batches'] += 1
+            self._stats['rows'] += len(inserted)
+            self._stats['errors'] += errors
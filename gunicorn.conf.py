@@ -0,0 +1,101 @@
+import gc
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+# Server configuration, read by gunicorn from the working directory:
+# `gunicorn "app:create_app()"`. GUNICORN_PROFILE picks the worker model:
+# - sync: one request per process, the most predictable under CPU load.
+# - gthread (default): GUNICORN_THREADS requests per process, the lowest
+#   memory per concurrent request for our read-heavy, DB-bound traffic.
+# - gevent: up to GUNICORN_WORKER_CONNECTIONS requests per process on
+#   greenlets, for slow clients and long exports.
+# WEB_CONCURRENCY overrides the number of worker processes.
+profile = os.environ.get('GUNICORN_PROFILE', 'gthread')
+cpus = multiprocessing.cpu_count()
+
+if profile == 'gevent':
+    # Patched before the app is imported, so the preloaded modules use
+    # cooperative sockets and locks.
+    from gevent import monkey
+    monkey.patch_all()
+    try:
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+    except ImportError:
+        pass
+
+    worker_class = 'gevent'
+    default_workers = cpus
+    worker_connections = int(
+        os.environ.get('GUNICORN_WORKER_CONNECTIONS', 1000))
+elif profile == 'gthread':
+    worker_class = 'gthread'
+    default_workers = cpus + 1
+    threads = int(os.environ.get('GUNICORN_THREADS', 4))
+elif profile == 'sync':
+    worker_class = 'sync'
+    default_workers = cpus * 2 + 1
+else:
+    raise RuntimeError(f'Unknown GUNICORN_PROFILE {profile!r}.')
+
+workers = int(os.environ.get('WEB_CONCURRENCY', default_workers))
+bind = '0.0.0.0:' + os.environ.get('PORT', '8000')
+
+# The app is imported once in the master and the workers share its memory
+# copy-on-write instead of each importing it again.
+preload_app = True
+
+# Idle connections from the router are kept for a few seconds, bursts
+# beyond the workers wait in the listen backlog.
+keepalive = int(os.environ.get('GUNICORN_KEEPALIVE', 5))
+backlog = int(os.environ.get('GUNICORN_BACKLOG', 2048))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 30))
+graceful_timeout = 30
+
+# Workers are replaced after a number of requests, the jitter keeps them
+# from all restarting at once.
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 1000))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 100))
+
+# The workers of this server add up their metrics through a directory of
+# their own, see metrics.py.
+metrics_dir = None
+if not os.environ.get('METRICS_DIR'):
+    metrics_dir = tempfile.mkdtemp(prefix='capstone-metrics-')
+    os.environ['METRICS_DIR'] = metrics_dir
+
+# Heartbeat files on tmpfs, a disk-backed /tmp can stall workers.
+if os.path.isdir('/dev/shm'):
+    worker_tmp_dir = '/dev/shm'
+
+
+# when_ready() runs in the master once the app is loaded. The cast graph
+# is built here so the workers share its arrays instead of each reading
+# movies_actors (waiting up to CAST_GRAPH_BUILD_SECONDS). Freezing the objects
+# allocated so far keeps the garbage collector from writing to them in the
+# workers, which would copy their pages.
+def when_ready(server):
+    app = server.app.wsgi()
+    with app.app_context():
+        app.extensions['cast_graph'].warm()
+    gc.freeze()
+
+
+# post_fork() runs in each new worker. Connections must never be shared
+# between processes, a worker drops any the master opened and opens its
+# own on first use.
+def post_fork(server, worker):
+    from models import db
+    app = worker.app.wsgi()
+    with app.app_context():
+        db.engine.dispose()
+    replicas = app.extensions.get('replicas')
+    if replicas is not None:
+        replicas.dispose()
+
+
+def on_exit(server):
+    if metrics_dir is not None:
+        shutil.rmtree(metrics_dir, ignore_errors=True)
@@ -0,0 +1,163 @@
+import json
+import logging
+import threading
+import time
+from urllib.request import urlopen
+from jose import jwk
+
+logger = logging.getLogger(__name__)
+
+
+# JWKSStore keeps the signing keys of the identity provider in memory,
+# parsed once into jose key objects and indexed by their 'kid'.
+#
+# - Keys are reused until their TTL runs out (the Cache-Control max-age
+#   of the JWKS response when present, otherwise the configured ttl).
+# - Shortly before expiry a single background thread refreshes them so
+#   requests never wait on the network in the steady state.
+# - An unknown 'kid' (key rotation) triggers at most one refetch every
+#   min_refetch_interval seconds.
+# - Concurrent callers that miss at the same moment share one fetch.
+# - A pinned JWKS file can be used to boot without network access; with
+#   no url the pinned keys are used forever.
+class JWKSStore:
+    def __init__(self, url=None, pinned_file=None, ttl=600,
+                 refresh_margin=60, min_refetch_interval=30, timeout=5):
+        self.url = url
+        self.pinned_file = pinned_file
+        self.ttl = ttl
+        self.refresh_margin = refresh_margin
+        self.min_refetch_interval = min_refetch_interval
+        self.timeout = timeout
+
+        self._keys = {}
+        self._expires_at = 0.0
+        self._last_fetch = 0.0
+        self._generation = 0
+        self._pinned_loaded = False
+        self._background = None
+        self._lock = threading.Lock()
+        self._fetch_lock = threading.Lock()
+        self._stats = {
+            'fetches': 0,
+            'fetch_failures': 0,
+            'background_refreshes': 0,
+            'unknown_kid_refetches': 0,
+        }
+
+    # get_key() returns the parsed key for kid, or None if the provider
+    # does not know it (even after a rate-limited refetch).
+    def get_key(self, kid):
+        self._ensure_fresh()
+
+        key = self._keys.get(kid)
+        if key is None and self._may_refetch():
+            with self._lock:
+                self._stats['unknown_kid_refetches'] += 1
+            self._refresh(self._generation, force=True)
+            key = self._keys.get(kid)
+
+        return key
+
+    # stats() returns a copy of the fetch counters.
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['keys'] = len(self._keys)
+        return stats
+
+    def _ensure_fresh(self):
+        if not self._pinned_loaded and self.pinned_file:
+            self._load_pinned()
+
+        if self.url is None:
+            return
+
+        now = time.monotonic()
+        if not self._keys or now >= self._expires_at:
+            # Nothing usable yet, callers have to wait for the fetch.
+            self._refresh(self._generation)
+        elif now >= self._expires_at - self.refresh_margin:
+            self._start_background_refresh()
+
+    def _may_refetch(self):
+        if self.url is None:
+            return False
+        return time.monotonic() - self._last_fetch >= \
+            self.min_refetch_interval
+
+    def _start_background_refresh(self):
+        with self._lock:
+            if self._background is not None and self._background.is_alive():
+                return
+            self._stats['background_refreshes'] += 1
+            self._background = threading.Thread(
+                target=self._refresh,
+                args=(self._generation,),
+                name='jwks-refresh',
+                daemon=True)
+            self._background.start()
+
+    # _refresh() fetches the key set unless another caller already did so
+    # since `generation` was observed.
+    def _refresh(self, generation, force=False):
+        with self._fetch_lock:
+            if self._generation != generation:
+                return
+            if not force and self._keys and \
+                    time.monotonic() < self._expires_at - self.refresh_margin:
+                return
+
+            self._last_fetch = time.monotonic()
+            try:
+                with urlopen(self.url, timeout=self.timeout) as response:
+                    ttl = self._max_age(response.headers.get('Cache-Control'))
+                    keys = self._parse(json.loads(response.read()))
+            except Exception:
+                with self._lock:
+                    self._stats['fetch_failures'] += 1
+                if not self._keys:
+                    raise
+                # Keep serving the keys we have instead of failing every
+                # request while the provider is unreachable.
+                logger.exception('JWKS refresh failed, serving cached keys.')
+                self._expires_at = time.monotonic() + \
+                    self.min_refetch_interval + self.refresh_margin
+                return
+
+            self._keys = keys
+            self._expires_at = time.monotonic() + ttl
+            self._generation += 1
+            with self._lock:
+                self._stats['fetches'] += 1
+
+    def _load_pinned(self):
+        with self._fetch_lock:
+            if self._pinned_loaded:
+                return
+            with open(self.pinned_file) as pinned:
+                keys = self._parse(json.load(pinned))
+            # Fetched keys win over pinned ones, pinned keys only fill in.
+            keys.update(self._keys)
+            self._keys = keys
+            self._pinned_loaded = True
+            if self.url is not None and not self._expires_at:
+                # Serve the pinned keys right away and refresh them soon.
+                self._expires_at = time.monotonic() + self.refresh_margin
+
+    def _max_age(self, cache_control):
+        for directive in (cache_control or '').split(','):
+            name, _, value = directive.strip().partition('=')
+            if name.lower() == 'max-age' and value.isdigit():
+                return max(int(value), self.min_refetch_interval)
+        return self.ttl
+
+    def _parse(self, jwks):
+        keys = {}
+        for key in jwks.get('keys', []):
+            if key.get('kty') != 'RSA' or 'kid' not in key:
+                continue
+            if key.get('use', 'sig') != 'sig':
+                continue
+            keys[key['kid']] = jwk.construct(key, key.get('alg', 'RS256'))
+        return keys
@@ -1,14 +1,35 @@
 from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 
-from app import APP
+import sys
+from app import create_app
+from catalog_stats import check_stats, rebuild_stats
 from models import db
 
-migrate = Migrate(APP, db)
-manager = Manager(APP)
+app = create_app()
+migrate = Migrate(app, db)
+manager = Manager(app)
 
 manager.add_command('db', MigrateCommand)
 
 
+@manager.command
+def stats_rebuild():
+    "Recompute the catalog counts of GET /stats from the tables."
+    rebuild_stats()
+    print('Catalog stats rebuilt.')
+
+
+@manager.command
+def stats_check():
+    "Compare the catalog counts of GET /stats with the tables."
+    differences = check_stats()
+    for kind, bucket, stored, actual in differences:
+        print(f'{kind} {bucket}: stored {stored}, actual {actual}')
+    if differences:
+        sys.exit(1)
+    print('Catalog stats are consistent.')
+
+
 if __name__ == '__main__':
     manager.run()
@@ -0,0 +1,407 @@
+import fcntl
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+from flask import Response, abort, current_app, request
+from flask import _request_ctx_stack
+from models import db
+from pool import pool_stats
+import sqlstats
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds of the latency histogram buckets.
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+           0.5, 1.0, 2.5, 5.0, 10.0)
+# Statistics of the components below that only ever increase.
+COUNTERS = {'hits', 'misses', 'evictions', 'expirations', 'stores',
+            'invalidations', 'errors', 'fetches', 'fetch_failures',
+            'background_refreshes', 'unknown_kid_refetches', 'checkouts',
+            'timeouts', 'wait_seconds', 'batches', 'rows', 'reads',
+            'builds', 'build_failures', 'stale_queries', 'responses',
+            'bytes_in', 'bytes_out', 'admitted', 'shed', 'queue_timeouts',
+            'rate_limited', 'subject_lookups'}
+# Statistics reported as the largest value of the workers: the response
+# cache is shared by all of them, each has its own copy of the cast graph.
+MAXIMA = {('response_cache', 'entries'), ('response_cache', 'bytes'),
+          ('pool', 'max_wait_seconds'), ('cast_graph', 'version'),
+          ('cast_graph', 'movies'), ('cast_graph', 'actors'),
+          ('cast_graph', 'links'), ('cast_graph', 'build_seconds')}
+
+_local = threading.local()
+# OS thread id -> store, and the totals of the stores of finished threads.
+_stores = {}
+_retired = {}
+_stores_pid = None
+_stores_lock = threading.Lock()
+_flusher = None
+
+
+# Histograms and counters are kept per OS thread, recording a request takes
+# no lock. A store maps (method, route, status) to the histograms of its
+# phases, [bucket counts..., +Inf, sum], and counter labels to counts.
+#
+# Stores are keyed by the native thread id rather than kept in a
+# threading.local: under gevent that is per greenlet, and every request
+# would leave a store behind. The greenlets of a worker share the store of
+# its thread, they only switch on I/O and never in the middle of an update.
+def _store():
+    store = _stores.get(threading.get_native_id())
+    if store is None or _stores_pid != os.getpid():
+        store = _new_store()
+    return store
+
+
+# _new_store() adds the store of the current thread. The stores of threads
+# that finished since are folded into _retired, so their number stays that
+# of the live threads.
+def _new_store():
+    global _stores_pid
+    # Registers threads not started by threading, so they are seen alive.
+    threading.current_thread()
+    with _stores_lock:
+        if _stores_pid != os.getpid():
+            # The stores of the master are not this worker's.
+            _stores.clear()
+            _retired.clear()
+            _stores_pid = os.getpid()
+        alive = {thread.native_id for thread in threading.enumerate()}
+        for native_id in [native_id for native_id in _stores
+                          if native_id not in alive]:
+            _merge_store(_retired, _stores.pop(native_id))
+        return _stores.setdefault(threading.get_native_id(), {})
+
+
+# _merge_store() adds the counters and histograms of a store into total.
+def _merge_store(total, store):
+    for labels, values in list(store.items()):
+        if not isinstance(values, dict):
+            total[labels] = total.get(labels, 0) + values
+            continue
+        series = total.setdefault(labels, {})
+        for phase, phase_values in list(values.items()):
+            sums = series.setdefault(phase, [0] * len(phase_values))
+            for i, value in enumerate(phase_values):
+                sums[i] += value
+
+
+def observe(series, phase, seconds):
+    values = series.get(phase)
+    if values is None:
+        values = series[phase] = [0] * (len(BUCKETS) + 2)
+    values[bisect_left(BUCKETS, seconds)] += 1
+    values[-1] += seconds
+
+
+def count(labels, amount=1):
+    store = _store()
+    store[labels] = store.get(labels, 0) + amount
+
+
+# add_phase() adds the time since start to a phase of the current request:
+# 'admission' (waiting for a slot, see admission.py), 'auth_header'
+# (parsing the Authorization header), 'auth_verify' (token verification) or
+# 'serialize'. The 'db' phase is measured by sqlstats.py
+# and 'total' covers the whole request. The phases live in a thread local
+# rather than flask.g, which costs microseconds per access.
+def add_phase(phase, start):
+    phases = getattr(_local, 'phases', None)
+    if phases is not None:
+        phases[phase] = phases.get(phase, 0) + time.perf_counter() - start
+
+
+def count_auth_failure(code):
+    count(('auth_failure', code))
+
+
+# setup_metrics(app) records the phases of every request and serves the
+# metrics of all the workers of the server at /metrics in the Prometheus
+# text format. Each worker writes its metrics to a file named after its pid
+# in METRICS_DIR every METRICS_FLUSH_INTERVAL seconds; the worker answering
+# a scrape adds them up. Set METRICS_TOKEN to require it as a bearer token.
+def setup_metrics(app):
+    app.before_request(start_request)
+    app.after_request(end_request)
+    app.add_url_rule('/metrics', 'metrics', serve_metrics)
+
+
+def start_request():
+    _local.phases = {}
+    _local.start = time.perf_counter()
+
+
+def end_request(response):
+    end = time.perf_counter()
+    start, _local.start = getattr(_local, 'start', None), None
+    request = _request_ctx_stack.top.request
+    if start is None or request.endpoint == 'metrics':
+        return response
+
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    key = (request.method, route, response.status_code)
+    store = _store()
+    series = store.get(key)
+    if series is None:
+        series = store[key] = {}
+
+    observe(series, 'total', end - start)
+    db_seconds = sqlstats.request_db_time()
+    if db_seconds:
+        observe(series, 'db', db_seconds)
+    for phase, seconds in _local.phases.items():
+        observe(series, phase, seconds)
+
+    if _flusher is None or _flusher[0] != os.getpid():
+        _start_flusher()
+    return response
+
+
+# snapshot() adds up the stores of this worker's threads.
+def snapshot(app):
+    total = {}
+    with _stores_lock:
+        if _stores_pid == os.getpid():
+            for store in [_retired] + list(_stores.values()):
+                _merge_store(total, store)
+    histograms, counters = {}, {}
+    for labels, values in total.items():
+        if not isinstance(values, dict):
+            counters[labels] = values
+            continue
+        method, route, status = labels
+        for phase, phase_values in values.items():
+            histograms[(method, route, str(status), phase)] = phase_values
+    return {'histograms': histograms, 'counters': counters,
+            'components': component_stats(app)}
+
+
+# component_stats() returns the statistics of the token cache, signing
+# keys, connection pool, response cache, group commit, replicas, cast
+# graph, compression, admission and rate limits of this worker.
+def component_stats(app):
+    stats = {
+        'token_cache': app.extensions['token_cache'].stats(),
+        'jwks': app.extensions['jwks'].stats(),
+    }
+    with app.app_context():
+        stats['pool'] = pool_stats(db.engine)
+    response_cache = app.extensions.get('response_cache')
+    if response_cache is not None:
+        stats['response_cache'] = response_cache.stats()
+    group_commit = app.extensions.get('group_commit')
+    if group_commit is not None:
+        stats['group_commit'] = group_commit.stats()
+    replicas = app.extensions.get('replicas')
+    if replicas is not None:
+        stats['replicas'] = replicas.stats()
+    cast_graph = app.extensions.get('cast_graph')
+    if cast_graph is not None:
+        stats['cast_graph'] = cast_graph.stats()
+    compression = app.extensions.get('compression')
+    if compression is not None:
+        stats['compression'] = compression.stats()
+    for name in ('admission', 'rate_limiter'):
+        if name in app.extensions:
+            stats[name] = app.extensions[name].stats()
+    return stats
+
+
+def metrics_dir(app):
+    directory = app.config['METRICS_DIR'] or \
+        os.path.join(tempfile.gettempdir(), 'capstone-metrics')
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def _encode(data):
+    return {
+        'histograms': [[list(labels), values]
+                       for labels, values in data['histograms'].items()],
+        'counters': [[list(labels), value]
+                     for labels, value in data['counters'].items()],
+        'components': data['components'],
+    }
+
+
+def _decode(data):
+    return {
+        'histograms': {tuple(labels): values
+                       for labels, values in data['histograms']},
+        'counters': {tuple(labels): value
+                     for labels, value in data['counters']},
+        'components': data['components'],
+    }
+
+
+# flush() writes the metrics of this worker to its file.
+def flush(app):
+    data = _encode(snapshot(app))
+    path = os.path.join(metrics_dir(app), f'{os.getpid()}.json')
+    with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(path),
+                                     delete=False) as out:
+        json.dump(data, out)
+    os.replace(out.name, path)
+
+
+def _start_flusher():
+    global _flusher
+    app = current_app._get_current_object()
+    interval = app.config['METRICS_FLUSH_INTERVAL']
+
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                flush(app)
+            except Exception:
+                logger.exception('Could not write the metrics.')
+
+    thread = threading.Thread(target=run, daemon=True)
+    _flusher = (os.getpid(), thread)
+    thread.start()
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def merge(total, data):
+    for labels, values in data['histograms'].items():
+        merged = total['histograms'].setdefault(labels, [0] * len(values))
+        for i, value in enumerate(values):
+            merged[i] += value
+    for labels, value in data['counters'].items():
+        total['counters'][labels] = total['counters'].get(labels, 0) + value
+    for component, stats in data['components'].items():
+        merged = total['components'].setdefault(component, {})
+        for key, value in stats.items():
+            if not isinstance(value, (int, float)) or \
+                    isinstance(value, bool):
+                continue
+            if (component, key) in MAXIMA:
+                merged[key] = max(merged.get(key, 0), value)
+            else:
+                merged[key] = merged.get(key, 0) + value
+
+
+# collect() adds up the metrics of every worker. Files left by workers that
+# exited (recycled by max_requests) are folded into archive.json, so the
+# counters keep increasing.
+def collect(app):
+    directory = metrics_dir(app)
+    total = {'histograms': {}, 'counters': {}, 'components': {}}
+    merge(total, snapshot(app))
+
+    with open(os.path.join(directory, 'lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        archive_path = os.path.join(directory, 'archive.json')
+        archive = {'histograms': {}, 'counters': {}, 'components': {}}
+        if os.path.exists(archive_path):
+            with open(archive_path) as archived:
+                archive = _decode(json.load(archived))
+        archived_any = False
+
+        for name in os.listdir(directory):
+            pid = name[:-len('.json')]
+            if not name.endswith('.json') or not pid.isdigit() or \
+                    int(pid) == os.getpid():
+                continue
+            path = os.path.join(directory, name)
+            try:
+                with open(path) as worker:
+                    data = _decode(json.load(worker))
+            except (OSError, ValueError):
+                continue
+            if _alive(int(pid)):
+                merge(total, data)
+            else:
+                # Gauges of exited workers are gone with them.
+                data['components'] = {
+                    component: {key: value for key, value in stats.items()
+                                if key in COUNTERS}
+                    for component, stats in data['components'].items()}
+                merge(archive, data)
+                os.remove(path)
+                archived_any = True
+
+        if archived_any:
+            with tempfile.NamedTemporaryFile('w', dir=directory,
+                                             delete=False) as out:
+                json.dump(_encode(archive), out)
+            os.replace(out.name, archive_path)
+
+    merge(total, archive)
+    return total
+
+
+def _labels(names, values):
+    return ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                                 .replace('"', '\\"'))
+                    for name, value in zip(names, values))
+
+
+# render() writes metrics in the Prometheus text format.
+def render(data):
+    lines = [
+        '# HELP capstone_request_duration_seconds Time spent in each phase '
+        'of a request.',
+        '# TYPE capstone_request_duration_seconds histogram',
+    ]
+    names = ('method', 'route', 'status', 'phase')
+    for labels, values in sorted(data['histograms'].items()):
+        label = _labels(names, labels)
+        cumulative = 0
+        for bound, value in zip(BUCKETS + ('+Inf',), values):
+            cumulative += value
+            lines.append('capstone_request_duration_seconds_bucket'
+                         '{%s,le="%s"} %d' % (label, bound, cumulative))
+        lines.append('capstone_request_duration_seconds_sum{%s} %r'
+                     % (label, values[-1]))
+        lines.append('capstone_request_duration_seconds_count{%s} %d'
+                     % (label, cumulative))
+
+    lines += [
+        '# HELP capstone_auth_failures_total Requests rejected by auth, '
+        'by AuthError code.',
+        '# TYPE capstone_auth_failures_total counter',
+    ]
+    for labels, value in sorted(data['counters'].items()):
+        if labels[0] == 'auth_failure':
+            lines.append('capstone_auth_failures_total{%s} %d'
+                         % (_labels(('code',), labels[1:]), value))
+
+    for component, stats in sorted(data['components'].items()):
+        for key, value in sorted(stats.items()):
+            if key in COUNTERS:
+                name = f'capstone_{component}_{key}_total'
+                lines.append(f'# TYPE {name} counter')
+            else:
+                name = f'capstone_{component}_{key}'
+                lines.append(f'# TYPE {name} gauge')
+            lines.append(f'{name} {value!r}')
+
+    return '\n'.join(lines) + '\n'
+
+
+def serve_metrics():
+    token = current_app.config['METRICS_TOKEN']
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        abort(401)
+
+    app = current_app._get_current_object()
+    try:
+        flush(app)
+    except OSError:
+        logger.exception('Could not write the metrics.')
+    return Response(render(collect(app)),
+                    mimetype='text/plain; version=0.0.4')
@@ -0,0 +1,34 @@
+"""table version counters
+
+Revision ID: 3e9b5d1c6a02
+Revises: 8c1f0e2a7d4b
+Create Date: 2026-10-18 10:05:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3e9b5d1c6a02'
+down_revision = '8c1f0e2a7d4b'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    table_version = op.create_table(
+        'table_version',
+        sa.Column('name', sa.String(length=50), nullable=False),
+        sa.Column('version', sa.BigInteger(), nullable=False),
+        sa.PrimaryKeyConstraint('name')
+    )
+    op.bulk_insert(table_version, [
+        {'name': 'movie', 'version': 0},
+        {'name': 'actor', 'version': 0},
+        {'name': 'movies_actors', 'version': 0},
+    ])
+
+
+def downgrade():
+    op.drop_table('table_version')
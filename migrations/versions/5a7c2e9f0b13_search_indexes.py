@@ -0,0 +1,74 @@
+"""search indexes
+
+Revision ID: 5a7c2e9f0b13
+Revises: 3e9b5d1c6a02
+Create Date: 2026-10-18 11:00:00.000000
+
+Postgres gets pg_trgm GIN indexes on movie.title and actor.name, which
+serve the ILIKE '%q%' filters of the search endpoints. SQLite gets FTS5
+tables using the trigram tokenizer (SQLite 3.34+), kept in sync with
+triggers.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5a7c2e9f0b13'
+down_revision = '3e9b5d1c6a02'
+branch_labels = None
+depends_on = None
+
+# Searched column of each table.
+SEARCHED = [('movie', 'title'), ('actor', 'name')]
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+
+    if dialect == 'postgresql':
+        op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        for table, column in SEARCHED:
+            op.execute(
+                f'CREATE INDEX {table}_{column}_trgm ON {table} '
+                f'USING gin ({column} gin_trgm_ops)')
+
+    elif dialect == 'sqlite':
+        for table, column in SEARCHED:
+            fts = f'{table}_fts'
+            op.execute(
+                f"CREATE VIRTUAL TABLE {fts} USING fts5({column}, "
+                f"content='{table}', content_rowid='id', "
+                f"tokenize='trigram')")
+            op.execute(
+                f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+            op.execute(
+                f'CREATE TRIGGER {fts}_insert AFTER INSERT ON {table} BEGIN '
+                f'INSERT INTO {fts}(rowid, {column}) '
+                f'VALUES (new.id, new.{column}); END')
+            op.execute(
+                f'CREATE TRIGGER {fts}_delete AFTER DELETE ON {table} BEGIN '
+                f"INSERT INTO {fts}({fts}, rowid, {column}) "
+                f"VALUES ('delete', old.id, old.{column}); END")
+            op.execute(
+                f'CREATE TRIGGER {fts}_update AFTER UPDATE ON {table} BEGIN '
+                f"INSERT INTO {fts}({fts}, rowid, {column}) "
+                f"VALUES ('delete', old.id, old.{column}); "
+                f'INSERT INTO {fts}(rowid, {column}) '
+                f'VALUES (new.id, new.{column}); END')
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+
+    if dialect == 'postgresql':
+        for table, column in SEARCHED:
+            op.execute(f'DROP INDEX {table}_{column}_trgm')
+
+    elif dialect == 'sqlite':
+        for table, column in SEARCHED:
+            fts = f'{table}_fts'
+            for trigger in ('insert', 'delete', 'update'):
+                op.execute(f'DROP TRIGGER {fts}_{trigger}')
+            op.execute(f'DROP TABLE {fts}')
@@ -0,0 +1,26 @@
+"""movie row version
+
+Revision ID: 7d2f4b8e1c35
+Revises: 5a7c2e9f0b13
+Create Date: 2026-10-18 14:20:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7d2f4b8e1c35'
+down_revision = '5a7c2e9f0b13'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('movie', sa.Column('version', sa.Integer(), nullable=False,
+                                     server_default='1'))
+
+
+def downgrade():
+    with op.batch_alter_table('movie') as batch_op:
+        batch_op.drop_column('version')
@@ -0,0 +1,52 @@
+"""initial schema
+
+Revision ID: 8c1f0e2a7d4b
+Revises:
+Create Date: 2026-10-18 10:00:00.000000
+
+Databases restored from capstoneDB.psql already have these tables, mark
+them with `python manage.py db stamp 8c1f0e2a7d4b` before upgrading.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8c1f0e2a7d4b'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'movie',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('title', sa.String(length=150), nullable=True),
+        sa.Column('releaseDate', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table(
+        'actor',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('name', sa.String(length=50), nullable=True),
+        sa.Column('age', sa.Integer(), nullable=True),
+        sa.Column('gender', sa.String(length=10), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_table(
+        'movies_actors',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('movie_id', sa.Integer(), nullable=False),
+        sa.Column('actor_id', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['actor_id'], ['actor.id'], ),
+        sa.ForeignKeyConstraint(['movie_id'], ['movie.id'], ),
+        sa.PrimaryKeyConstraint('id', 'movie_id', 'actor_id')
+    )
+
+
+def downgrade():
+    op.drop_table('movies_actors')
+    op.drop_table('actor')
+    op.drop_table('movie')
@@ -0,0 +1,188 @@
+"""catalog stats
+
+Revision ID: 9b4e6f2a1d58
+Revises: 7d2f4b8e1c35
+Create Date: 2026-10-18 16:40:00.000000
+
+catalog_stats holds the counts served by GET /stats: movies per release
+year, actors per gender and age decade, and movies per cast size. Triggers
+on movie, actor and movies_actors update the counts in the transaction of
+every write, whatever issued it. Postgres (10+) uses statement triggers
+over the transition tables, so bulk statements update each count once;
+SQLite uses row triggers. Links are never updated in place, only inserted
+and deleted.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9b4e6f2a1d58'
+down_revision = '7d2f4b8e1c35'
+branch_labels = None
+depends_on = None
+
+# Columns the counts are computed from.
+COLUMNS = {
+    'movie': ['id', '"releaseDate"'],
+    'actor': ['gender', 'age'],
+    'movies_actors': ['movie_id'],
+}
+
+YEAR = {
+    'postgresql': 'EXTRACT(YEAR FROM {r}."releaseDate")',
+    'sqlite': "strftime('%Y', {r}.\"releaseDate\")",
+}
+
+GENDER = "COALESCE({r}.gender, 'unknown')"
+AGE = ("COALESCE(CAST(({r}.age / 10) * 10 AS VARCHAR) || '-' || "
+       "CAST(({r}.age / 10) * 10 + 9 AS VARCHAR), 'unknown')")
+CAST_SIZE = ('CAST((SELECT count(*) FROM movies_actors ma '
+             'WHERE ma.movie_id = {r}.id) AS VARCHAR)')
+
+# Cast sizes of the movies whose links changed: the number of links
+# inserted or deleted and the number left.
+LINK_SIZES = ('SELECT count(*) AS changed, (SELECT count(*) FROM '
+              'movies_actors ma WHERE ma.movie_id = {r}.movie_id) AS size '
+              'FROM {rows} {r} WHERE {r}.movie_id IN (SELECT id FROM movie) '
+              'GROUP BY {r}.movie_id')
+
+
+def year(dialect):
+    return ("COALESCE(CAST(CAST(" + YEAR[dialect] +
+            " AS INTEGER) AS VARCHAR), 'unknown')")
+
+
+# bump() adds up the (bucket, delta) rows of a query into a count.
+def bump(kind, pairs):
+    return (f"INSERT INTO catalog_stats (kind, bucket, count) "
+            f"SELECT '{kind}', bucket, sum(delta) FROM ({pairs}) d "
+            f"GROUP BY bucket HAVING sum(delta) <> 0 "
+            f"ON CONFLICT (kind, bucket) DO UPDATE "
+            f"SET count = catalog_stats.count + excluded.count")
+
+
+def pairs(expression, sign, rows, r):
+    return (f'SELECT {expression.format(r=r)} AS bucket, {sign}1 AS delta '
+            f'FROM {rows} {r}')
+
+
+# statements() returns the statements updating the counts for one event on
+# a table. new and old are the row sources of the new and old rows.
+def statements(dialect, table, event, new, old):
+    counts = {
+        'movie': [('movies_by_year', year(dialect))],
+        'actor': [('actors_by_gender', GENDER), ('actors_by_age', AGE)],
+    }
+    if table == 'movies_actors':
+        if event == 'insert':
+            sizes = LINK_SIZES.format(rows=new, r='n')
+            before = 's.size - s.changed'
+        else:
+            sizes = LINK_SIZES.format(rows=old, r='o')
+            before = 's.size + s.changed'
+        return [bump('cast_size',
+                     f'SELECT CAST({before} AS VARCHAR) AS bucket, '
+                     f'-1 AS delta FROM ({sizes}) s UNION ALL '
+                     f'SELECT CAST(s.size AS VARCHAR), 1 FROM ({sizes}) s')]
+
+    result = []
+    for kind, expression in counts[table]:
+        if event == 'insert':
+            result.append(bump(kind, pairs(expression, '', new, 'n')))
+        elif event == 'delete':
+            result.append(bump(kind, pairs(expression, '-', old, 'o')))
+        else:
+            result.append(bump(kind, pairs(expression, '-', old, 'o') +
+                               ' UNION ALL ' +
+                               pairs(expression, '', new, 'n')))
+    if table == 'movie' and event == 'insert':
+        result.append(bump('cast_size', pairs(CAST_SIZE, '', new, 'n')))
+    elif table == 'movie' and event == 'delete':
+        result.append(bump('cast_size', pairs(CAST_SIZE, '-', old, 'o')))
+    return result
+
+
+# row() is the row of a SQLite row trigger as a one row table.
+def row(table, ref):
+    return '(SELECT ' + ', '.join(f'{ref}.{column} AS {column}'
+                                  for column in COLUMNS[table]) + ')'
+
+
+def events(table):
+    if table == 'movies_actors':
+        return ['insert', 'delete']
+    return ['insert', 'delete', 'update']
+
+
+def upgrade():
+    dialect = op.get_bind().dialect.name
+
+    op.create_table(
+        'catalog_stats',
+        sa.Column('kind', sa.String(length=30), nullable=False),
+        sa.Column('bucket', sa.String(length=30), nullable=False),
+        sa.Column('count', sa.BigInteger(), nullable=False),
+        sa.PrimaryKeyConstraint('kind', 'bucket')
+    )
+    # Cast sizes are counted per movie.
+    op.create_index('movies_actors_movie_id', 'movies_actors', ['movie_id'])
+
+    for table in COLUMNS:
+        if dialect == 'postgresql':
+            branches = ''.join(
+                f"{'IF' if i == 0 else 'ELSIF'} TG_OP = '{event.upper()}' "
+                f"THEN " + ''.join(
+                    f'{statement}; ' for statement in
+                    statements(dialect, table, event, 'new_rows',
+                               'old_rows'))
+                for i, event in enumerate(events(table)))
+            op.execute(
+                f'CREATE FUNCTION {table}_stats() RETURNS trigger '
+                f'LANGUAGE plpgsql AS $$ BEGIN {branches}END IF; '
+                f'RETURN NULL; END $$')
+            for event in events(table):
+                referencing = {
+                    'insert': 'NEW TABLE AS new_rows',
+                    'delete': 'OLD TABLE AS old_rows',
+                    'update': 'OLD TABLE AS old_rows NEW TABLE AS new_rows',
+                }[event]
+                op.execute(
+                    f'CREATE TRIGGER {table}_stats_{event} AFTER '
+                    f'{event.upper()} ON {table} REFERENCING {referencing} '
+                    f'FOR EACH STATEMENT EXECUTE PROCEDURE {table}_stats()')
+
+        elif dialect == 'sqlite':
+            for event in events(table):
+                columns = ''
+                if event == 'update':
+                    columns = ' OF ' + ', '.join(
+                        column for column in COLUMNS[table]
+                        if column != 'id')
+                body = ''.join(
+                    f'{statement}; ' for statement in
+                    statements(dialect, table, event, row(table, 'new'),
+                               row(table, 'old')))
+                op.execute(
+                    f'CREATE TRIGGER {table}_stats_{event} AFTER '
+                    f'{event.upper()}{columns} ON {table} BEGIN {body}END')
+
+    # The counts of the rows already there, the cast sizes are counted with
+    # the movies.
+    for table in ('movie', 'actor'):
+        for statement in statements(dialect, table, 'insert', table, None):
+            op.execute(statement)
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+
+    for table in COLUMNS:
+        for event in events(table):
+            op.execute(f'DROP TRIGGER {table}_stats_{event}'
+                       + (f' ON {table}' if dialect == 'postgresql' else ''))
+        if dialect == 'postgresql':
+            op.execute(f'DROP FUNCTION {table}_stats()')
+    op.drop_index('movies_actors_movie_id', 'movies_actors')
+    op.drop_table('catalog_stats')
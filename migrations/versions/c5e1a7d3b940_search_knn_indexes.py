@@ -0,0 +1,45 @@
+"""search knn indexes
+
+Revision ID: c5e1a7d3b940
+Revises: 9b4e6f2a1d58
+Create Date: 2026-10-18 19:30:00.000000
+
+Replaces the pg_trgm GIN indexes of the search_indexes migration with GiST
+ones. GiST trigram indexes serve the ILIKE filters too, and also return
+rows in order of trigram distance (<->), so a search page is a
+nearest-neighbour scan that stops after the page instead of a sort of
+every match. SQLite is unchanged.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5e1a7d3b940'
+down_revision = '9b4e6f2a1d58'
+branch_labels = None
+depends_on = None
+
+# Searched column of each table.
+SEARCHED = [('movie', 'title'), ('actor', 'name')]
+
+
+def upgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    for table, column in SEARCHED:
+        op.execute(f'DROP INDEX {table}_{column}_trgm')
+        op.execute(
+            f'CREATE INDEX {table}_{column}_trgm ON {table} '
+            f'USING gist ({column} gist_trgm_ops)')
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    for table, column in SEARCHED:
+        op.execute(f'DROP INDEX {table}_{column}_trgm')
+        op.execute(
+            f'CREATE INDEX {table}_{column}_trgm ON {table} '
+            f'USING gin ({column} gin_trgm_ops)')
@@ -0,0 +1,33 @@
+"""recent writes
+
+Revision ID: e2f8a4c6b157
+Revises: c5e1a7d3b940
+Create Date: 2026-10-18 21:10:00.000000
+
+Time of the last write of each token subject, read by replicas.py to keep
+the reads of a client on the primary after its writes, whichever worker
+serves them.
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e2f8a4c6b157'
+down_revision = 'c5e1a7d3b940'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'recent_writes',
+        sa.Column('subject', sa.String(length=255), nullable=False),
+        sa.Column('written_at', sa.Float(), nullable=False),
+        sa.PrimaryKeyConstraint('subject')
+    )
+
+
+def downgrade():
+    op.drop_table('recent_writes')
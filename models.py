@@ -1,18 +1,155 @@
-from flask_sqlalchemy import SQLAlchemy
-import os
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import bindparam, event, select, text
+from pool import engine_options
+from replicas import RoutingSQLAlchemy
+import logging
 
-db = SQLAlchemy()
+# Reads of GET requests can be routed to replicas, see replicas.py.
+db = RoutingSQLAlchemy()
+logger = logging.getLogger(__name__)
 
+# Functions called with the set of changed tables after a commit.
+commit_listeners = []
 
-# setup_db(app) binds a flask application and a SQLAlchemy service
+
+# setup_db(app) binds a flask application and a SQLAlchemy service.
+# No connection is opened here, the schema is managed by the migrations.
 def setup_db(app, database_path):
-    app.config["SQLALCHEMY_DATABASE_URI"] = os.environ['DATABASE_URL']
+    app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = \
+        engine_options(database_path, app.config)
     db.app = app
     db.init_app(app)
-    # uncomment to clear db
-    # db.drop_all()
-    db.create_all()
+
+
+# Version counters of the tables. Every write bumps the counters of the
+# tables it touches in the same transaction, so readers can tell whether a
+# table changed with one primary key lookup instead of a scan.
+class TableVersion(db.Model):
+    __tablename__ = 'table_version'
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.BigInteger, nullable=False, default=0)
+
+
+# Time of the last write of each token subject, so their reads skip the
+# replicas for READ_YOUR_WRITES_SECONDS from every worker (see replicas.py).
+class RecentWrite(db.Model):
+    __tablename__ = 'recent_writes'
+    subject = db.Column(db.String(255), primary_key=True)
+    written_at = db.Column(db.Float, nullable=False)
+
+
+# Counts of the catalog served by GET /stats, kept up to date by triggers
+# on movie, actor and movies_actors (see the catalog_stats migration and
+# catalog_stats.py).
+class CatalogStat(db.Model):
+    __tablename__ = 'catalog_stats'
+    kind = db.Column(db.String(30), primary_key=True)
+    bucket = db.Column(db.String(30), primary_key=True)
+    count = db.Column(db.BigInteger, nullable=False)
+
+
+# bump_versions() increments the counters of the given tables as part of
+# the current transaction.
+def bump_versions(*tables):
+    db.session.info.setdefault('changed_tables', set()).update(tables)
+    db.session.execute(
+        TableVersion.__table__.update()
+        .where(TableVersion.name.in_(tables))
+        .values(version=TableVersion.version + 1)
+    )
+
+
+# get_versions() returns the counters of the given tables in order.
+def get_versions(*tables):
+    versions = dict(
+        db.session.query(TableVersion.name, TableVersion.version)
+        .filter(TableVersion.name.in_(tables))
+    )
+    return tuple(versions.get(name, 0) for name in tables)
+
+
+# bulk_insert() inserts rows (dicts of column values) into the table of a
+# model as part of the current transaction and returns the generated ids in
+# order. Postgres gets one multi-row INSERT ... RETURNING per chunk, other
+# databases one INSERT per row.
+def bulk_insert(model, rows, chunk_size=500):
+    table = model.__table__
+    ids = []
+
+    for start in range(0, len(rows), chunk_size):
+        chunk = rows[start:start + chunk_size]
+        if db.engine.dialect.name == 'postgresql':
+            result = db.session.execute(
+                table.insert().values(chunk).returning(table.c.id))
+            ids += [row[0] for row in result]
+        else:
+            for row in chunk:
+                result = db.session.execute(table.insert(), row)
+                ids.append(result.inserted_primary_key[0])
+
+    bump_versions(table.name)
+    return ids
+
+
+# supports_returning() tells whether the database returns rows from UPDATE
+# and DELETE statements: Postgres, and SQLite since 3.35.
+def supports_returning():
+    dialect = db.engine.dialect
+    return dialect.name != 'sqlite' or \
+        dialect.dbapi.sqlite_version_info >= (3, 35)
+
+
+# delete_returning_ids() deletes the rows of a table with the given ids as
+# part of the current transaction and returns the ids that existed.
+def delete_returning_ids(table, ids):
+    if supports_returning():
+        result = db.session.execute(
+            text(f'DELETE FROM {table.name} WHERE id IN :ids RETURNING id')
+            .bindparams(bindparam('ids', expanding=True)), {'ids': ids})
+        return [row[0] for row in result]
+
+    found = [row[0] for row in db.session.execute(
+        select([table.c.id]).where(table.c.id.in_(ids)))]
+    if found:
+        db.session.execute(table.delete().where(table.c.id.in_(found)))
+    return found
+
+
+# delete_links() deletes the movies_actors rows whose column (movie_id or
+# actor_id) is one of the given ids as part of the current transaction and
+# returns how many there were, so the movies_actors version is only bumped
+# when links were removed.
+def delete_links(column, ids):
+    return db.session.execute(
+        MoviesActors.__table__.delete().where(column.in_(ids))).rowcount
+
+
+# on_commit() registers fn(tables) to be called once a transaction that
+# bumped table versions has committed.
+def on_commit(fn):
+    commit_listeners.append(fn)
+    return fn
+
+
+@event.listens_for(SignallingSession, 'after_commit')
+def notify_commit(session):
+    tables = session.info.pop('changed_tables', None)
+    if not tables:
+        return
+    for listener in commit_listeners:
+        try:
+            listener(frozenset(tables))
+        except Exception:
+            # The data is committed, a failing listener must not turn the
+            # request into an error.
+            logger.exception('Commit listener %r failed.', listener)
+
+
+@event.listens_for(SignallingSession, 'after_rollback')
+def discard_changes(session):
+    session.info.pop('changed_tables', None)
 
 
 class Movie (db.Model):
@@ -20,28 +157,101 @@ class Movie (db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(150))
     releaseDate = db.Column(db.DateTime)
+    # Row version for optimistic concurrency, incremented by every update.
+    # As the version_id_col, ORM updates and deletes check it too and raise
+    # StaleDataError (a 412, see app.py) if the movie changed meanwhile.
+    version = db.Column(db.Integer, nullable=False, server_default='1')
     actors = db.relationship('Actor', secondary='movies_actors')
 
+    __mapper_args__ = {'version_id_col': version}
+
+    # Columns of format(), serialize.py reads them without the objects.
+    fields = ('id', 'title', 'releaseDate', 'version')
+
     def __init__(self, title, releaseDate):
         self.title = title
         self.releaseDate = releaseDate
 
     def add(self):
         db.session.add(self)
+        bump_versions('movie')
         db.session.commit()
 
     def update(self):
+        bump_versions('movie')
         db.session.commit()
 
     def delete(self):
+        tables = ['movie']
+        if delete_links(MoviesActors.movie_id, [self.id]):
+            tables.append('movies_actors')
+        # A loaded collection would have its links deleted a second time.
+        db.session.expire(self, ['actors'])
         db.session.delete(self)
+        bump_versions(*tables)
         db.session.commit()
 
+    # patch() sets the given columns of a movie in a single statement,
+    # without loading it, and returns its (id, title, releaseDate, version)
+    # after the update. Returns None if no movie has this id, or none with
+    # one of the given versions.
+    @classmethod
+    def patch(cls, movie_id, values, versions=None):
+        if versions is not None and not versions:
+            return None
+
+        assignments = ''.join(f'"{name}" = :{name}, ' for name in values)
+        where = 'id = :id'
+        if versions is not None:
+            where += ' AND version IN :versions'
+        update = (f'UPDATE movie SET {assignments}version = version + 1 '
+                  f'WHERE {where} RETURNING id, title, "releaseDate", version')
+        params = dict(values, id=movie_id)
+        if versions is not None:
+            params['versions'] = list(versions)
+
+        dialect = db.engine.dialect
+        if dialect.name == 'postgresql':
+            # The table version is bumped by the same statement.
+            statement = (
+                f'WITH updated AS ({update}), bumped AS ('
+                f'UPDATE table_version SET version = version + 1 '
+                f"WHERE name = 'movie' AND EXISTS (SELECT 1 FROM updated)) "
+                f'SELECT id, title, "releaseDate", version FROM updated')
+        elif not supports_returning():
+            # No RETURNING before SQLite 3.35, the row is read back.
+            statement = update.split(' RETURNING ')[0]
+        else:
+            statement = update
+
+        query = text(statement).columns(
+            cls.id, cls.title, cls.releaseDate, cls.version)
+        if versions is not None:
+            query = query.bindparams(bindparam('versions', expanding=True))
+        result = db.session.execute(query, params)
+
+        if result.returns_rows:
+            row = result.first()
+        elif result.rowcount:
+            row = db.session.query(cls.id, cls.title, cls.releaseDate,
+                                   cls.version).filter_by(id=movie_id).one()
+        else:
+            row = None
+
+        if row is not None:
+            if dialect.name == 'postgresql':
+                db.session.info.setdefault('changed_tables', set()) \
+                    .add('movie')
+            else:
+                bump_versions('movie')
+        return row
+
     def format(self):
         return {
             'id': self.id,
             'title': self.title,
             'releaseDate': self.releaseDate,
+            'version': self.version,
         }
 
     def __repr__(self):
@@ -56,6 +266,9 @@ class Actor (db.Model):
     gender = db.Column(db.String(10))
     movies = db.relationship('Movie', secondary='movies_actors')
 
+    # Columns of format(), serialize.py reads them without the objects.
+    fields = ('id', 'name', 'age', 'gender')
+
     def __init__(self, name, age, gender):
         self.name = name
         self.age = age
@@ -63,15 +276,42 @@ class Actor (db.Model):
 
     def add(self):
         db.session.add(self)
+        bump_versions('actor')
         db.session.commit()
 
     def update(self):
+        bump_versions('actor')
         db.session.commit()
 
     def delete(self):
+        tables = ['actor']
+        if delete_links(MoviesActors.actor_id, [self.id]):
+            tables.append('movies_actors')
+        # A loaded collection would have its links deleted a second time.
+        db.session.expire(self, ['movies'])
         db.session.delete(self)
+        bump_versions(*tables)
         db.session.commit()
 
+    # delete_many() deletes the actors with the given ids and their links
+    # to movies with set-based statements, chunk_size ids per statement, as
+    # part of the current transaction. Returns the ids that existed.
+    @classmethod
+    def delete_many(cls, ids, chunk_size=500):
+        deleted = []
+        unlinked = 0
+        for start in range(0, len(ids), chunk_size):
+            chunk = list(ids[start:start + chunk_size])
+            unlinked += delete_links(MoviesActors.actor_id, chunk)
+            deleted += delete_returning_ids(cls.__table__, chunk)
+
+        tables = ['actor'] if deleted else []
+        if unlinked:
+            tables.append('movies_actors')
+        if tables:
+            bump_versions(*tables)
+        return sorted(deleted)
+
     def format(self):
         return {
             'id': self.id,
@@ -0,0 +1,116 @@
+import threading
+import time
+from flask import current_app, has_request_context, request
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import event, text
+from sqlalchemy.pool import QueuePool
+
+READ_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+# PoolMetrics accumulates the checkout waits of a pool.
+class PoolMetrics:
+    def __init__(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, wait, timed_out=False):
+        with self._lock:
+            self.checkouts += 1
+            self.wait_seconds += wait
+            self.max_wait_seconds = max(self.max_wait_seconds, wait)
+            if timed_out:
+                self.timeouts += 1
+
+
+# MeteredQueuePool is a QueuePool that measures how long each checkout
+# waits for a connection.
+class MeteredQueuePool(QueuePool):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = PoolMetrics()
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except Exception:
+            self.metrics.record(time.perf_counter() - start, timed_out=True)
+            raise
+        self.metrics.record(time.perf_counter() - start)
+        return connection
+
+    # recreate() is called by engine.dispose(), the metrics carry over.
+    def recreate(self):
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        return pool
+
+
+# engine_options() returns the SQLALCHEMY_ENGINE_OPTIONS for a database
+# url from the DB_POOL_* settings: DB_POOL_TIMEOUT is the seconds to wait
+# for a connection, DB_POOL_RECYCLE the seconds before a connection is
+# replaced and DB_POOL_PRE_PING tests connections on checkout, which
+# survives failovers.
+def engine_options(database_url, config):
+    # SQLite keeps the pool SQLAlchemy picks for it.
+    if database_url.startswith('sqlite'):
+        return {}
+
+    return {
+        'poolclass': MeteredQueuePool,
+        'pool_size': config.get('DB_POOL_SIZE', 5),
+        'max_overflow': config.get('DB_MAX_OVERFLOW', 10),
+        'pool_timeout': config.get('DB_POOL_TIMEOUT', 30),
+        'pool_recycle': config.get('DB_POOL_RECYCLE', 1800),
+        'pool_pre_ping': config.get('DB_POOL_PRE_PING', True),
+    }
+
+
+# pool_stats() returns the saturation of an engine's pool in this worker.
+def pool_stats(engine):
+    pool = engine.pool
+    if not isinstance(pool, QueuePool):
+        return {}
+
+    stats = {
+        'size': pool.size(),
+        'checked_in': pool.checkedin(),
+        'in_use': pool.checkedout(),
+        'overflow': max(pool.overflow(), 0),
+    }
+    metrics = getattr(pool, 'metrics', None)
+    if metrics is not None:
+        with metrics._lock:
+            stats.update({
+                'checkouts': metrics.checkouts,
+                'timeouts': metrics.timeouts,
+                'wait_seconds': metrics.wait_seconds,
+                'max_wait_seconds': metrics.max_wait_seconds,
+            })
+    return stats
+
+
+# statement_timeout() returns the timeout in milliseconds of the current
+# request class, DB_READ_TIMEOUT_MS for reads (GET, HEAD) and
+# DB_WRITE_TIMEOUT_MS otherwise. 0 disables it.
+def statement_timeout():
+    if not has_request_context():
+        return 0
+    if request.method in READ_METHODS:
+        return current_app.config.get('DB_READ_TIMEOUT_MS', 0)
+    return current_app.config.get('DB_WRITE_TIMEOUT_MS', 0)
+
+
+# Every transaction started while handling a request gets the statement
+# timeout of its class, so one slow query can't pin a connection forever.
+@event.listens_for(SignallingSession, 'after_begin')
+def set_statement_timeout(session, transaction, connection):
+    if connection.dialect.name != 'postgresql':
+        return
+    timeout = statement_timeout()
+    if timeout:
+        connection.execute(text(f'SET LOCAL statement_timeout = {timeout:d}'))
@@ -0,0 +1,266 @@
+import itertools
+import logging
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app, g, has_request_context, request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, event, orm, text
+from pool import READ_METHODS, engine_options
+
+logger = logging.getLogger(__name__)
+
+# Cookie holding the time of a client's last write, its reads go to the
+# primary for READ_YOUR_WRITES_SECONDS after it. The time is also kept per
+# token subject in the recent_writes table of the primary, for clients that
+# don't keep cookies.
+LAST_WRITE_COOKIE = 'capstone_last_write'
+
+RECENT_WRITE = text(
+    'SELECT written_at FROM recent_writes WHERE subject = :subject')
+REMEMBER_WRITE = text(
+    'INSERT INTO recent_writes (subject, written_at) '
+    'VALUES (:subject, :written_at) '
+    'ON CONFLICT (subject) DO UPDATE SET written_at = excluded.written_at')
+
+
+# RecentWrites caches the time of the last write of token subjects in a
+# worker, so reads don't ask the primary about their subject on every
+# request. The writes of the worker are stored as they happen. A time read
+# from recent_writes is kept for ttl seconds, or until the end of its
+# read-your-writes window if later: ttl is how long a write made through
+# another worker can go unseen.
+class RecentWrites:
+    def __init__(self, ttl=1, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        # subject -> (last write, expires at)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {
+            'subject_lookups': 0,
+        }
+
+    # get() returns the cached time of the last write of subject, None if
+    # it has to be looked up.
+    def get(self, subject, now):
+        with self._lock:
+            entry = self._entries.get(subject)
+            if entry is None or entry[1] <= now:
+                return None
+            self._entries.move_to_end(subject)
+            return entry[0]
+
+    # put() caches the last write of subject until expires_at, keeping a
+    # later write already cached.
+    def put(self, subject, last_write, expires_at):
+        with self._lock:
+            entry = self._entries.get(subject)
+            if entry is not None and entry[0] > last_write:
+                last_write, expires_at = entry[0], max(entry[1], expires_at)
+            self._entries[subject] = (last_write, expires_at)
+            self._entries.move_to_end(subject)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    # looked_up() caches the last write of subject read from the primary.
+    def looked_up(self, subject, last_write, now, window):
+        with self._lock:
+            self._stats['subject_lookups'] += 1
+        self.put(subject, last_write, max(now + self.ttl, last_write + window))
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['subjects'] = len(self._entries)
+        return stats
+
+
+# ReplicaSet holds the engines of the read replicas of a worker. Reads are
+# spread round-robin over the healthy ones; a background thread checks
+# each replica every check_interval seconds, and a replica that drops its
+# connections is taken out at once until a check succeeds again.
+class ReplicaSet:
+    def __init__(self, urls, config, check_interval=5, subject_ttl=1):
+        self.engines = [create_engine(url, **engine_options(url, config))
+                        for url in urls]
+        self.check_interval = check_interval
+        self.recent_writes = RecentWrites(ttl=subject_ttl)
+        self._healthy = set()
+        self._next = itertools.count()
+        self._pid = None
+        self._lock = threading.Lock()
+        self._stats = {
+            'reads': 0,
+            'errors': 0,
+        }
+        for engine in self.engines:
+            event.listen(engine, 'handle_error', self._handle_error)
+
+    # engine() returns the replica engine for the next read, None if no
+    # replica is healthy.
+    def engine(self):
+        if self._pid != os.getpid():
+            self._start_checks()
+        healthy = [engine for engine in self.engines
+                   if engine in self._healthy]
+        if not healthy:
+            return None
+        with self._lock:
+            self._stats['reads'] += 1
+        return healthy[next(self._next) % len(healthy)]
+
+    # check() runs SELECT 1 on every replica and updates their health.
+    def check(self):
+        for engine in self.engines:
+            try:
+                with engine.connect() as conn:
+                    conn.execute(text('SELECT 1'))
+            except Exception as error:
+                self._mark_down(engine, error)
+                continue
+            if engine not in self._healthy:
+                logger.info('Replica %s is up.', engine.url)
+                self._healthy.add(engine)
+
+    # dispose() drops the connections of every replica, gunicorn workers
+    # call it after the fork.
+    def dispose(self):
+        for engine in self.engines:
+            engine.dispose()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['size'] = len(self.engines)
+        stats['healthy'] = len(self._healthy)
+        stats.update(self.recent_writes.stats())
+        return stats
+
+    # The first read of each worker checks the replicas before using one,
+    # the checks then go on in the background.
+    def _start_checks(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        self.check()
+
+        def run():
+            while True:
+                time.sleep(self.check_interval)
+                self.check()
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def _mark_down(self, engine, error):
+        with self._lock:
+            self._stats['errors'] += 1
+        if engine in self._healthy:
+            logger.warning('Replica %s is down: %s', engine.url, error)
+            self._healthy.discard(engine)
+
+    def _handle_error(self, context):
+        if context.is_disconnect:
+            self._mark_down(context.engine, context.original_exception)
+
+
+# RoutingSession sends the statements of read requests (GET, HEAD) to a
+# replica and everything else to the primary. A session keeps the replica
+# it picked until its transaction ends. Writes, flushes and clients within
+# their read-your-writes window always use the primary.
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        replica = self.info.get('replica')
+        if replica is None and self._reads_from_replica():
+            replica = self.app.extensions['replicas'].engine()
+            self.info['replica'] = replica
+        if replica is not None:
+            return replica
+        return super().get_bind(mapper, clause)
+
+    def _reads_from_replica(self):
+        if 'replicas' not in self.app.extensions or self._flushing or \
+                self.info.get('changed_tables') or \
+                not has_request_context() or \
+                request.method not in READ_METHODS:
+            return False
+        window = self.app.config['READ_YOUR_WRITES_SECONDS']
+        now = time.time()
+        try:
+            last_write = float(request.cookies.get(LAST_WRITE_COOKIE, 0))
+        except ValueError:
+            last_write = 0
+        if now < last_write + window:
+            return False
+        subject = g.get('subject')
+        if subject is None:
+            return True
+        return now >= self._subject_last_write(subject, now, window) + window
+
+    # _subject_last_write() returns the time of the last write of subject,
+    # cached by the worker or else read from recent_writes on the primary.
+    def _subject_last_write(self, subject, now, window):
+        recent_writes = self.app.extensions['replicas'].recent_writes
+        last_write = recent_writes.get(subject, now)
+        if last_write is None:
+            with super().get_bind().connect() as conn:
+                last_write = conn.execute(
+                    RECENT_WRITE, subject=subject).scalar() or 0
+            recent_writes.looked_up(subject, last_write, now, window)
+        return last_write
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+@event.listens_for(RoutingSession, 'after_rollback')
+def release_replica(session):
+    session.info.pop('replica', None)
+
+
+# RoutingSQLAlchemy is flask_sqlalchemy.SQLAlchemy with RoutingSession.
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+# setup_replicas(app) routes the reads of the app to the replicas in
+# DATABASE_REPLICA_URLS. Successful writes set a cookie and record the time
+# for their token subject, so the reads of the same client go to the
+# primary for READ_YOUR_WRITES_SECONDS, long enough for the replicas to
+# catch up.
+def setup_replicas(app):
+    app.extensions['replicas'] = ReplicaSet(
+        app.config['DATABASE_REPLICA_URLS'], app.config,
+        check_interval=app.config['REPLICA_CHECK_INTERVAL'],
+        subject_ttl=app.config['READ_YOUR_WRITES_CACHE_SECONDS'])
+    app.after_request(remember_writes)
+
+
+def remember_writes(response):
+    if request.method not in READ_METHODS and response.status_code < 400:
+        window = current_app.config['READ_YOUR_WRITES_SECONDS']
+        now = time.time()
+        response.set_cookie(LAST_WRITE_COOKIE, '%.3f' % now,
+                            max_age=math.ceil(window), httponly=True,
+                            samesite='Lax')
+        if g.get('subject') is not None:
+            remember_subject(g.subject, now)
+    return response
+
+
+# remember_subject(subject, now) records a write of subject in the cache of
+# the worker and on the primary for the other workers. A failure is logged,
+# the cookie still covers clients that keep it.
+def remember_subject(subject, now):
+    window = current_app.config['READ_YOUR_WRITES_SECONDS']
+    replicas = current_app.extensions.get('replicas')
+    if replicas is not None:
+        replicas.recent_writes.put(subject, now, now + window)
+    engine = current_app.extensions['sqlalchemy'].db.engine
+    try:
+        with engine.begin() as conn:
+            conn.execute(REMEMBER_WRITE, subject=subject, written_at=now)
+    except Exception:
+        logger.exception('Could not record the write of %s.', subject)
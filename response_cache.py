@@ -0,0 +1,195 @@
+import logging
+import os
+from contextlib import contextmanager
+import sqlite3
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Cache files written with another SCHEMA_VERSION are emptied and
+# recreated, they only hold copies.
+SCHEMA_VERSION = 2
+SCHEMA = '''
+DROP TABLE IF EXISTS entries;
+CREATE TABLE entries (
+    key TEXT PRIMARY KEY,
+    tags TEXT NOT NULL,
+    mimetype TEXT NOT NULL,
+    body BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    accessed REAL NOT NULL,
+    expires REAL
+);
+CREATE INDEX entries_accessed ON entries (accessed);
+'''
+
+
+# ResponseCache stores serialized response bodies in a local SQLite file
+# shared by every worker on the host, so a payload computed by one gunicorn
+# worker is served by all of them. Entries are tagged with the tables they
+# were read from and invalidate() drops every entry of a table for all
+# workers at once. The file is bounded to max_bytes with LRU eviction, and
+# entries expire after ttl seconds (None keeps them until invalidated), for
+# writes that bypass the models and bump no table version.
+#
+# The cache is best effort: any SQLite error is logged and treated as a
+# miss so it can never fail a request.
+class ResponseCache:
+    def __init__(self, path=None, max_bytes=64 * 1024 * 1024,
+                 max_entry_bytes=None, ttl=None):
+        self.path = path or os.path.join(tempfile.gettempdir(),
+                                         'capstone-response-cache.sqlite')
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes or max_bytes // 8
+        self.ttl = ttl
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'stores': 0,
+            'evictions': 0,
+            'expirations': 0,
+            'invalidations': 0,
+            'errors': 0,
+        }
+
+    # get() returns (mimetype, body) for key, or None on a miss.
+    def get(self, key):
+        expired = False
+        try:
+            conn = self._connection()
+            row = conn.execute(
+                'SELECT mimetype, body, expires FROM entries WHERE key = ?',
+                (key,)).fetchone()
+            now = time.time()
+            if row is not None and row[2] is not None and row[2] <= now:
+                conn.execute('DELETE FROM entries WHERE key = ? AND '
+                             'expires <= ?', (key, now))
+                row, expired = None, True
+            elif row is not None:
+                # Only touch entries that were not used in the last second
+                # to keep writes off the hot path.
+                conn.execute(
+                    'UPDATE entries SET accessed = ? '
+                    'WHERE key = ? AND accessed < ?',
+                    (now, key, now - 1))
+        except sqlite3.Error:
+            self._error()
+            return None
+
+        if expired:
+            self._count('expirations')
+        self._count('hits' if row is not None else 'misses')
+        if row is None:
+            return None
+        return row[0], bytes(row[1])
+
+    # set() stores body under key, tagged with the given table names.
+    def set(self, key, tables, mimetype, body):
+        if len(body) > self.max_entry_bytes:
+            return
+
+        tags = ',' + ','.join(sorted(tables)) + ','
+        now = time.time()
+        expires = now + self.ttl if self.ttl else None
+        try:
+            with self._write() as conn:
+                conn.execute(
+                    'INSERT OR REPLACE INTO entries '
+                    '(key, tags, mimetype, body, size, accessed, expires) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (key, tags, mimetype, body, len(body), now, expires))
+                self._evict(conn)
+        except sqlite3.Error:
+            self._error()
+            return
+
+        self._count('stores')
+
+    # invalidate() drops every entry read from one of the given tables.
+    def invalidate(self, tables):
+        try:
+            with self._write() as conn:
+                for table in tables:
+                    conn.execute('DELETE FROM entries WHERE tags LIKE ?',
+                                 ('%,' + table + ',%',))
+        except sqlite3.Error:
+            self._error()
+            return
+
+        self._count('invalidations')
+
+    def clear(self):
+        try:
+            with self._write() as conn:
+                conn.execute('DELETE FROM entries')
+        except sqlite3.Error:
+            self._error()
+
+    # stats() returns this worker's counters and the shared cache size.
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        try:
+            entries, size = self._connection().execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries'
+            ).fetchone()
+        except sqlite3.Error:
+            entries, size = None, None
+        stats['entries'] = entries
+        stats['bytes'] = size
+        return stats
+
+    @contextmanager
+    def _write(self):
+        conn = self._connection()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield conn
+        except BaseException:
+            conn.execute('ROLLBACK')
+            raise
+        conn.execute('COMMIT')
+
+    def _evict(self, conn):
+        size, = conn.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()
+        while size > self.max_bytes:
+            key, entry_size = conn.execute(
+                'SELECT key, size FROM entries '
+                'ORDER BY accessed LIMIT 1').fetchone()
+            conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+            size -= entry_size
+            self._count('evictions')
+
+    # _connection() opens one connection per thread and per process, SQLite
+    # connections must not cross a fork.
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.pid == os.getpid():
+            return conn
+
+        # Autocommit, writes open their own transaction in _write().
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        # Losing the cache on a power cut is fine, skip the fsyncs.
+        conn.execute('PRAGMA synchronous=OFF')
+        version, = conn.execute('PRAGMA user_version').fetchone()
+        if version != SCHEMA_VERSION:
+            conn.executescript(f'BEGIN IMMEDIATE; {SCHEMA} '
+                               f'PRAGMA user_version = {SCHEMA_VERSION}; '
+                               f'COMMIT;')
+        self._local.conn = conn
+        self._local.pid = os.getpid()
+        return conn
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def _error(self):
+        self._count('errors')
+        logger.exception('Response cache error.')
@@ -0,0 +1,45 @@
+from sqlalchemy import text
+from models import db
+
+# Trigram indexes need at least three characters to narrow a search down.
+MIN_QUERY_LENGTH = 3
+
+
+# escape_like() escapes the LIKE wildcards of a user supplied string.
+def escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%') \
+        .replace('_', '\\_')
+
+
+# search() returns one page of a db.model class whose column contains q,
+# best matches first. On Postgres the pg_trgm GiST index (search_knn_indexes
+# migration) returns the matches by trigram distance, a nearest-neighbour
+# scan that stops after offset + limit rows instead of sorting them all.
+# SQLite ranks the matches of the FTS5 trigram table '<table>_fts'
+# (search_indexes migration) with bm25.
+def search(model, column, q, limit, offset):
+    dialect = db.engine.dialect.name
+
+    if dialect == 'postgresql':
+        return model.query \
+            .filter(column.ilike('%' + escape_like(q) + '%', escape='\\')) \
+            .order_by(column.op('<->')(q), model.id) \
+            .limit(limit).offset(offset).all()
+
+    if dialect == 'sqlite':
+        fts = model.__tablename__ + '_fts'
+        ids = [row[0] for row in db.session.execute(
+            text(f'SELECT rowid FROM {fts} WHERE {fts} MATCH :q '
+                 f'ORDER BY bm25({fts}), rowid LIMIT :limit OFFSET :offset'),
+            {'q': '"' + q.replace('"', '""') + '"',
+             'limit': limit,
+             'offset': offset})]
+        rows = {row.id: row for row in
+                model.query.filter(model.id.in_(ids))} if ids else {}
+        return [rows[row_id] for row_id in ids if row_id in rows]
+
+    # Other databases get an unindexed scan.
+    return model.query \
+        .filter(column.ilike('%' + escape_like(q) + '%', escape='\\')) \
+        .order_by(model.id) \
+        .limit(limit).offset(offset).all()
@@ -0,0 +1,85 @@
+import datetime
+import json
+import time
+from flask import current_app, jsonify, Response
+from sqlalchemy import DateTime
+from metrics import add_phase
+
+WEEKDAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+          'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+
+# columns() returns the columns a db.model class is formatted from, to
+# query them as plain tuples instead of loading the objects.
+def columns(model):
+    return [getattr(model, name) for name in model.fields]
+
+
+# http_date() formats a datetime like Flask's JSON encoder does
+# (werkzeug.http.http_date of its UTC time tuple), without building the
+# time tuple.
+def http_date(value):
+    if value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc)
+    return '%s, %02d %s %04d %02d:%02d:%02d GMT' % (
+        WEEKDAYS[value.weekday()], value.day, MONTHS[value.month - 1],
+        value.year, value.hour, value.minute, value.second)
+
+
+# formatter() returns a function turning a row of columns(model) into the
+# dict of model.format(), with datetimes already written as HTTP dates.
+def formatter(model):
+    names = model.fields
+    dates = [name for name in names
+             if isinstance(getattr(model, name).type, DateTime)]
+
+    if not dates:
+        return lambda row: dict(zip(names, row))
+
+    def format_row(row):
+        item = dict(zip(names, row))
+        for name in dates:
+            value = item[name]
+            if value is not None:
+                item[name] = http_date(value)
+        return item
+
+    return format_row
+
+
+# format_rows() formats rows of columns(model).
+def format_rows(model, rows):
+    return list(map(formatter(model), rows))
+
+
+def default(value):
+    if isinstance(value, datetime.datetime):
+        return http_date(value)
+    if isinstance(value, datetime.date):
+        return '%s, %02d %s %04d 00:00:00 GMT' % (
+            WEEKDAYS[value.weekday()], value.day, MONTHS[value.month - 1],
+            value.year)
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+# dumps() serializes like flask.json.dumps with the app's settings and
+# compact separators, through the C encoder of the json module.
+def dumps(data):
+    return json.dumps(data,
+                      sort_keys=current_app.config['JSON_SORT_KEYS'],
+                      ensure_ascii=current_app.config['JSON_AS_ASCII'],
+                      separators=(',', ':'),
+                      default=default)
+
+
+# json_response() is jsonify() for the list endpoints, byte for byte the
+# same body.
+def json_response(data):
+    if current_app.config['JSONIFY_PRETTYPRINT_REGULAR'] or \
+            current_app.debug:
+        return jsonify(data)
+    start = time.perf_counter()
+    body = dumps(data) + '\n'
+    add_phase('serialize', start)
+    return Response(body, mimetype=current_app.config['JSONIFY_MIMETYPE'])
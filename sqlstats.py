@@ -0,0 +1,122 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from flask import _request_ctx_stack
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+_local = threading.local()
+# Statements slower than this are logged, None disables the log.
+_slow_query_seconds = None
+
+
+# QueryCounter counts the statements executed while it is active.
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+
+
+# setup_sqlstats(app) counts and times the statements of every request.
+# With SERVER_TIMING the totals are sent in a Server-Timing header, and
+# statements slower than SLOW_QUERY_MS are logged with their parameters and
+# the route that ran them.
+def setup_sqlstats(app):
+    global _slow_query_seconds
+    if app.config['SLOW_QUERY_MS']:
+        _slow_query_seconds = app.config['SLOW_QUERY_MS'] / 1000
+
+    app.before_request(reset_request_stats)
+    if app.config['SERVER_TIMING']:
+        app.after_request(add_server_timing)
+
+
+def reset_request_stats():
+    _local.sql_queries = 0
+    _local.sql_seconds = 0
+
+
+def add_server_timing(response):
+    response.headers.add(
+        'Server-Timing', 'db;dur=%.3f;desc="%d queries"' % (
+            request_db_time() * 1000, request_query_count()))
+    return response
+
+
+# count_queries() counts the statements executed by the current thread
+# inside the with block, for example to prove a route does not issue one
+# query per row.
+@contextmanager
+def count_queries():
+    counter = QueryCounter()
+    active = getattr(_local, 'counters', None)
+    if active is None:
+        active = _local.counters = []
+    active.append(counter)
+    try:
+        yield counter
+    finally:
+        active.remove(counter)
+
+
+# assert_constant_queries() calls request(size) for each size and fails
+# when the number of statements grows with it, the sign of one query per
+# row (N+1). Returns the number of statements.
+def assert_constant_queries(request, sizes=(1, 5)):
+    counts = []
+    for size in sizes:
+        with count_queries() as counter:
+            request(size)
+        counts.append(counter.count)
+
+    if len(set(counts)) > 1:
+        raise AssertionError('Query count grows with the result size: ' +
+                             ', '.join(f'{count} queries for {size}'
+                                       for size, count in zip(sizes, counts)))
+    return counts[0]
+
+
+# request_query_count() returns the statements executed so far while
+# handling the current request.
+def request_query_count():
+    return getattr(_local, 'sql_queries', 0)
+
+
+# request_db_time() returns the seconds spent executing statements so far
+# while handling the current request.
+def request_db_time():
+    return getattr(_local, 'sql_seconds', 0)
+
+
+# current_route() names the request running a statement in the log.
+def current_route():
+    ctx = _request_ctx_stack.top
+    if ctx is None:
+        return 'no request'
+    rule = ctx.request.url_rule
+    return f'{ctx.request.method} {rule.rule if rule else ctx.request.path}'
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    for counter in getattr(_local, 'counters', ()):
+        counter.count += 1
+    _local.sql_queries = getattr(_local, 'sql_queries', 0) + 1
+    context._sql_start = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    start = getattr(context, '_sql_start', None)
+    if start is None:
+        return
+    elapsed = time.perf_counter() - start
+    _local.sql_seconds = getattr(_local, 'sql_seconds', 0) + elapsed
+
+    if _slow_query_seconds is not None and elapsed >= _slow_query_seconds:
+        logger.warning('Slow query (%.1f ms) in %s: %s; parameters: %.500r',
+                       elapsed * 1000, current_route(), statement,
+                       parameters)
@@ -1,33 +1,74 @@
 import unittest
 import datetime
+import gzip
 import json
 import os
-from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import func
-from app import APP, format
-from models import Movie, Actor, setup_db
+import random
+import tempfile
+import threading
+import time
+import zlib
+from flask import jsonify
+from flask_migrate import Migrate, upgrade
+from jose import jwt
+from sqlalchemy import func, or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
+from admission import AdmissionController, RateLimiter
+from app import create_app, format, encode_cursor
+from cast_graph import build_graph
+from catalog_stats import check_stats
+from group_commit import GroupCommitter
+import metrics
+from models import Movie, Actor, MoviesActors, RecentWrite, TableVersion
+from models import bump_versions
+from models import db, get_versions
+from replicas import ReplicaSet, remember_writes
+from response_cache import ResponseCache
+from sqlstats import assert_constant_queries, count_queries
 
 # Executive producer token has all permissions.
 token = os.environ['EXECUTIVE_PRODUCER_TOKEN']
 
 
+# The app is created once, the schema is brought up to date by the
+# migrations before the tests run.
+APP = create_app()
+Migrate(APP, db)
+
+
 class CapstoneTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with APP.app_context():
+            upgrade(directory=os.path.join(os.path.dirname(__file__),
+                                           'migrations'))
+
     def setUp(self):
         self.app = APP
         self.client = self.app.test_client
-        self.database_path = os.environ['DATABASE_URL']
-        setup_db(self.app, self.database_path)
         self.headers = {'Content-Type': 'application/json',
                         'Authorization': f'bearer {token}'}
 
-        with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            self.db.create_all()
-
     def tearDown(self):
         pass
 
+    # unlink() deletes the given movies and actors and their links, tests
+    # that link rows register it with addCleanup() so the tests emptying
+    # a table don't hit the foreign keys of movies_actors.
+    def unlink(self, movieIds=(), actorIds=()):
+        with APP.app_context():
+            MoviesActors.query.filter(or_(
+                MoviesActors.movie_id.in_(movieIds),
+                MoviesActors.actor_id.in_(actorIds))) \
+                .delete(synchronize_session=False)
+            Movie.query.filter(Movie.id.in_(movieIds)) \
+                .delete(synchronize_session=False)
+            Actor.query.filter(Actor.id.in_(actorIds)) \
+                .delete(synchronize_session=False)
+            bump_versions('movie', 'actor', 'movies_actors')
+            db.session.commit()
+
     # testGetMoviesSuccess() tests for successful behaviour
     # by checking against the database.
     def testGetMoviesSuccess(self):
@@ -35,7 +76,7 @@ class CapstoneTestCase(unittest.TestCase):
         movie = Movie('Spirited Away', datetime.datetime(2001, 7, 20))
         movie.add()
 
-        movies = format(Movie.query.all())
+        movies = Movie.query.order_by(Movie.id).limit(100).all()
         numOfMovies = len(movies)
 
         response = self.client().get('/movies',
@@ -54,14 +95,290 @@ class CapstoneTestCase(unittest.TestCase):
     # testGetActorsFailure() tests for failed behaviour
     # by emptying the table.
     def testGetMoviesFailure(self):
-        # Ensures that the movie table is empty.
+        # Ensures that the movie table is empty, its links go first.
+        MoviesActors.query.delete()
         Movie.query.delete()
+        # Bulk deletes bypass the models, bumps the version counters so
+        # no ETag or cached response of the full table is reused.
+        bump_versions('movie', 'movies_actors')
 
         response = self.client().get('/movies',
                                      headers=self.headers)
 
         self.assertEqual(response.status_code, 404)
 
+    # testGetMoviesPagination() tests that following next_cursor
+    # walks the table in id order without repeating rows.
+    def testGetMoviesPagination(self):
+        # Ensures there are at least three movies in the database.
+        for title in ['Spirited Away', 'Ponyo', 'Only Yesterday']:
+            Movie(title, datetime.datetime(2001, 7, 20)).add()
+
+        ids = [movie.id for movie in Movie.query.order_by(Movie.id).all()]
+
+        seen = []
+        url = '/movies?limit=2'
+        while url:
+            response = self.client().get(url, headers=self.headers)
+            data = json.loads(response.data.decode())
+
+            self.assertEqual(response.status_code, 200)
+            self.assertLessEqual(len(data['movies']), 2)
+            seen += [movie['id'] for movie in data['movies']]
+
+            url = None
+            if data['next_cursor']:
+                url = '/movies?limit=2&cursor=' + data['next_cursor']
+
+        self.assertEqual(seen, ids)
+
+    # testGetMoviesBadCursor() tests for failed behaviour
+    # with a malformed cursor.
+    def testGetMoviesBadCursor(self):
+        response = self.client().get('/movies?cursor=notacursor',
+                                     headers=self.headers)
+
+        self.assertEqual(response.status_code, 400)
+
+    # testGetMoviesBadLimit() tests for failed behaviour
+    # with limits that are not positive integers.
+    def testGetMoviesBadLimit(self):
+        for limit in ['0', '-1', 'ten', '1.5', '²', '١٠']:
+            response = self.client().get(f'/movies?limit={limit}',
+                                         headers=self.headers)
+            data = json.loads(response.data.decode())
+
+            self.assertEqual(response.status_code, 400, limit)
+            self.assertEqual(data['error'], 400)
+
+    # testGetMoviesStream() tests that both streamed export formats
+    # return every movie in the database.
+    def testGetMoviesStream(self):
+        # Ensures there is at least one movie in the database to get.
+        movie = Movie('Spirited Away', datetime.datetime(2001, 7, 20))
+        movie.add()
+
+        ids = [movie.id for movie in Movie.query.order_by(Movie.id).all()]
+
+        response = self.client().get('/movies?stream=1',
+                                     headers=self.headers)
+        data = json.loads(response.data.decode())
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([movie['id'] for movie in data['movies']], ids)
+
+        response = self.client().get('/movies?stream=ndjson',
+                                     headers=self.headers)
+        lines = response.data.decode().splitlines()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        self.assertEqual([json.loads(line)['id'] for line in lines], ids)
+
+    # testGetMoviesSerialization() tests that pages read as column tuples
+    # are byte for byte the jsonify() of the formatted movies.
+    def testGetMoviesSerialization(self):
+        movie = Movie('千と千尋の神隠し "Spirited Away"',
+                      datetime.datetime(2001, 7, 20, 18, 30, 5))
+        movie.add()
+        cursor = encode_cursor(movie.id - 1)
+
+        response = self.client().get(f'/movies?limit=1&cursor={cursor}',
+                                     headers=self.headers)
+        with APP.test_request_context():
+            expected = jsonify({
+                'success': True,
+                'movies': format([movie]),
+                'next_cursor': None
+            }).get_data()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, expected)
+
+    # testGetMoviesNotModified() tests that a conditional GET is answered
+    # with 304 until a movie is added.
+    def testGetMoviesNotModified(self):
+        # Ensures there is at least one movie in the database to get.
+        movie = Movie('Spirited Away', datetime.datetime(2001, 7, 20))
+        movie.add()
+
+        response = self.client().get('/movies',
+                                     headers=self.headers)
+        etag = response.headers['ETag']
+        headers = dict(self.headers, **{'If-None-Match': etag})
+
+        response = self.client().get('/movies', headers=headers)
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers['ETag'], etag)
+
+        movie = Movie('Ponyo', datetime.datetime(2008, 7, 19))
+        movie.add()
+
+        response = self.client().get('/movies', headers=headers)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+    # testGetMoviesCompressed() tests that pages and exports are compressed
+    # for clients accepting it, from the cache too, and small bodies are
+    # not.
+    def testGetMoviesCompressed(self):
+        for i in range(20):
+            Movie('Spirited Away', datetime.datetime(2001, 7, 20)).add()
+        plain = self.client().get('/movies', headers=self.headers).data
+        gzipHeaders = dict(self.headers, **{'Accept-Encoding': 'gzip'})
+        compressed = APP.extensions['compression'].stats()['responses']
+
+        # The second response is the compressed body of the cache.
+        for attempt in range(2):
+            response = self.client().get('/movies', headers=gzipHeaders)
+
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+            self.assertIn('Accept-Encoding', response.vary)
+            self.assertTrue(response.get_etag()[1])
+            self.assertEqual(gzip.decompress(response.data), plain)
+        self.assertEqual(APP.extensions['compression'].stats()['responses'],
+                         compressed + 1)
+
+        headers = dict(gzipHeaders,
+                       **{'If-None-Match': response.headers['ETag']})
+        response = self.client().get('/movies', headers=headers)
+
+        self.assertEqual(response.status_code, 304)
+
+        plain = self.client().get('/movies?stream=ndjson',
+                                  headers=self.headers).data
+        response = self.client().get(
+            '/movies?stream=ndjson',
+            headers=dict(self.headers, **{'Accept-Encoding': 'deflate'}))
+
+        self.assertEqual(response.headers['Content-Encoding'], 'deflate')
+        self.assertEqual(zlib.decompress(response.data), plain)
+
+        response = self.client().get('/movies?limit=1', headers=gzipHeaders)
+
+        self.assertNotIn('Content-Encoding', response.headers)
+
+    # testGetMoviesCacheFailure() tests that a response cache whose file
+    # can't be read is a miss for reads and doesn't fail writes.
+    def testGetMoviesCacheFailure(self):
+        movie = Movie('Spirited Away', datetime.datetime(2001, 7, 20))
+        movie.add()
+        movieId = movie.id
+        expected = self.client().get('/movies', headers=self.headers).data
+
+        response_cache = APP.extensions['response_cache']
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'cache.sqlite')
+            with open(path, 'wb') as f:
+                f.write(b'not a database' * 100)
+            broken = APP.extensions['response_cache'] = ResponseCache(path)
+            try:
+                response = self.client().get('/movies', headers=self.headers)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.data, expected)
+
+                response = self.client().patch(f'/movies/{movieId}',
+                                               json=dict(title='Ponyo'),
+                                               headers=self.headers)
+                self.assertEqual(response.status_code, 200)
+            finally:
+                APP.extensions['response_cache'] = response_cache
+
+        self.assertGreaterEqual(broken.stats()['errors'], 3)
+
+    # testGetMoviesIncludeActors() tests that embedding the cast costs the
+    # same number of queries whatever the page size.
+    def testGetMoviesIncludeActors(self):
+        # Ensures there are three movies sharing one actor.
+        actor = Actor('James', '21', 'Male')
+        actor.add()
+        self.addCleanup(self.unlink, actorIds=[actor.id])
+        linkId = db.session.query(func.max(MoviesActors.id)).scalar() or 0
+        for title in ['Spirited Away', 'Ponyo', 'Only Yesterday']:
+            movie = Movie(title, datetime.datetime(2001, 7, 20))
+            movie.add()
+            self.addCleanup(self.unlink, movieIds=[movie.id])
+            linkId += 1
+            db.session.add(MoviesActors(id=linkId, movie_id=movie.id,
+                                        actor_id=actor.id))
+        bump_versions('movies_actors')
+        db.session.commit()
+
+        # Starts the pages at the first of the three movies.
+        cursor = encode_cursor(movie.id - 3)
+        actorId = actor.id
+
+        queries = []
+        for limit in [1, 3]:
+            with count_queries() as counter:
+                response = self.client().get(
+                    f'/movies?include=actors&limit={limit}&cursor={cursor}',
+                    headers=self.headers)
+            data = json.loads(response.data.decode())
+
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(data['movies']), limit)
+            self.assertEqual(data['movies'][0]['actors'][0]['id'], actorId)
+            queries.append(counter.count)
+
+        self.assertEqual(queries[0], queries[1])
+
+    # testSearchMoviesSuccess() tests that searches rank the closest titles
+    # first, page through every match once, and accept 3 characters.
+    def testSearchMoviesSuccess(self):
+        # A word no other movie contains.
+        word = 'Tot' + ''.join(random.choice('bcdfghjklmnpqrstvwxz')
+                               for i in range(8))
+        titles = [f'{word} and the Catbus Adventure Collection',
+                  word, f'My Neighbor {word}']
+        movies = [Movie(title, datetime.datetime(1988, 4, 16))
+                  for title in titles]
+        for movie in movies:
+            movie.add()
+        ids = {movie.title: movie.id for movie in movies}
+
+        response = self.client().get(f'/movies/search?q={word.lower()}',
+                                     headers=self.headers)
+        data = json.loads(response.data.decode())
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([movie['title'] for movie in data['movies']],
+                         [titles[1], titles[2], titles[0]])
+
+        seen = []
+        url = f'/movies/search?q={word}&limit=1'
+        while url:
+            response = self.client().get(url, headers=self.headers)
+            data = json.loads(response.data.decode())
+            self.assertEqual(response.status_code, 200)
+            self.assertLessEqual(len(data['movies']), 1)
+            seen += [movie['id'] for movie in data['movies']]
+            url = None
+            if data['next_cursor']:
+                url = (f'/movies/search?q={word}&limit=1&cursor=' +
+                       data['next_cursor'])
+        self.assertEqual(seen, [ids[titles[1]], ids[titles[2]],
+                                ids[titles[0]]])
+
+        response = self.client().get(f'/movies/search?q={word[-3:]}',
+                                     headers=self.headers)
+        data = json.loads(response.data.decode())
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(set(ids.values()) <=
+                        {movie['id'] for movie in data['movies']})
+
+    # testSearchMoviesFailure() tests for failed behaviour
+    # with a query too short for the trigram index.
+    def testSearchMoviesFailure(self):
+        response = self.client().get('/movies/search?q=sp',
+                                     headers=self.headers)
+
+        self.assertEqual(response.status_code, 400)
+
     # testGetActorsSuccess() tests for successful behaviour
     # by checking against the database.
     def testGetActorsSuccess(self):
@@ -69,7 +386,7 @@ class CapstoneTestCase(unittest.TestCase):
         actor = Actor('James', '21', 'Male')
         actor.add()
 
-        actors = Actor.query.all()
+        actors = Actor.query.order_by(Actor.id).limit(100).all()
         numOfActors = len(actors)
 
         response = self.client().get('/actors',
@@ -88,14 +405,195 @@ class CapstoneTestCase(unittest.TestCase):
     # testGetActorsFailure() tests for failed behaviour
     # by emptying the table.
     def testGetActorsFailure(self):
-        # Ensures that the actor table is empty.
+        # Ensures that the actor table is empty, its links go first.
+        MoviesActors.query.delete()
         Actor.query.delete()
+        # Bulk deletes bypass the models, bumps the version counters so
+        # no ETag or cached response of the full table is reused.
+        bump_versions('actor', 'movies_actors')
 
         response = self.client().get('/actors',
                                      headers=self.headers)
 
         self.assertEqual(response.status_code, 404)
 
+    # testGetActorsIncludeMovies() tests that embedding the movies of
+    # actors does not issue a query per actor and that the statements are
+    # reported in the Server-Timing header.
+    def testGetActorsIncludeMovies(self):
+        # Ensures there are five actors with a movie each.
+        movie = Movie('Spirited Away', datetime.datetime(2001, 7, 20))
+        movie.add()
+        self.addCleanup(self.unlink, movieIds=[movie.id])
+        linkId = db.session.query(func.max(MoviesActors.id)).scalar() or 0
+        for name in ['Rumi', 'Miyu', 'Mari', 'Takashi', 'Yasuko']:
+            actor = Actor(name, '30', 'Female')
+            actor.add()
+            self.addCleanup(self.unlink, actorIds=[actor.id])
+            linkId += 1
+            db.session.add(MoviesActors(id=linkId, movie_id=movie.id,
+                                        actor_id=actor.id))
+        bump_versions('movies_actors')
+        db.session.commit()
+        cursor = encode_cursor(actor.id - 5)
+
+        def request(limit):
+            response = self.client().get(
+                f'/actors?include=movies&limit={limit}&cursor={cursor}',
+                headers=self.headers)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('db;dur=', response.headers['Server-Timing'])
+
+        assert_constant_queries(request, sizes=(1, 5))
+
+    # testGetStats() tests that the catalog counts follow the writes of the
+    # models and endpoints, and match the tables.
+    def testGetStats(self):
+        def stats():
+            response = self.client().get('/stats', headers=self.headers)
+            self.assertEqual(response.status_code, 200)
+            return json.loads(response.data.decode())['stats']
+
+        before = stats()
+        movie = Movie('Spirited Away', datetime.datetime(1901, 7, 20))
+        movie.add()
+        actor = Actor('Statsu', '101', 'Other')
+        actor.add()
+        linkId = db.session.query(func.max(MoviesActors.id)).scalar() or 0
+        db.session.add(MoviesActors(id=linkId + 1, movie_id=movie.id,
+                                    actor_id=actor.id))
+        bump_versions('movies_actors')
+        db.session.commit()
+        self.client().patch('/movies/' + str(movie.id),
+                            json=dict(releaseDate='1902-01-01'),
+                            headers=self.headers)
+        self.client().post('/actors/batch',
+                           json=[dict(name='Statsu', age=105)] * 2,
+                           headers=self.headers)
+        after = stats()
+
+        def delta(kind, bucket):
+            return after[kind].get(bucket, 0) - before[kind].get(bucket, 0)
+
+        self.assertEqual(after['movies'], before['movies'] + 1)
+        self.assertEqual(after['links'], before['links'] + 1)
+        self.assertEqual(delta('movies_by_year', '1901'), 0)
+        self.assertEqual(delta('movies_by_year', '1902'), 1)
+        self.assertEqual(delta('actors_by_age', '100-109'), 3)
+        self.assertEqual(delta('actors_by_gender', 'unknown'), 2)
+        self.assertEqual(check_stats(), [])
+
+        self.client().delete('/actors', json=dict(filter=dict(name='Statsu')),
+                             headers=self.headers)
+
+        self.assertEqual(stats()['links'], before['links'])
+        self.assertEqual(check_stats(), [])
+
+    # testGetCostarsAndPath() tests the cast graph endpoints, and that they
+    # follow a delete.
+    def testGetCostarsAndPath(self):
+        actors = [Actor(name, '30', 'Female') for name in 'ABCD']
+        movies = [Movie(title, datetime.datetime(2001, 7, 20))
+                  for title in ['One', 'Two', 'Three']]
+        for item in actors + movies:
+            item.add()
+        a, b, c, d = [actor.id for actor in actors]
+        one, two, three = [movie.id for movie in movies]
+        self.addCleanup(self.unlink, [one, two, three], [a, b, c, d])
+        linkId = db.session.query(func.max(MoviesActors.id)).scalar() or 0
+        for movie_id, actor_id in [(one, a), (one, b), (two, b), (two, c),
+                                   (three, a), (three, b)]:
+            linkId += 1
+            db.session.add(MoviesActors(id=linkId, movie_id=movie_id,
+                                        actor_id=actor_id))
+        bump_versions('movies_actors')
+        db.session.commit()
+
+        def get(url):
+            response = self.client().get(url, headers=self.headers)
+            return response.status_code, json.loads(response.data.decode())
+
+        status, data = get(f'/actors/{a}/costars')
+        self.assertEqual(status, 200)
+        self.assertEqual([(costar['id'], costar['shared_movies'])
+                          for costar in data['costars']], [(b, 2)])
+
+        status, data = get(f'/actors/{a}/path/{c}')
+        self.assertEqual(status, 200)
+        self.assertEqual(data['degrees'], 2)
+        self.assertEqual([actor['id'] for actor in data['actors']],
+                         [a, b, c])
+        self.assertIn(data['movies'][0]['id'], (one, three))
+        self.assertEqual(data['movies'][1]['id'], two)
+
+        status, data = get(f'/actors/{a}/path/{d}')
+        self.assertEqual(status, 200)
+        self.assertIsNone(data['degrees'])
+
+        status, data = get(f'/actors/{a}/path/{d + 1000}')
+        self.assertEqual(status, 404)
+
+        # The graph is rebuilt in the background after the delete, queries
+        # get the previous graph until it is done.
+        self.client().delete('/actors', json=[b], headers=self.headers)
+        response = self.client().get(f'/actors/{a}/path/{c}',
+                                     headers=self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['degrees'], 2)
+        self.assertNotIn('ETag', response.headers)
+        for attempt in range(100):
+            status, data = get(f'/actors/{a}/path/{c}')
+            if data['degrees'] is None:
+                break
+            time.sleep(0.05)
+        self.assertEqual(status, 200)
+        self.assertIsNone(data['degrees'])
+        self.assertGreaterEqual(
+            APP.extensions['cast_graph'].stats()['stale_queries'], 1)
+
+    # testCastGraphShortestPaths() checks path() against a breadth-first
+    # search over a random graph.
+    def testCastGraphShortestPaths(self):
+        rng = random.Random(7)
+        links = sorted({(rng.randrange(60), rng.randrange(150))
+                        for i in range(300)})
+        graph = build_graph(0, links)
+
+        neighbours = {}
+        for movie_id, actor_id in links:
+            for other_movie, other in links:
+                if other_movie == movie_id and other != actor_id:
+                    neighbours.setdefault(actor_id, set()).add(other)
+
+        def distance(source, target):
+            seen, frontier, depth = {source}, [source], 0
+            while frontier:
+                if target in frontier:
+                    return depth
+                frontier = [b for a in frontier
+                            for b in neighbours.get(a, ())
+                            if b not in seen and not seen.add(b)]
+                depth += 1
+            return None
+
+        cast = {}
+        for movie_id, actor_id in links:
+            cast.setdefault(movie_id, set()).add(actor_id)
+        for i in range(200):
+            source, target = rng.randrange(150), rng.randrange(150)
+            expected = distance(source, target) \
+                if source in neighbours or source == target else None
+            chain = graph.path(source, target, max_degrees=100)
+            if expected is None:
+                self.assertIsNone(chain)
+                continue
+            actor_ids, movie_ids = chain
+            self.assertEqual(len(movie_ids), expected)
+            self.assertEqual((actor_ids[0], actor_ids[-1]), (source, target))
+            for step, movie_id in enumerate(movie_ids):
+                self.assertLessEqual({actor_ids[step], actor_ids[step + 1]},
+                                     cast[movie_id])
+
     # testAddMovieSuccess() tests for successful behaviour
     # by checking against the database.
     def testAddMovieSuccess(self):
@@ -121,6 +619,91 @@ class CapstoneTestCase(unittest.TestCase):
 
         self.assertEqual(response.status_code, 400)
 
+    # testAddMovieGroupCommit() tests that concurrent inserts sharing a
+    # transaction each get their own id, and that a failing row does not
+    # fail the others.
+    def testAddMovieGroupCommit(self):
+        committer = GroupCommitter(APP, max_rows=10, max_wait_ms=50)
+        movie = Movie('Spirited Away', datetime.datetime(2001, 7, 20))
+        movie.add()
+        existingId = movie.id
+        results = {}
+
+        def insert(index):
+            values = {'title': f'Group {index}'}
+            if index == 0:
+                values['id'] = existingId
+            try:
+                results[index] = committer.insert(Movie, values)
+            except IntegrityError as error:
+                results[index] = error
+
+        threads = [threading.Thread(target=insert, args=(index,))
+                   for index in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertIsInstance(results.pop(0), IntegrityError)
+        for index, movieId in results.items():
+            self.assertEqual(Movie.query.get(movieId).title, f'Group {index}')
+        self.assertEqual(committer.stats()['rows'], 4)
+        self.assertEqual(committer.stats()['errors'], 1)
+
+        APP.extensions['group_commit'] = committer
+        try:
+            response = self.client().post('/movies',
+                                          json=dict(title='Ponyo'),
+                                          headers=self.headers)
+        finally:
+            del APP.extensions['group_commit']
+        data = json.loads(response.data.decode())
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Movie.query.get(data['id']).title, 'Ponyo')
+
+    # testAddMoviesBatchSuccess() tests for successful behaviour
+    # by checking the returned ids against the database.
+    def testAddMoviesBatchSuccess(self):
+        date = str(datetime.datetime(2001, 7, 20))
+
+        response = self.client().post('/movies/batch',
+                                      json=[dict(title='Spirited Away',
+                                                 releaseDate=date),
+                                            dict(title='Ponyo')],
+                                      headers=self.headers)
+        data = json.loads(response.data.decode())
+
+        titles = [Movie.query.get(movieId).title for movieId in data['ids']]
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(titles, ['Spirited Away', 'Ponyo'])
+
+    # testAddMoviesBatchFailure() tests for failed behaviour
+    # with an invalid record, with and without partial mode.
+    def testAddMoviesBatchFailure(self):
+        numOfMoviesBefore = len(Movie.query.all())
+        movies = [dict(title='Spirited Away'), dict(title='')]
+
+        response = self.client().post('/movies/batch',
+                                      json=movies,
+                                      headers=self.headers)
+        data = json.loads(response.data.decode())
+
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(data['errors'][0]['index'], 1)
+        self.assertEqual(len(Movie.query.all()), numOfMoviesBefore)
+
+        response = self.client().post('/movies/batch?partial=true',
+                                      json=movies,
+                                      headers=self.headers)
+        data = json.loads(response.data.decode())
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(data['ids'][1])
+        self.assertEqual(len(Movie.query.all()), numOfMoviesBefore + 1)
+
     # testUpdateMovieSuccess() tests for successful behaviour
     # by checking against the database.
     def testUpdateMovieSuccess(self):
@@ -151,6 +734,32 @@ class CapstoneTestCase(unittest.TestCase):
 
         self.assertEqual(response.status_code, 400)
 
+    # testUpdateMovieConflict() tests that an update with the version
+    # of an older read (If-Match) is rejected.
+    def testUpdateMovieConflict(self):
+        movie = Movie('Spirited Away', datetime.datetime(2001, 7, 20))
+        movie.add()
+        movieId, version = movie.id, movie.version
+        path = '/movies/' + str(movieId)
+        etag = f'"{version}"'
+
+        response = self.client().patch(path, json=dict(title='Ponyo'),
+                                       headers=dict(self.headers,
+                                                    **{'If-Match': etag}))
+        data = json.loads(response.data.decode())
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['movie']['version'], version + 1)
+        self.assertEqual(response.headers['ETag'], f'"{version + 1}"')
+
+        response = self.client().patch(path,
+                                       json=dict(releaseDate='2008-07-19'),
+                                       headers=dict(self.headers,
+                                                    **{'If-Match': etag}))
+
+        self.assertEqual(response.status_code, 412)
+        self.assertEqual(Movie.query.get(movieId).title, 'Ponyo')
+
     # testDeleteActorSuccess() tests for successful behaviour
     # by checking against the database.
     def testDeleteActorSuccess(self):
@@ -180,6 +789,332 @@ class CapstoneTestCase(unittest.TestCase):
 
         self.assertEqual(response.status_code, 404)
 
+    # testStaleMovieUpdate() tests that an ORM update of a movie changed
+    # since it was loaded fails, and that the error is answered with a 412.
+    def testStaleMovieUpdate(self):
+        movie = Movie('Spirited Away', datetime.datetime(2001, 7, 20))
+        movie.add()
+        version = movie.version
+        db.session.execute(Movie.__table__.update()
+                           .where(Movie.__table__.c.id == movie.id)
+                           .values(version=version + 1))
+        movie.title = 'Ponyo'
+
+        with self.assertRaises(StaleDataError):
+            movie.update()
+        db.session.rollback()
+
+        # The app's handlers run on the exception being handled.
+        with APP.test_request_context():
+            try:
+                raise StaleDataError()
+            except StaleDataError as error:
+                response = APP.make_response(
+                    APP.handle_user_exception(error))
+        self.assertEqual(response.status_code, 412)
+        self.assertEqual(response.get_json()['message'],
+                         'Precondition failed.')
+
+    # testDeleteActorsSuccess() tests that a bulk delete removes the
+    # listed actors and their links, and returns the ids that existed.
+    def testDeleteActorsSuccess(self):
+        movie = Movie('Spirited Away', datetime.datetime(2001, 7, 20))
+        movie.add()
+        actors = [Actor('JamesJ', '21', 'Male'),
+                  Actor('JaneJ', '22', 'Female')]
+        for actor in actors:
+            actor.add()
+        ids = [actor.id for actor in actors]
+        linkId = db.session.query(func.max(MoviesActors.id)).scalar() or 0
+        db.session.add(MoviesActors(id=linkId + 1, movie_id=movie.id,
+                                    actor_id=ids[0]))
+        db.session.commit()
+        missingId = ids[-1] + 1000
+
+        response = self.client().delete('/actors',
+                                        json=dict(ids=ids + [missingId]),
+                                        headers=self.headers)
+        data = json.loads(response.data.decode())
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['deleted'], ids)
+        self.assertEqual(Actor.query.filter(Actor.id.in_(ids)).count(), 0)
+        self.assertEqual(MoviesActors.query.filter(
+            MoviesActors.actor_id.in_(ids)).count(), 0)
+
+    # testDeleteLinkVersions() tests that deleting a movie or actors bumps
+    # the movies_actors version only when links were removed.
+    def testDeleteLinkVersions(self):
+        movie = Movie('Spirited Away', datetime.datetime(2001, 7, 20))
+        movie.add()
+        actors = [Actor('JamesJ', '21', 'Male') for i in range(3)]
+        for actor in actors:
+            actor.add()
+        linkId = db.session.query(func.max(MoviesActors.id)).scalar() or 0
+        db.session.add(MoviesActors(id=linkId + 1, movie_id=movie.id,
+                                    actor_id=actors[0].id))
+        db.session.commit()
+
+        def versions():
+            return get_versions('actor', 'movie', 'movies_actors')
+
+        before = versions()
+        self.assertEqual(Actor.delete_many([actors[1].id]), [actors[1].id])
+        db.session.commit()
+        self.assertEqual(versions(), (before[0] + 1, before[1], before[2]))
+
+        before = versions()
+        actors[2].delete()
+        self.assertEqual(versions(), (before[0] + 1, before[1], before[2]))
+
+        # The loaded collection of the movie holds the link.
+        self.assertEqual(len(movie.actors), 1)
+        before = versions()
+        movie.delete()
+        self.assertEqual(versions(), (before[0], before[1] + 1,
+                                      before[2] + 1))
+        self.assertEqual(MoviesActors.query.filter_by(
+            actor_id=actors[0].id).count(), 0)
+
+    # testDeleteActorsFilter() tests deleting the actors matching a filter,
+    # and rejecting an empty one.
+    def testDeleteActorsFilter(self):
+        for age in [30, 40, 50]:
+            Actor('Filtered', age, 'Male').add()
+
+        response = self.client().delete('/actors', json=dict(filter={}),
+                                        headers=self.headers)
+
+        self.assertEqual(response.status_code, 422)
+
+        response = self.client().delete(
+            '/actors', json=dict(filter=dict(name='Filtered', min_age=40)),
+            headers=self.headers)
+        data = json.loads(response.data.decode())
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(data['deleted']), 2)
+        self.assertEqual(Actor.query.filter_by(name='Filtered').count(), 1)
+
+    # testBadTokenNotCached() tests that tokens failing verification are
+    # refused every time and never stored in the token cache.
+    def testBadTokenNotCached(self):
+        header, payload, signature = token.split('.')
+        forged = '.'.join([header, payload, signature[::-1]])
+        token_cache = APP.extensions['token_cache']
+        before = token_cache.stats()
+
+        for bad in [forged, forged, 'notatoken', 'a.b.c']:
+            response = self.client().get(
+                '/movies', headers={'Authorization': f'bearer {bad}'})
+            self.assertEqual(response.status_code, 401, bad)
+            self.assertIsNone(token_cache.get(bad))
+
+        after = token_cache.stats()
+        self.assertEqual(after['hits'], before['hits'])
+        self.assertEqual(after['misses'], before['misses'] + 8)
+        self.assertLessEqual(after['size'], before['size'])
+
+    # testAdmissionQueue() tests that queued requests are admitted in
+    # priority order, and refused when the queue is full or they waited too
+    # long.
+    def testAdmissionQueue(self):
+        controller = AdmissionController(1, max_queue=1, queue_timeout=5)
+        results = {}
+
+        def acquire(name, priority):
+            results[name] = controller.acquire(priority)
+
+        def queued(count):
+            while controller.stats()['waiting'] != count:
+                time.sleep(0.001)
+
+        self.assertTrue(controller.acquire(0))
+        write = threading.Thread(target=acquire, args=('write', 2))
+        write.start()
+        queued(1)
+        # A read takes the place of the queued write, a second one is
+        # refused.
+        read = threading.Thread(target=acquire, args=('read', 0))
+        read.start()
+        write.join()
+        queued(1)
+
+        self.assertFalse(controller.acquire(0))
+
+        controller.release()
+        read.join()
+        controller.release()
+
+        self.assertEqual(results, {'write': False, 'read': True})
+        self.assertEqual(controller.stats(), {
+            'admitted': 2, 'shed': 2, 'queue_timeouts': 0, 'active': 0,
+            'waiting': 0})
+
+        controller = AdmissionController(1, max_queue=1, queue_timeout=0.01)
+        controller.acquire(0)
+
+        self.assertFalse(controller.acquire(0))
+        self.assertEqual(controller.stats()['queue_timeouts'], 1)
+
+    # testAdmissionRejected() tests the 503 of an overloaded worker and the
+    # 429 of a subject over its rate limit, both with Retry-After.
+    def testAdmissionRejected(self):
+        Movie('Spirited Away', datetime.datetime(2001, 7, 20)).add()
+        admission = APP.extensions.get('admission')
+        controller = AdmissionController(1, max_queue=0)
+        APP.extensions['admission'] = controller
+        try:
+            controller.acquire(0)
+            response = self.client().get('/movies', headers=self.headers)
+
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.headers['Retry-After'], '1')
+
+            controller.release()
+            response = self.client().get('/movies', headers=self.headers)
+
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(controller.stats()['active'], 0)
+
+            APP.extensions['rate_limiter'] = RateLimiter(0.5, 2)
+            statuses = [self.client().get('/movies',
+                                          headers=self.headers)
+                        for i in range(3)]
+
+            self.assertEqual([response.status_code for response in statuses],
+                             [200, 200, 429])
+            self.assertEqual(statuses[2].headers['Retry-After'], '2')
+        finally:
+            APP.extensions['admission'] = admission
+            APP.extensions.pop('rate_limiter', None)
+
+    # testMetrics() tests that requests and auth failures are counted in
+    # the Prometheus metrics.
+    def testMetrics(self):
+        self.client().get('/movies', headers=self.headers)
+        self.client().get('/movies')
+
+        response = self.client().get('/metrics')
+        metrics = response.data.decode()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('capstone_request_duration_seconds_count{method="GET",'
+                      'route="/movies",status="401",phase="total"}', metrics)
+        self.assertIn('capstone_auth_failures_total'
+                      '{code="authorization_header_missing"}', metrics)
+        self.assertIn('capstone_token_cache_hits_total', metrics)
+
+    # testMetricsThreadStores() tests that the counts of finished threads
+    # are kept while their stores are dropped.
+    def testMetricsThreadStores(self):
+        label = ('test_thread_stores', str(random.random()))
+        for i in range(20):
+            thread = threading.Thread(target=metrics.count, args=(label,))
+            thread.start()
+            thread.join()
+        metrics.count(label)
+
+        counters = metrics.snapshot(APP)['counters']
+        self.assertEqual(counters[label], 21)
+        self.assertLessEqual(len(metrics._stores),
+                             len(threading.enumerate()) + 1)
+
+    # testReplicaRouting() tests that reads go to a replica, except right
+    # after the client wrote, and that unreachable replicas are skipped.
+    def testReplicaRouting(self):
+        path, replicas = self.replica()
+        client = self.client()
+
+        APP.extensions['replicas'] = replicas
+        APP.after_request(remember_writes)
+        try:
+            response = client.get('/movies', headers=self.headers)
+            titles = [movie['title'] for movie in
+                      json.loads(response.data.decode())['movies']]
+
+            self.assertEqual(titles, ['Replica only'])
+
+            client.post('/movies', json=dict(title='Ponyo'),
+                        headers=self.headers)
+            response = client.get('/movies', headers=self.headers)
+            titles = [movie['title'] for movie in
+                      json.loads(response.data.decode())['movies']]
+
+            self.assertNotIn('Replica only', titles)
+            # The recent cookie kept the read on the primary, the first
+            # read was the only lookup of the subject.
+            self.assertEqual(replicas.stats()['subject_lookups'], 1)
+
+            APP.extensions['replicas'] = ReplicaSet(
+                ['sqlite:///' + os.path.join(path, 'missing.sqlite')],
+                APP.config)
+            response = self.client().get('/movies', headers=self.headers)
+
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(
+                APP.extensions['replicas'].stats()['healthy'], 0)
+        finally:
+            del APP.extensions['replicas']
+            APP.after_request_funcs[None].remove(remember_writes)
+
+    # testReplicaReadYourWritesWithoutCookies() tests that a client that
+    # doesn't keep cookies still reads from the primary right after it
+    # wrote, by the subject of its token, from the worker it wrote through
+    # and from another one.
+    def testReplicaReadYourWritesWithoutCookies(self):
+        with APP.app_context():
+            Movie('Ponyo', datetime.datetime(2008, 7, 19)).add()
+        path, replicas = self.replica()
+        client = self.client(use_cookies=False)
+
+        APP.extensions['replicas'] = replicas
+        APP.after_request(remember_writes)
+        try:
+            response = client.post('/actors/batch', json=[dict(
+                name='Yuria Nara', age=16, gender='Female')],
+                headers=self.headers)
+            self.assertLess(response.status_code, 400)
+            response = client.get('/movies', headers=self.headers)
+            titles = [movie['title'] for movie in
+                      json.loads(response.data.decode())['movies']]
+
+            self.assertNotIn('Replica only', titles)
+            subject = jwt.get_unverified_claims(token)['sub']
+            with APP.app_context():
+                self.assertIsNotNone(RecentWrite.query.get(subject))
+            self.assertEqual(replicas.stats()['subject_lookups'], 0)
+
+            # Another worker doesn't have the write in its cache, it reads
+            # the row of the subject from the primary once.
+            other = ReplicaSet(['sqlite:///' + path], APP.config)
+            APP.extensions['replicas'] = other
+            for attempt in range(2):
+                response = client.get('/movies', headers=self.headers)
+                titles = [movie['title'] for movie in
+                          json.loads(response.data.decode())['movies']]
+                self.assertNotIn('Replica only', titles)
+            self.assertEqual(other.stats()['subject_lookups'], 1)
+        finally:
+            del APP.extensions['replicas']
+            APP.after_request_funcs[None].remove(remember_writes)
+
+    # replica() returns the path and ReplicaSet of a new replica holding a
+    # single 'Replica only' movie, and forgets the recent writes.
+    def replica(self):
+        with APP.app_context():
+            RecentWrite.query.delete()
+            db.session.commit()
+        path = os.path.join(tempfile.mkdtemp(), 'replica.sqlite')
+        replicas = ReplicaSet(['sqlite:///' + path], APP.config)
+        with replicas.engines[0].begin() as conn:
+            db.Model.metadata.create_all(conn)
+            conn.execute(Movie.__table__.insert(), title='Replica only')
+            # A version of its own, no cached page of the primary matches.
+            conn.execute(TableVersion.__table__.insert(), name='movie',
+                         version=int(time.time() * 1000))
+        return path, replicas
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,174 @@
+import unittest
+import asyncio
+import datetime
+import json
+import os
+from flask_migrate import Migrate, upgrade
+from jose import jwt
+from app import create_app
+from asgi import create_asgi_app
+from models import Movie, Actor, db
+from replicas import LAST_WRITE_COOKIE
+
+token = os.environ['EXECUTIVE_PRODUCER_TOKEN']
+auth = {'Authorization': f'bearer {token}'}
+
+# Both apps serve the same database.
+APP = create_app()
+Migrate(APP, db)
+API = create_asgi_app()
+
+# Headers both apps must send alike, compared as sets where the order of
+# the values doesn't matter.
+HEADERS = ['Allow', 'Access-Control-Allow-Origin',
+           'Access-Control-Allow-Methods', 'Access-Control-Allow-Headers']
+
+
+class ASGITestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with APP.app_context():
+            upgrade(directory=os.path.join(os.path.dirname(__file__),
+                                           'migrations'))
+            # Ensures there are movies and actors to get.
+            Movie('Spirited Away', datetime.datetime(2001, 7, 20)).add()
+            Movie('Ponyo', datetime.datetime(2008, 7, 19)).add()
+            Actor('Rumi Hiiragi', 10, 'Female').add()
+        cls.loop = asyncio.new_event_loop()
+        cls.loop.run_until_complete(API.db.connect())
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.loop.run_until_complete(API.db.close())
+        cls.loop.close()
+
+    # wsgi() sends a request to the WSGI app, asgi() the same request to
+    # the ASGI app. Both return the status, body and headers of HEADERS.
+    def wsgi(self, method, path, query='', headers={}):
+        response = APP.test_client().open(path, method=method,
+                                          query_string=query,
+                                          headers=headers)
+        return (response.status_code, response.data,
+                {name: split(response.headers.get(name))
+                 for name in HEADERS})
+
+    def asgi(self, method, path, query='', headers={}):
+        status, body, response_headers = self.call(API, method, path, query,
+                                                   headers)
+        return (status, body,
+                {name: split(response_headers.get(name.lower()))
+                 for name in HEADERS})
+
+    # call() sends a request to an ASGI app and returns the status, body and
+    # headers, the first value of each by lower case name.
+    def call(self, api, method, path, query='', headers={}, body=b''):
+        scope = {
+            'type': 'http',
+            'method': method,
+            'path': path,
+            'query_string': query.encode(),
+            'headers': [(name.lower().encode(), value.encode())
+                        for name, value in headers.items()],
+        }
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': body}
+
+        async def send(message):
+            messages.append(message)
+
+        self.loop.run_until_complete(api(scope, receive, send))
+        start, body = messages
+        response_headers = {}
+        for name, value in start['headers']:
+            response_headers.setdefault(name.decode().lower(), value.decode())
+        return start['status'], body['body'], response_headers
+
+    def assertSameResponse(self, method, path, query='', headers={}):
+        expected = self.wsgi(method, path, query, headers)
+        self.assertEqual(self.asgi(method, path, query, headers), expected,
+                         f'{method} {path}?{query}')
+        return expected
+
+    # testSameResponses() tests that both apps answer reads and failed
+    # requests with the same status and body.
+    def testSameResponses(self):
+        self.assertEqual(self.assertSameResponse('GET', '/movies',
+                                                 headers=auth)[0], 200)
+        self.assertSameResponse('GET', '/movies', 'limit=1', auth)
+        self.assertSameResponse('GET', '/actors', headers=auth)
+        self.assertSameResponse('HEAD', '/movies', headers=auth)
+
+        for limit in ['0', '-1', 'ten', '²']:
+            status = self.assertSameResponse('GET', '/movies',
+                                             f'limit={limit}', auth)[0]
+            self.assertEqual(status, 400)
+        self.assertSameResponse('GET', '/movies', 'cursor=notacursor', auth)
+        self.assertSameResponse('GET', '/movies')
+        self.assertSameResponse('GET', '/nothing', headers=auth)
+
+    # testMethodNotAllowed() tests that a known path with another method
+    # is a 405 naming the allowed methods, not a 404.
+    def testMethodNotAllowed(self):
+        for method, path in [('PUT', '/movies'), ('DELETE', '/movies/1'),
+                             ('GET', '/actors/1'), ('HEAD', '/movies/1')]:
+            status, body, headers = self.assertSameResponse(method, path,
+                                                            headers=auth)
+            self.assertEqual(status, 405)
+            self.assertTrue(headers['Allow'])
+
+    # testPreflight() tests that both apps answer CORS preflight requests
+    # with 200 and the headers of flask_cors.
+    def testPreflight(self):
+        preflight = {
+            'Origin': 'https://capstone.example',
+            'Access-Control-Request-Method': 'PATCH',
+            'Access-Control-Request-Headers': 'Content-Type,Authorization',
+        }
+        status, body, headers = self.assertSameResponse(
+            'OPTIONS', '/movies/1', headers=preflight)
+        self.assertEqual(status, 200)
+        self.assertEqual(headers['Access-Control-Allow-Origin'],
+                         {'https://capstone.example'})
+        self.assertIn('PATCH', headers['Access-Control-Allow-Methods'])
+
+        self.assertSameResponse('OPTIONS', '/movies')
+        self.assertSameResponse('OPTIONS', '/nothing', headers=preflight)
+
+    # testRememberWrites() tests that with replicas, writes through an app
+    # that got no lifespan events set the last write cookie and record the
+    # token subject like the WSGI app.
+    def testRememberWrites(self):
+        api = create_asgi_app({'DATABASE_REPLICA_URLS': ['sqlite://']})
+        try:
+            status, body, headers = self.call(
+                api, 'POST', '/movies', headers=auth,
+                body=json.dumps({'title': 'Ponyo'}).encode())
+            self.assertEqual(status, 200)
+            self.assertTrue(headers['set-cookie'].startswith(
+                LAST_WRITE_COOKIE + '='))
+
+            subject = jwt.get_unverified_claims(token)['sub']
+            rows = self.loop.run_until_complete(api.db.fetch(
+                'SELECT written_at FROM recent_writes WHERE subject = ?',
+                subject))
+            self.assertEqual(len(rows), 1)
+
+            status, body, headers = self.call(api, 'GET', '/movies',
+                                              headers=auth)
+            self.assertEqual(status, 200)
+            self.assertNotIn('set-cookie', headers)
+        finally:
+            self.loop.run_until_complete(api.db.close())
+
+
+# split() returns the values of a comma separated header as a set.
+def split(value):
+    if value is None:
+        return None
+    return {item.strip() for item in value.split(',')}
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,122 @@
+import unittest
+import datetime
+import os
+from flask_migrate import Migrate, upgrade
+from sqlalchemy import func
+from app import create_app
+from catalog_stats import check_stats, read_stats
+from models import Movie, Actor, MoviesActors, db
+
+DATABASE_URL = os.environ.get('DATABASE_URL', '')
+# Title and name of the rows the tests write.
+MARKER = 'Trigger test'
+
+movies = Movie.__table__
+actors = Actor.__table__
+links = MoviesActors.__table__
+
+
+# The catalog_stats migration creates row triggers on SQLite, which every
+# run of test_app.py exercises, and statement-level triggers over
+# transition tables on Postgres. These tests write through multi-row
+# statements to exercise the Postgres ones, and only run when DATABASE_URL
+# is a Postgres database.
+@unittest.skipUnless(DATABASE_URL.startswith('postgres'),
+                     'DATABASE_URL is not a Postgres database')
+class CatalogStatsTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.app = create_app()
+        Migrate(cls.app, db)
+        with cls.app.app_context():
+            upgrade(directory=os.path.join(os.path.dirname(__file__),
+                                           'migrations'))
+
+    def setUp(self):
+        self.context = self.app.app_context()
+        self.context.push()
+        self.before = read_stats()
+
+    def tearDown(self):
+        db.session.rollback()
+        self.execute(links.delete().where(links.c.movie_id.in_(
+            db.session.query(Movie.id).filter(Movie.title == MARKER))))
+        self.execute(movies.delete().where(movies.c.title == MARKER))
+        self.execute(actors.delete().where(actors.c.name == MARKER))
+        self.context.pop()
+
+    # execute() runs one statement in its own transaction and returns the
+    # ids it inserted, if any.
+    def execute(self, statement):
+        result = db.session.execute(statement)
+        ids = [row[0] for row in result] if result.returns_rows else []
+        db.session.commit()
+        return ids
+
+    # delta() returns how much a stored count changed since setUp().
+    def delta(self, kind, bucket):
+        return read_stats()[kind].get(bucket, 0) - \
+            self.before[kind].get(bucket, 0)
+
+    # testBulkStatements() tests that the counts follow multi-row inserts,
+    # updates and deletes of movies, actors and links.
+    def testBulkStatements(self):
+        movieIds = self.execute(movies.insert().values([
+            dict(title=MARKER, releaseDate=datetime.datetime(1890, 1, 1)),
+            dict(title=MARKER, releaseDate=datetime.datetime(1890, 6, 1)),
+            dict(title=MARKER, releaseDate=None),
+        ]).returning(movies.c.id))
+        actorIds = self.execute(actors.insert().values([
+            dict(name=MARKER, age=101, gender='Trigger'),
+            dict(name=MARKER, age=105, gender='Trigger'),
+            dict(name=MARKER, age=None, gender=None),
+        ]).returning(actors.c.id))
+
+        self.assertEqual(self.delta('movies_by_year', '1890'), 2)
+        self.assertEqual(self.delta('actors_by_age', '100-109'), 2)
+        self.assertEqual(self.delta('actors_by_gender', 'Trigger'), 2)
+        self.assertEqual(self.delta('cast_size', '0'), 3)
+        self.assertEqual(check_stats(), [])
+
+        # Two actors in the first movie, one in the second.
+        linkId = db.session.query(func.max(MoviesActors.id)).scalar() or 0
+        self.execute(links.insert().values([
+            dict(id=linkId + 1, movie_id=movieIds[0], actor_id=actorIds[0]),
+            dict(id=linkId + 2, movie_id=movieIds[0], actor_id=actorIds[1]),
+            dict(id=linkId + 3, movie_id=movieIds[1], actor_id=actorIds[0]),
+        ]))
+
+        self.assertEqual(self.delta('cast_size', '0'), 1)
+        self.assertEqual(self.delta('cast_size', '1'), 1)
+        self.assertEqual(self.delta('cast_size', '2'), 1)
+        self.assertEqual(check_stats(), [])
+
+        self.execute(movies.update().where(movies.c.title == MARKER)
+                     .values(releaseDate=datetime.datetime(1891, 1, 1)))
+        self.execute(actors.update().where(actors.c.name == MARKER)
+                     .values(age=actors.c.age + 10))
+
+        self.assertEqual(self.delta('movies_by_year', '1890'), 0)
+        self.assertEqual(self.delta('movies_by_year', '1891'), 3)
+        self.assertEqual(self.delta('actors_by_age', '100-109'), 0)
+        self.assertEqual(self.delta('actors_by_age', '110-119'), 2)
+        self.assertEqual(check_stats(), [])
+
+        # Unlinks the first actor from both movies in one statement.
+        self.execute(links.delete().where(links.c.actor_id == actorIds[0]))
+
+        self.assertEqual(self.delta('cast_size', '0'), 2)
+        self.assertEqual(self.delta('cast_size', '1'), 1)
+        self.assertEqual(self.delta('cast_size', '2'), 0)
+        self.assertEqual(check_stats(), [])
+
+        self.execute(links.delete().where(links.c.movie_id.in_(movieIds)))
+        self.execute(movies.delete().where(movies.c.id.in_(movieIds)))
+        self.execute(actors.delete().where(actors.c.id.in_(actorIds)))
+
+        self.assertEqual(read_stats(), self.before)
+        self.assertEqual(check_stats(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
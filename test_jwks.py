@@ -0,0 +1,166 @@
+import unittest
+import base64
+import json
+import os
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jwks import JWKSStore
+
+# Public numbers of one RSA key, every kid of the tests shares them.
+MODULUS = rsa.generate_private_key(
+    public_exponent=65537, key_size=2048,
+    backend=default_backend()).public_key().public_numbers().n
+
+
+def public_key(kid):
+    n = MODULUS.to_bytes((MODULUS.bit_length() + 7) // 8, 'big')
+    return {'kty': 'RSA', 'kid': kid, 'use': 'sig', 'alg': 'RS256',
+            'n': base64.urlsafe_b64encode(n).rstrip(b'=').decode(),
+            'e': 'AQAB'}
+
+
+# JWKSHandler serves the keys named in server.kids after server.delay
+# seconds, with a Cache-Control max-age of server.max_age if set, or a 500
+# while server.fail is set. server.requests counts the requests.
+class JWKSHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests += 1
+        time.sleep(self.server.delay)
+        if self.server.fail:
+            self.send_error(500)
+            return
+
+        body = json.dumps({'keys': [public_key(kid)
+                                    for kid in self.server.kids]}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if self.server.max_age is not None:
+            self.send_header('Cache-Control',
+                             f'public, max-age={self.server.max_age}')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class JWKSTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), JWKSHandler)
+        self.server.lock = threading.Lock()
+        self.server.requests = 0
+        self.server.delay = 0
+        self.server.fail = False
+        self.server.max_age = None
+        self.server.kids = ['a']
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        self.url = 'http://127.0.0.1:%d/.well-known/jwks.json' % \
+            self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    # testColdStart() tests that callers missing at the same moment share a
+    # single fetch.
+    def testColdStart(self):
+        self.server.delay = 0.2
+        store = JWKSStore(url=self.url)
+        keys = []
+
+        def get():
+            keys.append(store.get_key('a'))
+
+        threads = [threading.Thread(target=get) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(keys), 8)
+        self.assertTrue(all(key is not None for key in keys))
+        self.assertEqual(self.server.requests, 1)
+        self.assertEqual(store.stats()['fetches'], 1)
+
+    # testUnknownKid() tests that an unknown kid refetches the keys at most
+    # once every min_refetch_interval seconds.
+    def testUnknownKid(self):
+        store = JWKSStore(url=self.url, min_refetch_interval=0.3)
+        self.assertIsNotNone(store.get_key('a'))
+
+        # The provider rotates to a new key right after the first fetch.
+        self.server.kids = ['a', 'b']
+        self.assertIsNone(store.get_key('b'))
+        self.assertEqual(self.server.requests, 1)
+
+        time.sleep(0.3)
+        self.assertIsNotNone(store.get_key('b'))
+        for attempt in range(5):
+            self.assertIsNone(store.get_key('unknown'))
+
+        self.assertEqual(self.server.requests, 2)
+        stats = store.stats()
+        self.assertEqual(stats['unknown_kid_refetches'], 1)
+        self.assertEqual(stats['fetches'], 2)
+        self.assertEqual(stats['keys'], 2)
+
+    # testPinnedFile() tests that the pinned keys are served when the
+    # provider can't be reached, and that a failed refresh keeps them.
+    def testPinnedFile(self):
+        self.server.fail = True
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'jwks.json')
+            with open(path, 'w') as pinned:
+                json.dump({'keys': [public_key('a')]}, pinned)
+            store = JWKSStore(url=self.url, pinned_file=path,
+                              min_refetch_interval=0)
+
+            self.assertIsNotNone(store.get_key('a'))
+            for attempt in range(100):
+                if store.stats()['fetch_failures']:
+                    break
+                time.sleep(0.02)
+
+        self.assertIsNotNone(store.get_key('a'))
+        stats = store.stats()
+        self.assertGreaterEqual(stats['fetch_failures'], 1)
+        self.assertEqual(stats['fetches'], 0)
+        self.assertEqual(stats['keys'], 1)
+
+    # testBackgroundRefresh() tests that keys close to expiry are refreshed
+    # by a background thread while callers keep getting the current ones.
+    def testBackgroundRefresh(self):
+        self.server.max_age = 1
+        store = JWKSStore(url=self.url, refresh_margin=0.8,
+                          min_refetch_interval=0)
+        self.assertIsNotNone(store.get_key('a'))
+
+        self.server.kids = ['b']
+        self.server.delay = 0.5
+        time.sleep(0.3)
+        start = time.monotonic()
+        self.assertIsNotNone(store.get_key('a'))
+        self.assertLess(time.monotonic() - start, 0.25)
+
+        for attempt in range(100):
+            if store.stats()['fetches'] == 2:
+                break
+            time.sleep(0.02)
+
+        self.assertIsNotNone(store.get_key('b'))
+        stats = store.stats()
+        self.assertEqual(stats['fetches'], 2)
+        self.assertEqual(stats['background_refreshes'], 1)
+        self.assertEqual(stats['fetch_failures'], 0)
+        self.assertEqual(self.server.requests, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,112 @@
+import unittest
+import sqlite3
+import threading
+import time
+from unittest import mock
+from flask import Flask
+from sqlalchemy import create_engine
+from sqlalchemy.exc import TimeoutError
+from pool import (MeteredQueuePool, engine_options, pool_stats,
+                  set_statement_timeout)
+
+
+def connect():
+    return sqlite3.connect(':memory:', check_same_thread=False)
+
+
+class PoolTestCase(unittest.TestCase):
+    # testCheckoutWaits() tests that checkouts, their waits and the ones
+    # that time out are counted.
+    def testCheckoutWaits(self):
+        pool = MeteredQueuePool(connect, pool_size=1, max_overflow=0,
+                                timeout=0.1)
+        first = pool.connect()
+
+        start = time.perf_counter()
+        with self.assertRaises(TimeoutError):
+            pool.connect()
+        self.assertGreaterEqual(time.perf_counter() - start, 0.1)
+
+        # The connection is returned while the next checkout waits for it.
+        timer = threading.Timer(0.05, first.close)
+        timer.start()
+        second = pool.connect()
+        timer.join()
+        second.close()
+
+        metrics = pool.metrics
+        self.assertEqual(metrics.checkouts, 3)
+        self.assertEqual(metrics.timeouts, 1)
+        self.assertGreaterEqual(metrics.max_wait_seconds, 0.1)
+        self.assertGreaterEqual(metrics.wait_seconds, 0.15)
+
+    # testRecreate() tests that the metrics survive engine.dispose(), and
+    # the statistics pool_stats() reports.
+    def testRecreate(self):
+        engine = create_engine('sqlite://', creator=connect,
+                               poolclass=MeteredQueuePool, pool_size=2,
+                               max_overflow=1)
+        with engine.connect() as conn:
+            conn.execute('SELECT 1')
+            stats = pool_stats(engine)
+            self.assertEqual((stats['size'], stats['in_use']), (2, 1))
+
+        metrics = engine.pool.metrics
+        engine.dispose()
+        self.assertIsInstance(engine.pool, MeteredQueuePool)
+        self.assertIs(engine.pool.metrics, metrics)
+        with engine.connect() as conn:
+            conn.execute('SELECT 1')
+
+        stats = pool_stats(engine)
+        self.assertEqual(stats['checkouts'], 2)
+        self.assertEqual(stats['timeouts'], 0)
+        self.assertEqual(stats['in_use'], 0)
+        self.assertEqual(pool_stats(create_engine('sqlite://')), {})
+
+    # testEngineOptions() tests that only non-SQLite databases get the
+    # metered pool, configured from the DB_POOL_* settings.
+    def testEngineOptions(self):
+        self.assertEqual(engine_options('sqlite:///capstone.sqlite', {}), {})
+        options = engine_options('postgresql://localhost/capstone',
+                                 {'DB_POOL_SIZE': 3, 'DB_POOL_TIMEOUT': 2})
+        self.assertIs(options['poolclass'], MeteredQueuePool)
+        self.assertEqual((options['pool_size'], options['pool_timeout'],
+                          options['max_overflow']), (3, 2, 10))
+
+    # testStatementTimeout() tests the statement timeout set on the
+    # transactions of read and write requests.
+    def testStatementTimeout(self):
+        app = Flask(__name__)
+        app.config.update(DB_READ_TIMEOUT_MS=500, DB_WRITE_TIMEOUT_MS=2000)
+
+        def timeout(method, dialect='postgresql'):
+            connection = mock.Mock()
+            connection.dialect.name = dialect
+            with app.test_request_context(method=method):
+                set_statement_timeout(None, None, connection)
+            return [str(call[0][0]) for call in
+                    connection.execute.call_args_list]
+
+        self.assertEqual(timeout('GET'),
+                         ['SET LOCAL statement_timeout = 500'])
+        self.assertEqual(timeout('HEAD'),
+                         ['SET LOCAL statement_timeout = 500'])
+        self.assertEqual(timeout('POST'),
+                         ['SET LOCAL statement_timeout = 2000'])
+        self.assertEqual(timeout('DELETE'),
+                         ['SET LOCAL statement_timeout = 2000'])
+        self.assertEqual(timeout('GET', dialect='sqlite'), [])
+
+        app.config['DB_WRITE_TIMEOUT_MS'] = 0
+        self.assertEqual(timeout('PATCH'), [])
+
+        # Transactions outside a request, such as migrations, have none.
+        connection = mock.Mock()
+        connection.dialect.name = 'postgresql'
+        set_statement_timeout(None, None, connection)
+        connection.execute.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()
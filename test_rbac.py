@@ -2,10 +2,10 @@ import unittest
 import datetime
 import json
 import os
-from flask_sqlalchemy import SQLAlchemy
+from flask_migrate import Migrate, upgrade
 from sqlalchemy import func
-from app import APP, format
-from models import Movie, Actor, setup_db
+from app import create_app
+from models import Movie, Actor, db
 
 # Retrieve tokens for each role.
 EPToken = os.environ['EXECUTIVE_PRODUCER_TOKEN']
@@ -17,17 +17,22 @@ CDAuth = {'Authorization': f'bearer {CDToken}'}
 CAAuth = {'Authorization': f'bearer {CAToken}'}
 
 
+# The app is created once, the schema is brought up to date by the
+# migrations before the tests run.
+APP = create_app()
+Migrate(APP, db)
+
+
 class CapstoneTestCase(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        with APP.app_context():
+            upgrade(directory=os.path.join(os.path.dirname(__file__),
+                                           'migrations'))
+
     def setUp(self):
         self.app = APP
         self.client = self.app.test_client
-        self.database_path = os.environ['DATABASE_URL']
-        setup_db(self.app, self.database_path)
-
-        with self.app.app_context():
-            self.db = SQLAlchemy()
-            self.db.init_app(self.app)
-            self.db.create_all()
 
     def tearDown(self):
         pass
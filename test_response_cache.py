@@ -0,0 +1,98 @@
+import unittest
+import multiprocessing
+import os
+import tempfile
+from unittest import mock
+from response_cache import ResponseCache
+
+
+class ResponseCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'cache.sqlite')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    # testInvalidateOtherProcess() tests that a write in one process drops
+    # the entries of the tables it changed for every other process.
+    def testInvalidateOtherProcess(self):
+        cache = ResponseCache(path=self.path)
+        cache.set('movies', ['movie'], 'application/json', b'[1]')
+        cache.set('actors', ['actor', 'movies_actors'], 'application/json',
+                  b'[2]')
+        self.assertEqual(cache.get('movies'), ('application/json', b'[1]'))
+
+        # The forked process opens its own connection to the same file.
+        writer = multiprocessing.get_context('fork').Process(
+            target=cache.invalidate, args=(['movie'],))
+        writer.start()
+        writer.join(10)
+        self.assertEqual(writer.exitcode, 0)
+
+        self.assertIsNone(cache.get('movies'))
+        self.assertEqual(cache.get('actors'), ('application/json', b'[2]'))
+
+    # testEviction() tests that the least recently used entries are evicted
+    # to keep the cache within max_bytes, and that entries over
+    # max_entry_bytes are not stored.
+    def testEviction(self):
+        cache = ResponseCache(path=self.path, max_bytes=300,
+                              max_entry_bytes=100)
+        body = b'x' * 100
+        with mock.patch('response_cache.time.time') as now:
+            for second, key in enumerate(['a', 'b', 'c']):
+                now.return_value = 1000 + second
+                cache.set(key, ['movie'], 'application/json', body)
+            # a is used again, b is now the least recently used.
+            now.return_value = 1010
+            self.assertIsNotNone(cache.get('a'))
+            now.return_value = 1011
+            cache.set('d', ['movie'], 'application/json', body)
+
+        self.assertIsNone(cache.get('b'))
+        for key in ['a', 'c', 'd']:
+            self.assertIsNotNone(cache.get(key), key)
+
+        cache.set('big', ['movie'], 'application/json', b'x' * 101)
+        self.assertIsNone(cache.get('big'))
+
+        stats = cache.stats()
+        self.assertEqual(stats['evictions'], 1)
+        self.assertEqual(stats['entries'], 3)
+        self.assertLessEqual(stats['bytes'], 300)
+
+    # testExpiry() tests that entries are misses once ttl seconds passed.
+    def testExpiry(self):
+        cache = ResponseCache(path=self.path, ttl=60)
+        with mock.patch('response_cache.time.time') as now:
+            now.return_value = 1000
+            cache.set('movies', ['movie'], 'application/json', b'[1]')
+            now.return_value = 1059
+            self.assertIsNotNone(cache.get('movies'))
+            now.return_value = 1060
+            self.assertIsNone(cache.get('movies'))
+
+        stats = cache.stats()
+        self.assertEqual(stats['expirations'], 1)
+        self.assertEqual(stats['entries'], 0)
+
+    # testBrokenFile() tests that a cache file SQLite can't read turns
+    # every operation into a counted error and a miss.
+    def testBrokenFile(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'not a database' * 100)
+        cache = ResponseCache(path=self.path)
+
+        cache.set('movies', ['movie'], 'application/json', b'[1]')
+        self.assertIsNone(cache.get('movies'))
+        cache.invalidate(['movie'])
+
+        stats = cache.stats()
+        self.assertEqual(stats['errors'], 3)
+        self.assertEqual(stats['hits'], 0)
+        self.assertIsNone(stats['entries'])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,43 @@
+import unittest
+import json
+import os
+import subprocess
+import sys
+
+# Cold start of a worker: importing the app and calling the factory.
+# STARTUP_BUDGET_SECONDS bounds it so autoscaled workers come up quickly.
+BUDGET = float(os.environ.get('STARTUP_BUDGET_SECONDS', 2.0))
+
+COLD_START = '''
+import json, time
+start = time.perf_counter()
+from app import create_app
+app = create_app()
+print(json.dumps({'seconds': time.perf_counter() - start}))
+'''
+
+
+class StartupTestCase(unittest.TestCase):
+    # testColdStart() boots the app in a fresh interpreter against a
+    # database that can't be opened, so any I/O at startup fails the test.
+    def testColdStart(self):
+        env = dict(os.environ,
+                   DATABASE_URL='sqlite:////nonexistent/capstone.sqlite',
+                   AUTH0_DOMAIN='capstone.invalid',
+                   ALGORITHMS='RS256',
+                   AUDIENCE='capstone')
+
+        result = subprocess.run([sys.executable, '-c', COLD_START],
+                                cwd=os.path.dirname(os.path.abspath(__file__)),
+                                env=env,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE,
+                                timeout=60)
+
+        self.assertEqual(result.returncode, 0, result.stderr.decode())
+        seconds = json.loads(result.stdout.decode().splitlines()[-1])
+        self.assertLess(seconds['seconds'], BUDGET)
+
+
+if __name__ == "__main__":
+    unittest.main()
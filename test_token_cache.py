@@ -0,0 +1,67 @@
+import unittest
+from unittest import mock
+from token_cache import TokenCache
+
+PAYLOAD = {'sub': 'auth0|1', 'permissions': ['view:content']}
+
+
+class TokenCacheTestCase(unittest.TestCase):
+    # testExpiry() tests that an entry expires after ttl seconds, and never
+    # outlives the 'exp' claim of its token.
+    def testExpiry(self):
+        cache = TokenCache(ttl=300)
+        with mock.patch('token_cache.time.time') as now:
+            now.return_value = 1000
+            cache.put('long', PAYLOAD)
+            entry = cache.put('short', dict(PAYLOAD, exp=1060))
+            self.assertEqual(entry.expires_at, 1060)
+
+            now.return_value = 1059
+            self.assertIs(cache.get('short'), entry)
+            now.return_value = 1060
+            self.assertIsNone(cache.get('short'))
+            self.assertIsNotNone(cache.get('long'))
+            now.return_value = 1300
+            self.assertIsNone(cache.get('long'))
+
+        stats = cache.stats()
+        self.assertEqual(stats['expirations'], 2)
+        self.assertEqual(stats['size'], 0)
+
+    # testEviction() tests that the least recently used entry is evicted
+    # once the cache holds max_size tokens.
+    def testEviction(self):
+        cache = TokenCache(max_size=2)
+        cache.put('a', PAYLOAD)
+        cache.put('b', PAYLOAD)
+        self.assertIsNotNone(cache.get('a'))
+        cache.put('c', PAYLOAD)
+
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNotNone(cache.get('c'))
+        stats = cache.stats()
+        self.assertEqual(stats['evictions'], 1)
+        self.assertEqual(stats['size'], 2)
+
+    # testStats() tests the hit and miss counters, and that a disabled
+    # cache stores nothing.
+    def testStats(self):
+        cache = TokenCache()
+        self.assertIsNone(cache.get('a'))
+        entry = cache.put('a', PAYLOAD)
+        self.assertIs(cache.get('a'), entry)
+        self.assertIs(cache.get('a'), entry)
+        self.assertEqual(entry.permissions, frozenset(['view:content']))
+
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (2, 1))
+
+        disabled = TokenCache(max_size=0)
+        disabled.put('a', PAYLOAD)
+        self.assertIsNone(disabled.get('a'))
+        self.assertEqual(disabled.stats()['size'], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,89 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+
+# VerifiedToken is a cache entry: the decoded payload of a token whose
+# signature and claims were already checked, plus its permissions as a set.
+class VerifiedToken:
+    __slots__ = ('payload', 'permissions', 'expires_at')
+
+    def __init__(self, payload, expires_at):
+        self.payload = payload
+        self.expires_at = expires_at
+        if 'permissions' in payload:
+            self.permissions = frozenset(payload['permissions'])
+        else:
+            self.permissions = None
+
+
+# TokenCache is a bounded LRU of verified tokens keyed by a hash of the raw
+# token, so the raw bearer tokens are never kept in memory. Entries expire
+# after ttl seconds and never outlive the token's own 'exp' claim.
+class TokenCache:
+    def __init__(self, max_size=10000, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {
+            'hits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'expirations': 0,
+        }
+
+    # get() returns the VerifiedToken for token, or None on a miss.
+    def get(self, token):
+        if self.max_size <= 0:
+            return None
+
+        key = self._key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+            if entry.expires_at <= time.time():
+                del self._entries[key]
+                self._stats['expirations'] += 1
+                self._stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            return entry
+
+    # put() stores the payload of a freshly verified token and returns
+    # its VerifiedToken.
+    def put(self, token, payload):
+        expires_at = time.time() + self.ttl
+        if 'exp' in payload:
+            expires_at = min(expires_at, payload['exp'])
+        entry = VerifiedToken(payload, expires_at)
+
+        if self.max_size <= 0:
+            return entry
+
+        key = self._key(token)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+        return entry
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    # stats() returns a copy of the counters and the current size.
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = len(self._entries)
+        return stats
+
+    def _key(self, token):
+        return hashlib.sha256(token.encode()).digest()